@@ -10,16 +10,20 @@
 # ---------------------------------------------------------------------------
 
 
+import collections
+import concurrent.futures
 import os
 import random
 import socket
 import subprocess
-import tempfile
+import threading
 import time
 import zmq
 import zstandard as zstd
 
 from mtda.main import MultiTenantDeviceAccess
+from mtda.storage.datastream import Frame
+from mtda.storage.fetch import HTTPSource, RangeFetcher
 from mtda.utils import Compression
 import mtda.constants as CONSTS
 
@@ -158,6 +162,138 @@ class Client:
                 else:
                     raise
 
+    def storage_commit(self, **kwargs):
+        """
+        Commit changes made to the shared storage and wait for them to be
+        merged. Returns whether they were committed.
+        """
+        impl = self._impl
+        session = kwargs.get('session', self._session)
+        events = self._storage_events(credits=False)
+        try:
+            job = impl.storage_commit(session=session)
+            if isinstance(job, bool) or job is None:
+                # older agents commit synchronously
+                return job
+            result = impl.storage_commit_status(job, session=session)
+            while result is None:
+                if events is not None:
+                    events.committed(job)
+                else:
+                    time.sleep(CONSTS.STORAGE.COMMIT_INTERVAL)
+                result = impl.storage_commit_status(job, session=session)
+            return result
+        finally:
+            if events is not None:
+                events.close()
+
+    def storage_fetch(self, url, bmap_url=None):
+        """
+        Have the agent download an image from a HTTP(S) server and write it
+        to the shared storage
+        """
+        impl = self._impl
+        # subscribe before the write starts not to miss its completion
+        events = self._storage_events(credits=False)
+        try:
+            size = impl.storage_fetch(url, bmap_url, session=self._session)
+            if events is not None:
+                events.written()
+            if not untimed(impl, 'storage_flush', size,
+                           session=self._session):
+                raise IOError('image write failed!')
+        finally:
+            self.storage_close()
+            impl.storage_bmap_dict(None)
+            if events is not None:
+                events.close()
+
+    def storage_dump(self, path, bmap_path=None):
+        """
+        Dump the shared storage to a zstd-compressed image at the specified
+        path and write its block map next to it (the .zst extension of the
+        image replaced with .bmap) unless a path is specified for it
+        """
+        from mtda.storage.helpers.bmap import BlockMap
+
+        if bmap_path is None:
+            base, ext = os.path.splitext(path)
+            bmap_path = (base if ext == '.zst' else path) + '.bmap'
+
+        port = self._impl.storage_dump(session=self._session)
+        context = zmq.Context()
+        socket = context.socket(zmq.PULL)
+        socket.setsockopt(zmq.RCVTIMEO, CONSTS.WRITER.DUMP_TIMEOUT * 1000)
+        hwm = int(CONSTS.WRITER.HIGH_WATER_MARK / CONSTS.WRITER.DUMP_SIZE)
+        socket.setsockopt(zmq.RCVHWM, max(hwm, 1))
+        socket.connect(f'tcp://{self.remote()}:{port}')
+
+        # data that was not sent is zeroes
+        cctx = zstd.ZstdCompressor()
+        zeroes = cctx.compress(bytes(CONSTS.WRITER.DUMP_SIZE))
+
+        def fill(out, size):
+            while size >= CONSTS.WRITER.DUMP_SIZE:
+                out.write(zeroes)
+                size -= CONSTS.WRITER.DUMP_SIZE
+            if size > 0:
+                out.write(cctx.compress(bytes(size)))
+
+        try:
+            with open(path, 'wb') as out:
+                pos = 0
+                expected = 0
+                while True:
+                    try:
+                        message = socket.recv(copy=False).buffer
+                    except zmq.Again:
+                        raise IOError('timeout while receiving the dump')
+                    sequence, offset, size, payload = Frame.decode(message)
+                    if sequence != expected:
+                        raise IOError(f'dump frame #{expected} was lost')
+                    expected += 1
+                    if size == 0 and len(payload) > 0:
+                        payload = bytes(payload)
+                        if not payload.startswith(BlockMap.MAGIC):
+                            raise IOError(payload.decode(errors='replace'))
+                        bmap = BlockMap.decode(payload)
+                        break
+                    if offset > pos:
+                        fill(out, offset - pos)
+                        pos = offset
+                    if size > 0:
+                        out.write(payload)
+                        pos += size
+                if bmap.image_size > pos:
+                    fill(out, bmap.image_size - pos)
+        except BaseException:
+            # let the agent release the storage
+            self.storage_close()
+            raise
+        finally:
+            socket.close(linger=0)
+
+        with open(bmap_path, 'w') as f:
+            f.write(bmap.xml())
+        return bmap
+
+    def _storage_events(self, credits=True):
+        """
+        Subscribe to events of the shared storage and enable flow control
+        of data we send (if supported by the agent)
+        """
+        host = self.remote()
+        if host is None:
+            return None
+        result = StorageEvents(host, self._agent.conport)
+        if credits is True:
+            try:
+                result.credits(self._impl, self._session)
+            except Exception as e:
+                # e.g. older agents
+                self.debug(2, f"client._storage_events(): {e}")
+        return result
+
     def storage_update(self, dest, src=None, **kwargs):
         session = kwargs.get('session', self._session)
 
@@ -172,11 +308,12 @@ class Client:
         impl = self._impl
 
         # Get file handler from specified path
-        file = ImageFile.new(path, impl, session, blksz)
+        file = ImageFile.new(path, impl, session, blksz, self._agent)
+        events = self._storage_events()
 
         try:
             # Prepare for download/copy
-            file.prepare(self._data, size)
+            file.prepare(self._data, size, events=events)
 
             # Copy image to shared storage
             file.copy()
@@ -189,14 +326,20 @@ class Client:
         finally:
             # Storage may be closed now
             self.storage_close()
+            if events is not None:
+                events.close()
 
-    def storage_write_image(self, path):
+    def storage_write_image(self, path, delta=False, verify=False):
         blksz = self._agent.blksz
         impl = self._impl
         session = self._session
 
         # Get file handler from specified path
-        file = ImageFile.new(path, impl, session, blksz)
+        file = ImageFile.new(path, impl, session, blksz, self._agent)
+
+        # Try the cache of the agent first
+        if delta is False and self._storage_write_cached(file, verify):
+            return
 
         # Open the shared storage device so we own it
         # It also prevents us from loading a new bmap file while
@@ -205,6 +348,7 @@ class Client:
 
         # Automatically discover the bmap file
         bmap = None
+        bmapDict = None
         image_path = file.path()
         image_size = None
         while True:
@@ -217,8 +361,7 @@ class Client:
                     bmap = ET.fromstring(bmap)
                     print(f"Discovered bmap file '{bmap_path}'")
                     bmapDict = self.parseBmap(bmap, bmap_path)
-                    self._impl.storage_bmap_dict(bmapDict)
-                    image_size = bmapDict['ImageSize']
+                    image_size = bmapDict.image_size
                     break
             except Exception:
                 pass
@@ -227,9 +370,32 @@ class Client:
                 print("No bmap file found at location of image")
                 break
 
+        # Get hashes of blocks from the shared storage to only send
+        # blocks that differ
+        checksums = None
+        if delta is True:
+            if file.random_access is False:
+                print("Differential write requires an uncompressed "
+                      "local image, writing the full image")
+            else:
+                try:
+                    checksums = self._storage_checksums(file.size)
+                except Exception as e:
+                    print(f"Differential write not supported ({str(e)}), "
+                          "writing the full image")
+
+        # Checksums of mapped ranges cannot be verified by the agent if
+        # only some of their blocks are sent
+        bmapSent = bmapDict is not None and checksums is None
+        if bmapSent is True:
+            self._impl.storage_bmap_dict(bmapDict.encode())
+
+        events = self._storage_events()
         try:
             # Prepare for download/copy
-            file.prepare(self._data, image_size)
+            file.prepare(self._data, image_size, bmap=bmapDict,
+                         checksums=checksums, resume=self._storage_resume,
+                         events=events)
 
             # Copy image to shared storage
             file.copy()
@@ -237,42 +403,97 @@ class Client:
             # Wait for background writes to complete
             file.flush()
 
+            # Read the image back from the shared storage
+            if verify is True:
+                self._storage_verify(file, bmapSent)
+
         except Exception:
             raise
         finally:
             # Storage may be closed now
             self.storage_close()
             self._impl.storage_bmap_dict(None)
+            if events is not None:
+                events.close()
+
+    def _storage_verify(self, file, bmap=None):
+        """
+        Verify the written image against its block map if the agent has it
+        (bmap is True), against hashes of our image otherwise (if available)
+        """
+        checksums = None
+        size = 0
+        if bmap is not True and file.random_access is True:
+            checksums = file.checksums()
+            size = file.size
+        elif bmap is False:
+            print("Verification requires a bmap file or an uncompressed "
+                  "local image, skipping")
+            return
+
+        print(f"Verifying '{file.path()}'")
+        result = untimed(self._impl, 'storage_verify', checksums, size,
+                         session=self._session)
+        if result is False:
+            raise IOError('image verification failed!')
+
+    def _storage_write_cached(self, file, verify=False):
+        impl = self._impl
+        events = None
+        try:
+            # check if the agent caches images before hashing ours
+            if self.storage_write_cached() is None:
+                return False
+            digest = file.digest()
+            if digest is None:
+                return False
+            # subscribe before the write starts not to miss its completion
+            events = self._storage_events(credits=False)
+            size = self.storage_write_cached(digest)
+        except Exception:
+            size = None
+        if not size:
+            if events is not None:
+                events.close()
+            return False
+
+        print(f"Writing '{file.path()}' from the cache of the agent")
+        try:
+            if events is not None:
+                events.written()
+            if not untimed(impl, 'storage_flush', size,
+                           session=self._session):
+                raise IOError('image write failed!')
+            if verify is True:
+                self._storage_verify(file)
+        finally:
+            self.storage_close()
+            impl.storage_bmap_dict(None)
+            if events is not None:
+                events.close()
+        return True
+
+    def _storage_resume(self, sent):
+        port, checkpoint, received = self.storage_resume(sent)
+        if self._data is not None:
+            self._data.close(linger=0)
+        socket = self._storage_socket(port)
+        return socket, checkpoint, received
+
+    def _storage_checksums(self, size):
+        # hashing blocks that were not written by the agent may take a while
+        return untimed(self._impl, 'storage_checksums', size,
+                       session=self._session)
 
     def parseBmap(self, bmap, bmap_path):
+        from mtda.storage.helpers.bmap import BlockMap
+
         try:
-            bmapDict = {}
-            bmapDict["BlockSize"] = int(
-                bmap.find("BlockSize").text.strip())
-            bmapDict["BlocksCount"] = int(
-                bmap.find("BlocksCount").text.strip())
-            bmapDict["MappedBlocksCount"] = int(
-                bmap.find("MappedBlocksCount").text.strip())
-            bmapDict["ImageSize"] = int(
-                bmap.find("ImageSize").text.strip())
-            bmapDict["ChecksumType"] = \
-                bmap.find("ChecksumType").text.strip()
-            bmapDict["BmapFileChecksum"] = \
-                bmap.find("BmapFileChecksum").text.strip()
-            bmapDict["BlockMap"] = []
-            for child in bmap.find("BlockMap").findall("Range"):
-                range = child.text.strip().split("-")
-                first = range[0]
-                last = range[0] if len(range) == 1 else range[1]
-                bmapDict["BlockMap"].append({
-                    "first": int(first),
-                    "last": int(last),
-                    "chksum": child.attrib["chksum"]
-                })
+            result = BlockMap.parse(bmap)
         except Exception:
             print(f"Error parsing '{bmap_path}', probably not a bmap 2.0 file")
             return None
-        return bmapDict
+        return result
 
     def start(self):
         return self._agent.start()
@@ -308,21 +529,134 @@ class Client:
         return self._impl.video_url(host, opts)
 
 
+class StorageEvents:
+    """
+    STORAGE events of the agent while the shared storage is being written:
+    CREDIT events tell how many bytes we may have sent so far (flow control,
+    see storage_credits()) and INITIALIZED or CORRUPTED events that the
+    write completed. COMMITTED events tell that a commit completed.
+    """
+
+    def __init__(self, host, port):
+        self._agent = None
+        self._committed = set()
+        self._session = None
+        self._limit = None
+        self._status = None
+        self._context = zmq.Context()
+        self._socket = self._context.socket(zmq.SUB)
+        self._socket.setsockopt(zmq.SUBSCRIBE, CONSTS.CHANNEL.EVENTS)
+        self._socket.connect(f'tcp://{host}:{port}')
+
+    def credits(self, agent, session):
+        """ Enable flow control (fails if not supported by the agent) """
+        self._agent = agent
+        self._session = session
+        self._limit = 0
+        try:
+            self.refresh()
+        except Exception:
+            self._limit = None
+            raise
+
+    @property
+    def crediting(self):
+        return self._limit is not None
+
+    def refresh(self):
+        """ Ask the agent for credits (raises an error if writes failed) """
+        limit = self._agent.storage_credits(session=self._session)
+        self._limit = max(self._limit, limit)
+
+    def _receive(self):
+        while self._socket.poll(0):
+            _, data = self._socket.recv_multipart()
+            event = data.decode('utf-8').split()
+            if len(event) < 2 or event[0] != CONSTS.EVENTS.STORAGE:
+                continue
+            if event[1] == CONSTS.STORAGE.CREDIT and self.crediting:
+                self._limit = max(self._limit, int(event[2]))
+            elif event[1] in [CONSTS.STORAGE.INITIALIZED,
+                              CONSTS.STORAGE.CORRUPTED]:
+                self._status = event[1]
+            elif event[1] == CONSTS.STORAGE.COMMITTED and len(event) > 2:
+                self._committed.add(int(event[2]))
+
+    def wait(self, offset):
+        """ Wait until we may have sent data up to the specified offset """
+        timeout = CONSTS.WRITER.RECV_TIMEOUT * 1000
+        self._receive()
+        while offset > self._limit:
+            if self._socket.poll(timeout) == 0:
+                # events may have been missed (e.g. before we subscribed)
+                self.refresh()
+            else:
+                self._receive()
+
+    def written(self):
+        """
+        Wait for the write to complete. Returns None if events stopped
+        coming (e.g. while written data is being synced) or the status of
+        the shared storage otherwise.
+        """
+        timeout = CONSTS.WRITER.RECV_TIMEOUT * 1000
+        self._receive()
+        while self._status is None:
+            if self._socket.poll(timeout) == 0:
+                break
+            self._receive()
+        return self._status
+
+    def committed(self, job):
+        """
+        Wait for the specified commit to complete. Returns whether it did
+        (events may have been missed: check with storage_commit_status()).
+        """
+        timeout = CONSTS.WRITER.RECV_TIMEOUT * 1000
+        self._receive()
+        while job not in self._committed:
+            if self._socket.poll(timeout) == 0:
+                break
+            self._receive()
+        return job in self._committed
+
+    def close(self):
+        self._socket.close(linger=0)
+        self._context.term()
+
+
+def untimed(impl, name, *args, **kwargs):
+    """ Call a (long running) method of the agent without RPC timeout """
+    timeout = getattr(impl, '_pyroTimeout', None)
+    try:
+        if timeout is not None:
+            impl._pyroTimeout = None
+        return getattr(impl, name)(*args, **kwargs)
+    finally:
+        if timeout is not None:
+            impl._pyroTimeout = timeout
+
+
 class ImageFile:
     """ Base class for image files (local or remote) """
 
-    def new(path, agent, session, blksz):
+    def new(path, agent, session, blksz, config=None):
         if path.startswith('s3:'):
-            return ImageS3(path, agent, session, blksz)
+            return ImageS3(path, agent, session, blksz, config)
+        elif path.startswith(('http://', 'https://')):
+            return ImageHTTP(path, agent, session, blksz, config)
         else:
             return ImageLocal(path, agent, session, blksz)
 
     def __init__(self, path, agent, session, blksz):
         self._agent = agent
         self._blksz = blksz
+        self._events = None
         self._imgname = os.path.basename(path)
         self._inputsize = 0
         self._path = path
+        self._ranges = None
+        self._resume = None
         self._session = session
         self._totalread = 0
         self._totalsent = 0
@@ -330,15 +664,124 @@ class ImageFile:
     def bmap(self, path):
         return None
 
+    def digest(self):
+        """ SHA-256 digest of the image, None if not available """
+        return None
+
+    def checksums(self):
+        """ Hashes of blocks of the image (see BlockHashIndex) """
+        from mtda.storage.helpers.hashindex import BlockHashIndex
+
+        blksz = CONSTS.WRITER.HASH_BLOCK_SIZE
+        result = bytearray()
+        for offset in range(0, self.size, blksz):
+            result += BlockHashIndex.digest(self._read(offset, blksz))
+        return bytes(result)
+
+    def copy(self):
+        """ Copy the image to the shared storage """
+        if self._ranges is not None:
+            self._copy_ranges()
+
+    def _copy_ranges(self):
+        """ Send ranges of the image as compressed frames """
+        end = self._ranges[-1][1] if self._ranges else 0
+        checkpoint = 0
+        while True:
+            try:
+                self._send_frames(checkpoint)
+                if self._resume is None or end == 0:
+                    break
+                # resume from the last frame written if frames were lost
+                received, lost = untimed(self._agent, 'storage_received',
+                                         self._totalsent,
+                                         session=self._session)
+                if lost is False and received == self._totalsent:
+                    break
+                checkpoint = self._resume_transfer()
+                if checkpoint >= end:
+                    break
+            except Pyro4.errors.CommunicationError as e:
+                if self._resume is None:
+                    raise
+                print(f"\nTransfer interrupted ({str(e)}), resuming...")
+                checkpoint = self._resume_transfer()
+
+    def _send_frames(self, start=0):
+        """ Send frames from the specified offset """
+        local = threading.local()
+
+        def compress(data):
+            # compressors cannot be shared between threads
+            cctx = getattr(local, 'cctx', None)
+            if cctx is None:
+                cctx = local.cctx = zstd.ZstdCompressor(level=1)
+            return cctx.compress(data)
+
+        # frames are compressed independently on a pool of threads
+        workers = os.cpu_count() or 1
+        pending = collections.deque()
+        sequence = 0
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            for offset, size, data in self._read_frames(start):
+                if len(data) != size:
+                    raise IOError(f'{self._path}: short read at offset {offset}!')
+                self._totalread += size
+                pending.append((offset, size, pool.submit(compress, data)))
+                # send compressed frames in order
+                while len(pending) > 2 * workers or \
+                        (pending and pending[0][2].done()):
+                    sequence = self._send_frame(sequence, *pending.popleft())
+            while pending:
+                sequence = self._send_frame(sequence, *pending.popleft())
+
+    def _send_frame(self, sequence, offset, size, future):
+        frame = Frame.encode(sequence, offset, size, future.result())
+        self._write_to_storage(frame)
+        return sequence + 1
+
+    def _resume_transfer(self):
+        """ Get a new data socket and offset to resume the transfer from """
+        deadline = time.monotonic() + CONSTS.WRITER.RESUME_TIMEOUT
+        while True:
+            try:
+                self._socket, checkpoint, self._totalsent = \
+                    self._resume(self._totalsent)
+                return checkpoint
+            except Pyro4.errors.CommunicationError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(CONSTS.WRITER.RESUME_INTERVAL)
+
+    def _frames(self):
+        """ Split mapped ranges into frames """
+        for start, end in self._ranges:
+            for offset in range(start, end, CONSTS.WRITER.FRAME_SIZE):
+                yield offset, min(CONSTS.WRITER.FRAME_SIZE, end - offset)
+
+    def _read_frames(self, start=0):
+        """ Read frames (offset, size, data) from the specified offset """
+        for offset, size in self._frames():
+            if offset < start:
+                continue
+            yield offset, size, self._read(offset, size)
+
+    def _read(self, offset, size):
+        """ Read data from the specified offset of the image """
+        raise NotImplementedError('random access not supported')
+
+    @property
+    def random_access(self):
+        return False
+
     def flush(self):
-        # Wait for background writes to complete
-        agent = self._agent
+        # Wait for background writes to complete: their completion is
+        # announced with an event, storage_flush() also waits for them
         self._socket.send(b'')
-        writing = True
-        while writing:
-            _, writing, written = agent.storage_status()
-            time.sleep(0.5)
-        success = agent.storage_flush(self._totalsent)
+        if self._events is not None:
+            self._events.written()
+        success = untimed(self._agent, 'storage_flush', self._totalsent,
+                          session=self._session)
         self._socket.close()
         self._socket = None
         if not success:
@@ -347,13 +790,29 @@ class ImageFile:
     def path(self):
         return self._path
 
-    def prepare(self, socket, output_size=None, compression=None):
+    def prepare(self, socket, output_size=None, compression=None, bmap=None,
+                checksums=None, resume=None, events=None):
         compr = None
         if compression is None:
             compr = Compression.from_extension(self._path)
         self._inputsize = self.size
         self._outputsize = output_size
         self._socket = socket
+        self._events = events
+        self._resume = None
+        # send uncompressed images as frames: only mapped (or changed)
+        # ranges are sent and transfers may be resumed
+        self._ranges = None
+        if compr == CONSTS.IMAGE.RAW.value and self.random_access is True:
+            if self._agent.storage_sparse(
+                    True, session=self._session) is not None:
+                self._resume = resume
+                if bmap is not None:
+                    self._ranges = self._mapped_ranges(bmap)
+                else:
+                    self._ranges = [(0, self._inputsize)]
+                if checksums is not None:
+                    self._ranges = self._changed_ranges(checksums)
         # if image is uncompressed, we compress on the fly
         if compr == CONSTS.IMAGE.RAW.value:
             compr = CONSTS.IMAGE.ZST.value
@@ -361,11 +820,55 @@ class ImageFile:
         self._lastreport = time.time()
         self._totalread = 0
 
+    def _mapped_ranges(self, bmap):
+        """ Get mapped ranges of the image (in bytes) from its bmap """
+        return list(bmap.ranges())
+
+    def _changed_ranges(self, checksums):
+        """ Restrict ranges to blocks that differ from the shared storage """
+        from mtda.storage.helpers.hashindex import BlockHashIndex
+
+        blksz = CONSTS.WRITER.HASH_BLOCK_SIZE
+        dgsz = BlockHashIndex.DIGEST_SIZE
+        changed = {}
+        result = []
+        for start, end in self._ranges:
+            offset = start
+            while offset < end:
+                block = offset // blksz
+                if block not in changed:
+                    bstart = block * blksz
+                    data = self._read(bstart, blksz)
+                    digest = BlockHashIndex.digest(data)
+                    changed[block] = (
+                        digest != checksums[block * dgsz:(block + 1) * dgsz])
+                stop = min(end, (block + 1) * blksz)
+                if changed[block] is True:
+                    if result and result[-1][1] == offset:
+                        result[-1] = (result[-1][0], stop)
+                    else:
+                        result.append((offset, stop))
+                offset = stop
+        return result
+
     @property
     def size(self):
         return 0
 
     def _write_to_storage(self, data):
+        events = self._events
+        if events is not None and events.crediting:
+            # send what the agent allows us to
+            events.wait(self._totalsent + len(data))
+            timeout = CONSTS.WRITER.RECV_TIMEOUT * 1000
+            while self._socket.poll(timeout, zmq.POLLOUT) == 0:
+                # fails if the agent stopped writing
+                events.refresh()
+            self._socket.send(data)
+            self._totalsent += len(data)
+            return
+
+        # agents without flow control
         backoff = 0
         while True:
             try:
@@ -390,6 +893,7 @@ class ImageLocal(ImageFile):
 
     def __init__(self, path, agent, session, blksz):
         super().__init__(path, agent, session, blksz)
+        self._image = None
 
     def bmap(self, path):
         if os.path.exists(path):
@@ -397,14 +901,30 @@ class ImageLocal(ImageFile):
                 return f.read()
         return None
 
+    def digest(self):
+        import hashlib
+
+        result = hashlib.sha256()
+        with open(self._path, 'rb') as f:
+            while (data := f.read(CONSTS.WRITER.READ_SIZE)):
+                result.update(data)
+        return result.hexdigest()
+
     def copy(self):
         if os.path.exists(self._path) is False:
             raise IOError(f'{self._path}: image not found!')
 
+        if self._ranges is not None:
+            try:
+                self._copy_ranges()
+            finally:
+                self._close()
+            return
+
         image = open(self._path, 'rb')
         comp_on_the_fly = False
         if Compression.from_extension(self._path) == CONSTS.IMAGE.RAW.value:
-            cctx = zstd.ZstdCompressor(level=1)
+            cctx = zstd.ZstdCompressor(level=1, threads=-1)
             comp_on_the_fly = True
             inputstream = cctx.stream_reader(image)
         else:
@@ -420,18 +940,132 @@ class ImageLocal(ImageFile):
             else:
                 image.close()
 
+    def _close(self):
+        if self._image is not None:
+            self._image.close()
+            self._image = None
+
+    def _read(self, offset, size):
+        if self._image is None:
+            self._image = open(self._path, 'rb')
+        return os.pread(self._image.fileno(), size, offset)
+
+    @property
+    def random_access(self):
+        compr = Compression.from_extension(self._path)
+        return compr == CONSTS.IMAGE.RAW.value
+
     @property
     def size(self):
         st = os.stat(self._path)
         return st.st_size
 
 
-class ImageS3(ImageFile):
-    """ An image to be downloaded from a S3 bucket """
+class ImageRanged(ImageFile):
+    """
+    Base class for remote images read with concurrent ranged requests (see
+    RangeFetcher)
+    """
 
-    def __init__(self, path, agent, session, blksz):
+    def __init__(self, path, agent, session, blksz, concurrency, partsz):
         super().__init__(path, agent, session, blksz)
-        self._object = None
+        self._concurrency = concurrency
+        self._partsz = partsz
+
+    def copy(self):
+        if self._ranges is not None:
+            self._copy_ranges()
+            return
+
+        # images that are not compressed get compressed on the fly
+        cobj = None
+        if Compression.from_extension(self._path) == CONSTS.IMAGE.RAW.value:
+            cobj = zstd.ZstdCompressor(level=1).compressobj()
+
+        for data in self._stream():
+            self._totalread += len(data)
+            if cobj is not None:
+                data = cobj.compress(data)
+            for offset in range(0, len(data), self._blksz):
+                self._write_to_storage(data[offset:offset + self._blksz])
+        if cobj is not None:
+            self._write_to_storage(cobj.flush())
+
+    def _stream(self):
+        """ Get data of the image (in order) """
+        parts = RangeFetcher.split([(0, self.size)], self._partsz)
+        for _, data in RangeFetcher(self._read, parts, self._concurrency):
+            yield data
+
+    def _read_frames(self, start=0):
+        """ Read frames from parts fetched concurrently """
+        frame = CONSTS.WRITER.FRAME_SIZE
+        # parts are made of whole frames
+        partsz = max(frame, self._partsz - self._partsz % frame)
+        parts = [(offset, size) for offset, size
+                 in RangeFetcher.split(self._ranges, partsz)
+                 if offset + size > start]
+        for offset, data in RangeFetcher(self._read, parts,
+                                         self._concurrency):
+            view = memoryview(data)
+            for pos in range(0, len(data), frame):
+                if offset + pos < start:
+                    continue
+                size = min(frame, len(data) - pos)
+                yield offset + pos, size, view[pos:pos + size]
+
+    @property
+    def ranged(self):
+        """ Whether ranges of the image may be read """
+        return True
+
+    @property
+    def random_access(self):
+        compr = Compression.from_extension(self._path)
+        return compr == CONSTS.IMAGE.RAW.value and self.ranged
+
+
+class ImageHTTP(ImageRanged):
+    """ An image to be downloaded from a HTTP(S) server (see HTTPSource) """
+
+    def __init__(self, path, agent, session, blksz, config=None):
+        concurrency = getattr(config, 'http_concurrency',
+                              CONSTS.DEFAULTS.HTTP_CONCURRENCY)
+        partsz = getattr(config, 'http_part_size',
+                         CONSTS.DEFAULTS.HTTP_PART_SIZE)
+        super().__init__(path, agent, session, blksz, concurrency, partsz)
+        self._source = HTTPSource(path, concurrency, partsz)
+
+    def bmap(self, path):
+        return self._source.text(path)
+
+    def _read(self, offset, size):
+        return self._source.read(offset, size)
+
+    def _stream(self):
+        return self._source.stream(self._blksz)
+
+    @property
+    def ranged(self):
+        return self._source.ranged
+
+    @property
+    def size(self):
+        return self._source.size
+
+
+class ImageS3(ImageRanged):
+    """ An image to be downloaded from a S3 bucket """
+
+    def __init__(self, path, agent, session, blksz, config=None):
+        super().__init__(path, agent, session, blksz,
+                         getattr(config, 's3_concurrency',
+                                 CONSTS.DEFAULTS.S3_CONCURRENCY),
+                         getattr(config, 's3_part_size',
+                                 CONSTS.DEFAULTS.S3_PART_SIZE))
+        self._client = None
+        self._endpoint = getattr(config, 's3_endpoint', None)
+        self._size = None
 
         from urllib.parse import urlparse
         url = urlparse(self._path)
@@ -444,60 +1078,31 @@ class ImageS3(ImageFile):
         url = urlparse(path)
         bucket = url.hostname
         key = url.path[1:]
-        result = None
 
         if bucket != self._bucket:
             raise RuntimeError('bmap shall be downloaded from the same S3 '
                                'bucket as the image!')
 
-        bmap = self._open(key)
-        with tempfile.NamedTemporaryFile(mode='w+', delete=False) as tmp:
-            from boto3.s3.transfer import TransferConfig
-
-            config = TransferConfig(use_threads=False)
-            bmap.download_file(Filename=tmp.name, Config=config)
-            bmap = None
-
-            tmp.close()
-            with open(tmp.name, 'r') as f:
-                result = f.read()
-            os.unlink(tmp.name)
-
-        return result
-
-    def copy(self):
-        if self._object is None:
-            self._object = self._open()
+        response = self._s3().get_object(Bucket=bucket, Key=key)
+        return response['Body'].read().decode()
 
-        from boto3.s3.transfer import TransferConfig
-        config = TransferConfig(use_threads=False)
-        self._object.download_fileobj(self, Config=config)
+    def _read(self, offset, size):
+        response = self._s3().get_object(
+            Bucket=self._bucket, Key=self._key,
+            Range=f'bytes={offset}-{offset + size - 1}')
+        return response['Body'].read()
 
     @property
     def size(self):
-        if self._object is None:
-            self._object = self._open()
-
-        result = None
-        if self._object is not None:
-            result = self._object.content_length
-        return result
-
-    def write(self, data):
-        """ called by boto3 as data gets downloaded from S3 """
-
-        dataread = len(data)
-        self._totalread += dataread
-
-        # Write block to shared storage device
-        self._write_to_storage(data)
-
-        return dataread
-
-    def _open(self, key=None):
-        if key is None:
-            key = self._key
-
-        import boto3
-        s3 = boto3.resource('s3')
-        return s3.Object(self._bucket, key)
+        if self._size is None:
+            response = self._s3().head_object(Bucket=self._bucket,
+                                              Key=self._key)
+            self._size = response['ContentLength']
+        return self._size
+
+    def _s3(self):
+        """ Get a S3 client (which may be shared between threads) """
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('s3', endpoint_url=self._endpoint)
+        return self._client
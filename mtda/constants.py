@@ -26,6 +26,12 @@ class DEFAULTS:
     WWW_PORT = 5000
     WWW_WORKERS = 10
     IMAGE_FILESIZE = 8*1024**3
+    IMAGE_CACHE_SIZE = 32*1024**3
+    HTTP_CONCURRENCY = 8
+    HTTP_PART_SIZE = 8*1024**2
+    HTTP_TIMEOUT = 30
+    S3_CONCURRENCY = 8
+    S3_PART_SIZE = 8*1024**2
 
 
 class EVENTS:
@@ -53,6 +59,14 @@ class MOUSE:
     MAX_Y = 32767
 
 
+class NBD:
+    ALLOW_FILE = '/etc/nbd-server/allow'
+    EXPORT = 'mtda-storage'
+    MAX_REQUEST = 32*1024**2
+    PORT = 10809
+    QUEUE_DEPTH = 16
+
+
 class POWER:
     OFF = "OFF"
     ON = "ON"
@@ -82,9 +96,17 @@ class STORAGE:
     UNLOCKED = "UNLOCKED"
     OPENED = "OPENED"
     WRITING = "WRITING"
+    CREDIT = "CREDIT"
+    COMMITTING = "COMMITTING"
+    COMMITTED = "COMMITTED"
+    DUMPING = "DUMPING"
+    DUMPED = "DUMPED"
+    VERIFYING = "VERIFYING"
+    VERIFIED = "VERIFIED"
     CORRUPTED = "CORRUPTED"
     INITIALIZED = "INITIALIZED"
     UNKNOWN = "???"
+    COMMIT_INTERVAL = 1
     RETRY_INTERVAL = 0.5
     TIMEOUT = 30
 
@@ -95,11 +117,29 @@ class USB:
 
 
 class WRITER:
+    CREDIT_WINDOW = 16*1024**2
+    DECODE_MEMORY = 256*1024**2
+    DIRECT_ALIGNMENT = 4096
+    DIRECT_BUFFERS = 8
+    DIRECT_BUFFER_SIZE = 1024**2
+    DUMP_BLOCK_SIZE = 4096
+    DUMP_LEVEL = 3
+    DUMP_SIZE = 4*1024**2
+    DUMP_TIMEOUT = 60
+    FRAME_SIZE = 256*1024
+    HASH_BLOCK_SIZE = 256*1024
+    HASH_READ_BLOCKS = 16
     HIGH_WATER_MARK = 16*1024**2
+    QUEUE_SIZE = 16
+    QUEUE_TIMEOUT = 0.5
     RECV_RETRIES = 5
     RECV_TIMEOUT = 5
+    RESUME_INTERVAL = 5
+    RESUME_TIMEOUT = 5*60
     SEND_BACKOFF_BASE = 0.1
     SEND_MAX_WAIT = 10
+    VERIFY_READ_SIZE = 8*1024**2
     READ_SIZE = 512*1024
     WRITE_SIZE = 512*1024
+    ZERO_BLOCK_SIZE = 64*1024
     NOTIFY_SECONDS = 1
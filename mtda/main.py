@@ -10,6 +10,7 @@
 # ---------------------------------------------------------------------------
 
 # System imports
+import base64
 import configparser
 import glob
 import importlib
@@ -35,9 +36,6 @@ except ImportError:
 DEFAULT_PREFIX_KEY = 'ctrl-a'
 DEFAULT_PASTEBIN_EP = "http://pastebin.com/api/api_post.php"
 
-NBD_CONF_DIR = '/etc/nbd-server/conf.d'
-NBD_CONF_FILE = 'mtda-storage.conf'
-
 
 def _make_printable(s):
     return s.encode('ascii', 'replace').decode()
@@ -73,8 +71,15 @@ class MultiTenantDeviceAccess:
         self._pastebin_endpoint = None
         self._session_manager = None
         self._session_timer = None
+        self._storage_cache = None
+        self._storage_cached = None
+        self._storage_committed = None
+        self._storage_committing = None
+        self._storage_dumper = None
+        self._storage_jobs = 0
         self._storage_locked = False
         self._storage_mounted = False
+        self._storage_nbd = None
         self._storage_opened = False
         self._storage_owner = None
         self._storage_status = CONSTS.STORAGE.UNKNOWN
@@ -88,8 +93,14 @@ class MultiTenantDeviceAccess:
         self.is_remote = False
         self.is_server = False
         self.remote = None
+        self.http_concurrency = CONSTS.DEFAULTS.HTTP_CONCURRENCY
+        self.http_part_size = CONSTS.DEFAULTS.HTTP_PART_SIZE
+        self.s3_concurrency = CONSTS.DEFAULTS.S3_CONCURRENCY
+        self.s3_endpoint = None
+        self.s3_part_size = CONSTS.DEFAULTS.S3_PART_SIZE
         self._power_expiry = None
         self._power_lock = threading.Lock()
+        self._storage_lock = threading.Lock()
         self._socket_lock = threading.Lock()
         self._time_from_pwr = None
         self._time_from_str = None
@@ -694,12 +705,33 @@ class MultiTenantDeviceAccess:
         return result
 
     @Pyro4.expose
-    def storage_bmap_dict(self, bmapDict, **kwargs):
+    def storage_credits(self, **kwargs):
+        """
+        Get the number of bytes the client may have sent to the shared
+        storage so far and have further credits granted with CREDIT events
+        as data gets consumed by the writer
+        """
+        self.mtda.debug(3, "main.storage_credits()")
+
+        session = kwargs.get("session", None)
+        self.session_ping(session)
+        if self.storage is None:
+            raise RuntimeError('no shared storage device')
+        elif self._storage_opened is False or \
+                self._storage_owner != session:
+            raise RuntimeError('shared storage not opened')
+        result = self._writer.credits()
+
+        self.mtda.debug(3, f"main.storage_credits(): {result}")
+        return result
+
+    @Pyro4.expose
+    def storage_bmap_dict(self, bmap, **kwargs):
         self.mtda.debug(3, "main.storage_bmap_dict()")
 
         result = None
         if self.storage is not None:
-            self.storage.setBmap(bmapDict)
+            self.storage.setBmap(bmap)
             result = True
         self.mtda.debug(3, f"main.storage_bmap_dict()(): {result}")
 
@@ -712,13 +744,12 @@ class MultiTenantDeviceAccess:
         if self.storage is None:
             result = False
         else:
-            conf = os.path.join(NBD_CONF_DIR, NBD_CONF_FILE)
-            if os.path.exists(conf):
-                os.unlink(conf)
-                cmd = ['systemctl', 'restart', 'nbd-server']
-                subprocess.check_call(cmd)
-
+            self._storage_unshare()
+            dumper = self._storage_dumper
+            if dumper is not None:
+                dumper.stop()
             self._writer.stop()
+            self._storage_cached = None
             self._storage_opened = not self.storage.close()
             self._storage_owner = None
             result = (self._storage_opened is False)
@@ -731,6 +762,12 @@ class MultiTenantDeviceAccess:
 
     @Pyro4.expose
     def storage_commit(self, **kwargs):
+        """
+        Commit changes made to the shared storage in the background. The
+        progress of the merge is reported with COMMITTING events and its
+        outcome with a COMMITTED event. Returns an identifier of the commit
+        (see storage_commit_status()) or False without shared storage.
+        """
         self.mtda.debug(3, "main.storage_commit()")
 
         session = kwargs.get("session", None)
@@ -741,14 +778,246 @@ class MultiTenantDeviceAccess:
             if not hasattr(self.storage, 'commit'):
                 raise NotImplementedError('commit is not supported for '
                                           f'{self.storage.variant}')
-            if self.storage_locked(session):
-                raise RuntimeError('cannot commit changes, '
-                                   'storage is locked!')
-            result = self.storage.commit()
+            with self._storage_lock:
+                if self.storage_locked(session):
+                    raise RuntimeError('cannot commit changes, '
+                                       'storage is locked!')
+                self._storage_jobs += 1
+                result = self._storage_jobs
+                self._storage_committing = result
+            self._storage_event(CONSTS.STORAGE.COMMITTING, f"{result} 0 0")
+            thread = threading.Thread(target=self._storage_commit,
+                                      args=(result,), daemon=True,
+                                      name='storage.commit')
+            thread.start()
 
         self.mtda.debug(3, f"main.storage_commit(): {result}")
         return result
 
+    def _storage_commit(self, job):
+        self.mtda.debug(3, f"main._storage_commit({job})")
+
+        def progress(merged, total):
+            self._storage_event(CONSTS.STORAGE.COMMITTING,
+                                f"{job} {merged} {total}")
+
+        error = None
+        try:
+            if self.storage.commit(progress=progress) is False:
+                error = 'commit failed'
+        except Exception as e:
+            error = str(e) or 'commit failed'
+            self.mtda.debug(1, f"main._storage_commit(): {error}")
+        self._storage_invalidate()
+
+        self._storage_committed = (job, error)
+        self._storage_committing = None
+        self.storage_locked()
+        self._storage_event(CONSTS.STORAGE.COMMITTED,
+                            f"{job} {error or 'OK'}")
+
+        self.mtda.debug(3, f"main._storage_commit(): {error}")
+
+    @Pyro4.expose
+    def storage_commit_status(self, job, **kwargs):
+        """
+        Get the outcome of a commit: None while changes are being merged,
+        True if they were committed and False otherwise
+        """
+        self.mtda.debug(3, f"main.storage_commit_status({job})")
+
+        session = kwargs.get("session", None)
+        self.session_ping(session)
+
+        result = None
+        committed = self._storage_committed
+        if self._storage_committing == job:
+            result = None
+        elif committed is not None and committed[0] == job:
+            result = committed[1] is None
+        else:
+            raise ValueError(f'unknown commit {job}')
+
+        self.mtda.debug(3, f"main.storage_commit_status(): {result}")
+        return result
+
+    @Pyro4.expose
+    def storage_dump(self, **kwargs):
+        """
+        Read the shared storage and stream its mapped data (compressed with
+        zstd) to the calling client (see ImageDumper). Returns the port of
+        the data socket to connect to. The storage is held by the session
+        until the transfer completes. Progress is reported with DUMPING
+        events and the outcome with a DUMPED event.
+        """
+        self.mtda.debug(3, "main.storage_dump()")
+
+        session = kwargs.get("session", None)
+        self.session_ping(session)
+        owner = self._storage_owner
+        status, _, _ = self.storage_status()
+
+        if self.storage is None:
+            raise RuntimeError('no shared storage device')
+        elif status != CONSTS.STORAGE.ON_HOST:
+            raise RuntimeError('shared storage not attached to host')
+        elif (owner is not None and owner != session) or \
+                self._storage_opened is True:
+            raise RuntimeError('shared storage in use')
+        elif self._storage_committing is not None:
+            raise RuntimeError('changes being committed')
+        path = self.storage.path()
+        if not path:
+            raise RuntimeError('path to shared storage not available')
+
+        from mtda.storage.dump import ImageDumper
+
+        def progress(read, total, speed):
+            self.session_ping(session)
+            self._storage_event(CONSTS.STORAGE.DUMPING,
+                                f'{read} {total} {speed}')
+
+        def done(error):
+            if error is not None:
+                self.mtda.debug(1, f"main.storage_dump(): {error}")
+                reason = str(error) or 'failed'
+            else:
+                reason = 'OK'
+            self._storage_dumper = None
+            self._storage_opened = False
+            self._storage_owner = None
+            self.storage_locked()
+            self._storage_event(CONSTS.STORAGE.DUMPED, reason)
+
+        dumper = ImageDumper(path, self.dataport, progress, done)
+        with self._storage_lock:
+            # a commit may have been started in the meantime
+            if self._storage_committing is not None:
+                raise RuntimeError('changes being committed')
+            result = dumper.prepare()
+            self._storage_dumper = dumper
+            self._storage_opened = True
+            self._storage_owner = session
+        self.storage_locked()
+        dumper.start()
+
+        self.mtda.debug(3, f"main.storage_dump(): {result}")
+        return result
+
+    @Pyro4.expose
+    def storage_fetch(self, url, bmap_url=None, **kwargs):
+        """
+        Download an image from a HTTP(S) server and write it to the shared
+        storage. A block map is searched next to the image unless its URL is
+        specified. Progress is reported with WRITING events: the client shall
+        then call storage_flush() and storage_close() as for other writes.
+        Returns the size of the image being downloaded (0 if unknown).
+        """
+        self.mtda.debug(3, f"main.storage_fetch({url})")
+
+        session = kwargs.get("session", None)
+        self.session_ping(session)
+        owner = self._storage_owner
+        status, _, _ = self.storage_status()
+
+        if self.storage is None:
+            raise RuntimeError('no shared storage device')
+        elif status != CONSTS.STORAGE.ON_HOST:
+            raise RuntimeError('shared storage not attached to host')
+        elif (owner is not None and owner != session) or \
+                self._storage_opened is True:
+            raise RuntimeError('shared storage in use')
+        elif self._storage_committing is not None:
+            raise RuntimeError('changes being committed')
+        elif not url.startswith(('http://', 'https://')):
+            raise ValueError(f'{url}: unsupported URL')
+
+        from mtda.storage.datastream import HTTPDataStream
+        from mtda.storage.fetch import HTTPSource
+        from mtda.utils import Compression
+
+        source = HTTPSource(url, self.http_concurrency, self.http_part_size)
+        result = source.size
+
+        # Automatically discover the bmap file
+        bmap = None
+        if bmap_url is not None:
+            bmap = self._storage_fetch_bmap(source, bmap_url)
+            if bmap is None:
+                raise RuntimeError(f'{bmap_url}: not found')
+        else:
+            path = url
+            candidates = []
+            while True:
+                path, ext = os.path.splitext(path)
+                if ext == "":
+                    break
+                candidates.append(path + '.bmap')
+            candidates.append(url + '.bmap')
+            for candidate in candidates:
+                # the image is written without bmap if none can be used
+                try:
+                    bmap = self._storage_fetch_bmap(source, candidate)
+                except Exception as e:
+                    self.mtda.debug(1, f"main.storage_fetch(): {e}")
+                if bmap is not None:
+                    break
+        self.storage.setBmap(bmap)
+
+        self._writer.compression = Compression.from_extension(url)
+        self._writer.sparse = False
+        self.storage_open(result, HTTPDataStream(source), session=session)
+
+        self.mtda.debug(3, f"main.storage_fetch(): {result}")
+        return result
+
+    def _storage_fetch_bmap(self, source, url):
+        """ Download and parse a bmap file, None if not found """
+        import xml.etree.ElementTree as ET
+        from mtda.storage.helpers.bmap import BlockMap
+
+        bmap = source.text(url)
+        if bmap is not None:
+            bmap = BlockMap.parse(ET.fromstring(bmap)).encode()
+        return bmap
+
+    @Pyro4.expose
+    def storage_received(self, sent, **kwargs):
+        """
+        Get the number of bytes received by the shared storage once the
+        client sent the specified number of bytes and whether frames were
+        lost: the transfer shall then be resumed with storage_resume()
+        """
+        self.mtda.debug(3, "main.storage_received()")
+
+        session = kwargs.get("session", None)
+        self.session_ping(session)
+        if self.storage is None:
+            raise RuntimeError('no shared storage device')
+        elif self._storage_opened is False or \
+                self._storage_owner != session:
+            raise RuntimeError('shared storage not opened')
+        result = self._writer.received(sent)
+
+        self.mtda.debug(3, f"main.storage_received(): {result}")
+        return result
+
+    @Pyro4.expose
+    def storage_resume(self, sent=0, **kwargs):
+        self.mtda.debug(3, "main.storage_resume()")
+
+        session = kwargs.get("session", None)
+        self.session_ping(session)
+        if self.storage is None:
+            raise RuntimeError('no shared storage device')
+        elif self._storage_opened is False or \
+                self._storage_owner != session:
+            raise RuntimeError('shared storage not opened')
+        result = self._writer.resume(sent)
+
+        self.mtda.debug(3, f"main.storage_resume(): {result}")
+        return result
+
     @Pyro4.expose
     def storage_rollback(self, **kwargs):
         self.mtda.debug(3, "main.storage_rollback()")
@@ -769,6 +1038,97 @@ class MultiTenantDeviceAccess:
         self.mtda.debug(3, f"main.storage_rollback(): {result}")
         return result
 
+    def _storage_snapshots(self, session, what):
+        """ Check that snapshots of the shared storage may be managed """
+        if not hasattr(self.storage, 'snapshot'):
+            raise NotImplementedError('snapshots are not supported for '
+                                      f'{self.storage.variant}')
+        if what is not None and self.storage_locked(session):
+            raise RuntimeError(f'cannot {what} snapshot, storage is locked!')
+
+    @Pyro4.expose
+    def storage_snapshot(self, name, **kwargs):
+        """ Take a named snapshot of the shared storage """
+        self.mtda.debug(3, f"main.storage_snapshot({name})")
+
+        session = kwargs.get("session", None)
+        self.session_ping(session)
+
+        result = False
+        if self.storage is not None:
+            self._storage_snapshots(session, 'take')
+            result = self.storage.snapshot(name)
+
+        self.mtda.debug(3, f"main.storage_snapshot(): {result}")
+        return result
+
+    @Pyro4.expose
+    def storage_snapshots(self, **kwargs):
+        """ Get names of snapshots of the shared storage """
+        self.mtda.debug(3, "main.storage_snapshots()")
+
+        session = kwargs.get("session", None)
+        self.session_ping(session)
+
+        result = []
+        if self.storage is not None:
+            self._storage_snapshots(session, None)
+            result = self.storage.snapshots()
+
+        self.mtda.debug(3, f"main.storage_snapshots(): {result}")
+        return result
+
+    @Pyro4.expose
+    def storage_snapshot_delete(self, name, **kwargs):
+        self.mtda.debug(3, f"main.storage_snapshot_delete({name})")
+
+        session = kwargs.get("session", None)
+        self.session_ping(session)
+
+        result = False
+        if self.storage is not None:
+            self._storage_snapshots(session, 'delete')
+            result = self.storage.delete_snapshot(name)
+
+        self.mtda.debug(3, f"main.storage_snapshot_delete(): {result}")
+        return result
+
+    @Pyro4.expose
+    def storage_revert(self, name, **kwargs):
+        """ Revert the shared storage to a named snapshot """
+        self.mtda.debug(3, f"main.storage_revert({name})")
+
+        session = kwargs.get("session", None)
+        self.session_ping(session)
+
+        result = False
+        if self.storage is not None:
+            self._storage_snapshots(session, 'revert to')
+            result = self.storage.revert(name)
+            self._storage_invalidate(cow=True)
+
+        self.mtda.debug(3, f"main.storage_revert(): {result}")
+        return result
+
+    @Pyro4.expose
+    def storage_checksums(self, size, **kwargs):
+        self.mtda.debug(3, f"main.storage_checksums({size})")
+
+        session = kwargs.get("session", None)
+        self.session_ping(session)
+        if self.storage is None:
+            raise RuntimeError('no shared storage device')
+        elif hasattr(self.storage, 'checksums') is False:
+            raise NotImplementedError('checksums are not supported for '
+                                      f'{self.storage.variant}')
+        elif self._storage_opened is False or \
+                self._storage_owner != session:
+            raise RuntimeError('shared storage not opened')
+        result = self.storage.checksums(size)
+
+        self.mtda.debug(3, f"main.storage_checksums(): {len(result)} bytes")
+        return result
+
     @Pyro4.expose
     def storage_flush(self, size, **kwargs):
         self.mtda.debug(3, f"main.storage_flush({size})")
@@ -797,6 +1157,10 @@ class MultiTenantDeviceAccess:
         elif self.storage is None:
             reason = "no shared storage device"
             result = True
+        # Changes shall not be merged underneath us
+        elif self._storage_committing is not None:
+            reason = "changes are being committed"
+            result = True
         # If hotplugging is supported, swap only if the shared storage
         # isn't opened
         elif self.storage.supports_hotplug() is True:
@@ -859,6 +1223,24 @@ class MultiTenantDeviceAccess:
         self.mtda.debug(3, f"main.storage_mount(): {result}")
         return result
 
+    @Pyro4.expose
+    def storage_sparse(self, enabled, **kwargs):
+        self.mtda.debug(3, "main.storage_sparse()")
+
+        session = kwargs.get("session", None)
+        self.session_ping(session)
+        if self.storage is None:
+            result = None
+        elif self._storage_opened is False or \
+                self._storage_owner != session:
+            raise RuntimeError('shared storage not opened')
+        else:
+            result = self._writer.sparse
+            self._writer.sparse = enabled
+
+        self.mtda.debug(3, f"main.storage_sparse(): {result}")
+        return result
+
     @Pyro4.expose
     def storage_update(self, dst, size, stream=None, **kwargs):
         self.mtda.debug(3, "main.storage_update()")
@@ -894,26 +1276,19 @@ class MultiTenantDeviceAccess:
             raise RuntimeError('no shared storage device')
         elif hasattr(self.storage, 'path') is False:
             raise RuntimeError('path to shared storage not available')
-        elif os.path.exists(NBD_CONF_DIR) is False:
-            raise RuntimeError('NBD configuration directory not found')
         elif self.storage_locked(session) is True:
             raise RuntimeError('shared storage in use')
         elif self.storage.to_host() is True:
             file = self.storage.path()
             if file:
-                conf = os.path.join(NBD_CONF_DIR, NBD_CONF_FILE)
-                with open(conf, 'w') as f:
-                    f.write('[mtda-storage]\n')
-                    f.write('authfile = /etc/nbd-server/allow\n')
-                    f.write(f'exportname = {file}\n')
-                    f.close()
-
-                cmd = ['systemctl', 'restart', 'nbd-server']
-                subprocess.check_call(cmd)
+                from mtda.storage.nbd import NBDServer, allow_list
 
-                cmd = ['systemctl', 'is-active', 'nbd-server']
-                subprocess.check_call(cmd)
+                self._storage_unshare()
+                server = NBDServer(self, file, allow=allow_list())
+                server.start()
+                self._storage_nbd = server
 
+                self._storage_invalidate()
                 self._storage_owner = session
                 self.storage_locked()
                 self._storage_event(CONSTS.STORAGE.ON_NETWORK)
@@ -924,6 +1299,31 @@ class MultiTenantDeviceAccess:
         self.mtda.debug(3, f"main.storage_network(): {result}")
         return result
 
+    @Pyro4.expose
+    def storage_network_stats(self, **kwargs):
+        """
+        Get counters of requests served to clients of the shared storage
+        over the network (None if the storage is not on the network)
+        """
+        self.mtda.debug(3, "main.storage_network_stats()")
+
+        session = kwargs.get("session", None)
+        self.session_ping(session)
+        result = None
+        server = self._storage_nbd
+        if server is not None:
+            result = server.stats()
+
+        self.mtda.debug(3, f"main.storage_network_stats(): {result}")
+        return result
+
+    def _storage_unshare(self):
+        """ Stop sharing the storage over the network """
+        server = self._storage_nbd
+        if server is not None:
+            self._storage_nbd = None
+            server.stop()
+
     @Pyro4.expose
     def storage_open(self, size=0, stream=None, **kwargs):
         self.mtda.debug(3, 'main.storage_open()')
@@ -931,35 +1331,110 @@ class MultiTenantDeviceAccess:
         result = None
         session = kwargs.get("session", None)
         self.session_ping(session)
-        owner = self._storage_owner
         status, _, _ = self.storage_status()
 
-        if self.storage is None:
-            raise RuntimeError('no shared storage device')
-        elif status != CONSTS.STORAGE.ON_HOST:
-            raise RuntimeError('shared storage not attached to host')
-        elif owner is not None and owner != session:
-            raise RuntimeError('shared storage in use')
-        elif self._storage_opened is False:
-            try:
-                self.storage.open()
-                self._storage_opened = True
-                self._storage_owner = session
-                self.storage_locked()
-                self._storage_event(CONSTS.STORAGE.OPENED, session)
-            except Exception:
-                raise RuntimeError('shared storage could not be opened!')
+        # changes shall not be committed while the storage gets opened
+        with self._storage_lock:
+            owner = self._storage_owner
+            if self.storage is None:
+                raise RuntimeError('no shared storage device')
+            elif status != CONSTS.STORAGE.ON_HOST:
+                raise RuntimeError('shared storage not attached to host')
+            elif owner is not None and owner != session:
+                raise RuntimeError('shared storage in use')
+            elif self._storage_committing is not None:
+                raise RuntimeError('changes being committed')
+            elif self._storage_opened is False:
+                try:
+                    self.storage.open()
+                    self._storage_opened = True
+                    self._storage_owner = session
+                except Exception:
+                    raise RuntimeError('shared storage could not be opened!')
+                opened = True
+            else:
+                opened = False
+
+        if opened is True:
+            self.storage_locked()
+            self._storage_event(CONSTS.STORAGE.OPENED, session)
             result = self._storage_socket(session, size, stream)
+            self._storage_record(session, size)
 
         self.mtda.debug(3, f'main.storage_open(): {result}')
         return result
 
+    def _storage_record(self, session, size):
+        # Record the image into the cache if the client asked for it
+        cached = self._storage_cached
+        self._storage_cached = None
+        if cached is not None and cached[0] == session:
+            try:
+                recorder = self._storage_cache.record(cached[1], size)
+                self._writer.record(recorder)
+            except OSError as e:
+                self.mtda.debug(1, f"main._storage_record(): {e}")
+
+    def _storage_invalidate(self, cow=False):
+        if hasattr(self.storage, 'invalidate'):
+            self.storage.invalidate(cow)
+
     def _storage_socket(self, session, size, stream=None):
         if stream is None:
             from mtda.storage.datastream import NetworkDataStream
             stream = NetworkDataStream(self.dataport)
         return self._writer.start(session, size, stream)
 
+    @Pyro4.expose
+    def storage_write_cached(self, digest=None, **kwargs):
+        """
+        Write an image from the cache of the agent. Returns None if images
+        are not cached, False if the image with the specified SHA-256 digest
+        is not cached (it will then be added to the cache when received with
+        the next storage_open() call from this session) or the size of the
+        data being replayed from the cache.
+        """
+        self.mtda.debug(3, 'main.storage_write_cached()')
+
+        result = None
+        session = kwargs.get("session", None)
+        self.session_ping(session)
+        owner = self._storage_owner
+        status, _, _ = self.storage_status()
+
+        if self.storage is None:
+            raise RuntimeError('no shared storage device')
+        elif self._storage_cache is None:
+            result = None
+        elif digest is None:
+            result = False
+        elif status != CONSTS.STORAGE.ON_HOST:
+            raise RuntimeError('shared storage not attached to host')
+        elif (owner is not None and owner != session) or \
+                self._storage_opened is True:
+            raise RuntimeError('shared storage in use')
+        elif self._storage_committing is not None:
+            raise RuntimeError('changes being committed')
+        else:
+            entry = self._storage_cache.lookup(digest)
+            if entry is None:
+                self._storage_cached = (session, digest)
+                result = False
+            else:
+                from mtda.storage.datastream import CachedDataStream
+                bmap = entry['bmap']
+                if isinstance(bmap, str):
+                    bmap = base64.b64decode(bmap)
+                self.storage.setBmap(bmap)
+                self._writer.compression = entry['compression']
+                self._writer.sparse = entry['sparse']
+                stream = CachedDataStream(entry['path'])
+                self.storage_open(entry['size'], stream, session=session)
+                result = entry['size']
+
+        self.mtda.debug(3, f'main.storage_write_cached(): {result}')
+        return result
+
     @Pyro4.expose
     def storage_status(self, **kwargs):
         self.mtda.debug(3, "main.storage_status()")
@@ -1025,6 +1500,7 @@ class MultiTenantDeviceAccess:
             self.storage_close()
             result = self.storage.to_target()
             if result is True:
+                self._storage_invalidate(cow=True)
                 self._storage_event(CONSTS.STORAGE.ON_TARGET)
         else:
             self.error('cannot switch storage to target: locked')
@@ -1042,7 +1518,9 @@ class MultiTenantDeviceAccess:
         if self.storage_locked(session) is False:
             result, writing, written = self.storage_status(session=session)
             if result in [CONSTS.STORAGE.ON_HOST, CONSTS.STORAGE.ON_NETWORK]:
+                self._storage_unshare()
                 if self.storage.to_target() is True:
+                    self._storage_invalidate(cow=True)
                     self._storage_event(CONSTS.STORAGE.ON_TARGET)
             elif result == CONSTS.STORAGE.ON_TARGET:
                 if self.storage.to_host() is True:
@@ -1051,6 +1529,49 @@ class MultiTenantDeviceAccess:
         self.mtda.debug(3, f"main.storage_swap(): {str(result)}")
         return result
 
+    @Pyro4.expose
+    def storage_verify(self, checksums=None, size=0, **kwargs):
+        """
+        Read the written image back from the shared storage and compare it
+        with its block map or with the specified checksums (hashes of blocks
+        of the first size bytes of the image, see BlockHashIndex). Progress
+        is reported with VERIFYING events and the outcome with a VERIFIED
+        event.
+        """
+        self.mtda.debug(3, "main.storage_verify()")
+
+        session = kwargs.get("session", None)
+        self.session_ping(session)
+        if self.storage is None:
+            raise RuntimeError('no shared storage device')
+        elif hasattr(self.storage, 'verify') is False:
+            raise NotImplementedError('verification is not supported for '
+                                      f'{self.storage.variant}')
+        elif self._storage_opened is False or \
+                self._storage_owner != session:
+            raise RuntimeError('shared storage not opened')
+        elif self._writer.writing is True:
+            raise RuntimeError('shared storage being written')
+
+        def progress(verified, total, speed):
+            self.session_ping(session)
+            self._storage_event(CONSTS.STORAGE.VERIFYING,
+                                f'{verified} {total} {speed}')
+
+        mismatches = self.storage.verify(checksums, size, progress)
+        for start, end in mismatches:
+            self.mtda.debug(1, "main.storage_verify(): "
+                               f"bytes {start}-{end} differ")
+        if mismatches:
+            reason = f'{len(mismatches)} ranges differ'
+        else:
+            reason = 'OK'
+        self._storage_event(CONSTS.STORAGE.VERIFIED, reason)
+        result = len(mismatches) == 0
+
+        self.mtda.debug(3, f"main.storage_verify(): {result}")
+        return result
+
     def storage_write(self, data, **kwargs):
         self.mtda.debug(3, "main.storage_write()")
 
@@ -1579,6 +2100,10 @@ class MultiTenantDeviceAccess:
             self.load_pastebin_config(parser)
         if parser.has_section('remote'):
             self.load_remote_config(parser)
+        if parser.has_section('http'):
+            self.load_http_config(parser)
+        if parser.has_section('s3'):
+            self.load_s3_config(parser)
         self.load_timeouts_config(parser)
         if parser.has_section('ui'):
             self.load_ui_config(parser)
@@ -1680,6 +2205,31 @@ class MultiTenantDeviceAccess:
 
         from mtda.storage.writer import AsyncImageWriter
         self._writer = AsyncImageWriter(self, storage)
+        decompressor = parser.get('storage', 'decompressor',
+                                  fallback='internal')
+        if decompressor not in ['internal', 'external']:
+            raise ValueError(f'unknown decompressor: {decompressor}')
+        self._writer.external = decompressor == 'external'
+        if parser.getboolean('storage', 'direct', fallback=False):
+            if hasattr(storage, 'direct'):
+                storage.direct = True
+            else:
+                self.mtda.debug(1, "main.post_configure_storage(): "
+                                   "direct I/O not supported by this storage")
+        if parser.has_option('storage', 'sync-interval'):
+            from mtda.utils import Size
+            self._writer.sync_interval = Size.to_bytes(
+                parser.get('storage', 'sync-interval'), 'MiB')
+
+        cache = parser.get('storage', 'cache', fallback=None)
+        if cache:
+            from mtda.storage.cache import ImageCache
+            from mtda.utils import Size
+            size = CONSTS.DEFAULTS.IMAGE_CACHE_SIZE
+            if parser.has_option('storage', 'cache-size'):
+                size = Size.to_bytes(parser.get('storage', 'cache-size'),
+                                     'GiB')
+            self._storage_cache = ImageCache(cache, size)
 
         import atexit
         atexit.register(self.storage_close)
@@ -1711,6 +2261,32 @@ class MultiTenantDeviceAccess:
             self.remote = None
         self.is_remote = self.remote is not None
 
+    def load_http_config(self, parser):
+        self.mtda.debug(3, "main.load_http_config()")
+
+        from mtda.utils import Size
+        self.http_concurrency = int(
+            parser.get('http', 'concurrency', fallback=self.http_concurrency))
+        if self.http_concurrency < 1:
+            raise ValueError('http concurrency shall be at least 1')
+        if parser.has_option('http', 'part-size'):
+            self.http_part_size = Size.to_bytes(
+                parser.get('http', 'part-size'), 'MiB')
+
+    def load_s3_config(self, parser):
+        self.mtda.debug(3, "main.load_s3_config()")
+
+        from mtda.utils import Size
+        self.s3_concurrency = int(
+            parser.get('s3', 'concurrency', fallback=self.s3_concurrency))
+        if self.s3_concurrency < 1:
+            raise ValueError('s3 concurrency shall be at least 1')
+        self.s3_endpoint = parser.get('s3', 'endpoint',
+                                      fallback=self.s3_endpoint)
+        if parser.has_option('s3', 'part-size'):
+            self.s3_part_size = Size.to_bytes(
+                parser.get('s3', 'part-size'), 'MiB')
+
     def load_timeouts_config(self, parser):
         self.mtda.debug(3, "main.load_timeouts_config()")
 
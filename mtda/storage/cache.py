@@ -0,0 +1,203 @@
+# ---------------------------------------------------------------------------
+# Cache of images written to the shared storage
+# ---------------------------------------------------------------------------
+#
+# This software is a part of MTDA.
+# Copyright (C) 2025 Siemens AG
+#
+# ---------------------------------------------------------------------------
+# SPDX-License-Identifier: MIT
+# ---------------------------------------------------------------------------
+
+# System imports
+import hashlib
+import json
+import os
+import re
+import struct
+import threading
+
+# Local imports
+from mtda.storage.datastream import Frame
+
+
+class ImageCache:
+    """
+    Least-recently-used cache of images received by the agent, keyed by the
+    SHA-256 digest of the image. Entries hold data as it was received from
+    the client (i.e. still compressed) so that it may be replayed into the
+    image writer.
+    """
+
+    DIGEST = re.compile(r'[0-9a-f]{64}')
+    LENGTH = struct.Struct('!I')
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.lock = threading.Lock()
+        os.makedirs(path, mode=0o755, exist_ok=True)
+        # remove incomplete entries
+        for name in os.listdir(path):
+            if name.endswith('.tmp'):
+                os.unlink(os.path.join(path, name))
+
+    def _entry(self, digest):
+        if digest is None or self.DIGEST.fullmatch(digest) is None:
+            raise ValueError(f'invalid image digest: {digest}')
+        return os.path.join(self.path, digest)
+
+    def lookup(self, digest):
+        """ Get metadata of a cached image, None if not cached """
+        entry = self._entry(digest)
+        with self.lock:
+            try:
+                with open(f'{entry}.json', 'r') as f:
+                    result = json.load(f)
+                # keep track of recently used entries
+                os.utime(f'{entry}.data')
+            except (FileNotFoundError, ValueError):
+                return None
+        result['path'] = f'{entry}.data'
+        return result
+
+    def record(self, digest, size=0):
+        """ Get a recorder for data of an image of size bytes to be cached """
+        return ImageRecorder(self, self._entry(digest), digest, size)
+
+    def _commit(self, entry, metadata):
+        with self.lock:
+            with open(f'{entry}.json.tmp', 'w') as f:
+                json.dump(metadata, f)
+            os.replace(f'{entry}.data.tmp', f'{entry}.data')
+            os.replace(f'{entry}.json.tmp', f'{entry}.json')
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if name.endswith('.data'):
+                st = os.stat(os.path.join(self.path, name))
+                entries.append((st.st_mtime, st.st_size, name[:-5]))
+                total += st.st_size
+        entries.sort()
+        while total > self.size and entries:
+            _, size, digest = entries.pop(0)
+            for ext in ['.json', '.data']:
+                try:
+                    os.unlink(os.path.join(self.path, digest + ext))
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+
+class ImageRecorder:
+    """
+    Record data received for an image into the cache. The image is only
+    cached if its SHA-256 digest matches the one it is cached under: the
+    digest of received data when the image is received as is or the digest
+    of the image data (see update()) when it is received as frames. Frames
+    are recorded by offset (see write_frame()) so that frames received more
+    than once (e.g. when a transfer was resumed) are only recorded once.
+    """
+
+    ZEROES = bytes(1024**2)
+
+    def __init__(self, cache, entry, digest, size=0):
+        self._cache = cache
+        self._digest = digest
+        self._entry = entry
+        self._end = 0
+        self._file = open(f'{entry}.data.tmp', 'wb')
+        self._frames = 0
+        self._image = None
+        self._image_size = size
+        self._offset = 0
+        self._received = 0
+        self._size = 0
+        self._stream = hashlib.sha256()
+
+    def write(self, data):
+        if self._file is None:
+            return
+        self._stream.update(data)
+        self._record(data)
+
+    def write_frame(self, offset, size, payload):
+        """
+        Record a frame holding size bytes of the image at the specified
+        offset, unless that range was already recorded. Recorded frames
+        are numbered in sequence to be replayed as a single transfer.
+        """
+        if self._file is None or offset < self._end:
+            return
+        self._end = offset + size
+        self._record(Frame.encode(self._frames, offset, size, payload))
+        self._frames += 1
+
+    def _record(self, data):
+        self._received += len(data)
+        self._size += ImageCache.LENGTH.size + len(data)
+        if self._size > self._cache.size:
+            # too large to be cached
+            self.discard()
+            return
+        try:
+            self._file.write(ImageCache.LENGTH.pack(len(data)))
+            self._file.write(data)
+        except OSError:
+            # e.g. no space left: the image is just not cached
+            self.discard()
+
+    def update(self, offset, data):
+        """
+        Hash image data decoded from received frames, which shall be fed
+        in order (skipped ranges are hashed as zeroes and data that was
+        already hashed is skipped)
+        """
+        if self._file is None:
+            return
+        if self._image is None:
+            self._image = hashlib.sha256()
+        if offset < self._offset:
+            # e.g. frames written again after a transfer was resumed
+            data = data[self._offset - offset:]
+            offset = self._offset
+        self._zeroes(offset)
+        self._image.update(data)
+        self._offset += len(data)
+
+    def _zeroes(self, offset):
+        while self._offset < offset:
+            size = min(offset - self._offset, len(self.ZEROES))
+            self._image.update(self.ZEROES[:size])
+            self._offset += size
+
+    def commit(self, **metadata):
+        """ Add the recorded image to the cache if its digest matches """
+        if self._file is None:
+            return False
+        if self._image is not None:
+            self._zeroes(self._image_size)
+            digest = self._image.hexdigest()
+        else:
+            digest = self._stream.hexdigest()
+        if digest != self._digest:
+            self.discard()
+            raise ValueError(f'image digest {digest} does not match '
+                             f'{self._digest}, image not cached')
+        self._file.close()
+        self._file = None
+        metadata['size'] = self._received
+        self._cache._commit(self._entry, metadata)
+        return True
+
+    def discard(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            try:
+                os.unlink(f'{self._entry}.data.tmp')
+            except FileNotFoundError:
+                pass
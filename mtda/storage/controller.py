@@ -47,8 +47,13 @@ class StorageController(object):
         return False
 
     @abc.abstractmethod
-    def setBmap(self, bmapDict):
-        """ set up the bmapDict for writing the image faster"""
+    def pwrite(self, data, offset):
+        """ Write data at the specified offset of the shared storage device"""
+        return False
+
+    @abc.abstractmethod
+    def setBmap(self, bmap):
+        """ set up the block map for writing the image faster"""
         return False
 
     @abc.abstractmethod
@@ -56,6 +61,10 @@ class StorageController(object):
         """ Whether the shared storage device may be hot-plugged"""
         return False
 
+    def sync(self, incremental=False):
+        """ Make data written to the storage device durable"""
+        return True
+
     @abc.abstractmethod
     def to_host(self):
         """ Attach the shared storage device to the host"""
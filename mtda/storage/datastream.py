@@ -10,12 +10,32 @@
 # ---------------------------------------------------------------------------
 
 import abc
+import struct
 import zmq
 
 import mtda.constants as CONSTS
 from mtda.exceptions import RetryException
 
 
+class Frame:
+    """
+    Data frame used to transfer ranges of images: a header with a sequence
+    number (to detect lost frames), the offset and (uncompressed) size of the
+    data is followed by the payload
+    """
+    HEADER = struct.Struct('!IQI')
+
+    @staticmethod
+    def encode(sequence, offset, size, payload):
+        return Frame.HEADER.pack(sequence, offset, size) + payload
+
+    @staticmethod
+    def decode(message):
+        sequence, offset, size = Frame.HEADER.unpack_from(message)
+        payload = memoryview(message)[Frame.HEADER.size:]
+        return sequence, offset, size, payload
+
+
 class DataStream(object):
     __metaclass__ = abc.ABCMeta
 
@@ -36,6 +56,63 @@ class DataStream(object):
         """ Get queued data from the backend"""
 
 
+class CachedDataStream(DataStream):
+    """ Replay data of an image from the cache """
+
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+
+    def prepare(self):
+        self._file = open(self._path, 'rb')
+        return None
+
+    def close(self):
+        self._file.close()
+        self._file = None
+
+    def push(self, data, callback=None):
+        raise RuntimeError('data is read from the cache')
+
+    def pop(self):
+        from mtda.storage.cache import ImageCache
+
+        header = self._file.read(ImageCache.LENGTH.size)
+        if len(header) == 0:
+            # an empty chunk marks the end of the transfer
+            return b''
+        size, = ImageCache.LENGTH.unpack(header)
+        chunk = self._file.read(size)
+        if len(chunk) != size:
+            raise IOError(f'{self._path}: truncated cache entry!')
+        return chunk
+
+
+class HTTPDataStream(DataStream):
+    """ Download an image from a HTTP(S) server (see HTTPSource) """
+
+    def __init__(self, source, blksz=CONSTS.WRITER.WRITE_SIZE):
+        self._blksz = blksz
+        self._chunks = None
+        self._source = source
+
+    def prepare(self):
+        self._chunks = self._source.stream(self._blksz)
+        return None
+
+    def close(self):
+        if self._chunks is not None:
+            self._chunks.close()
+            self._chunks = None
+
+    def push(self, data, callback=None):
+        raise RuntimeError(f'data is downloaded from {self._source.url}')
+
+    def pop(self):
+        # an empty chunk marks the end of the transfer
+        return next(self._chunks, b'')
+
+
 class NetworkDataStream(DataStream):
 
     def __init__(self, dataport):
@@ -55,6 +55,9 @@ class DockerController(StorageController):
         self.mtda.debug(3, f"storage.docker.open(): {result}")
         return result
 
+    def pwrite(self, data, offset):
+        raise RuntimeError('random writes not supported for docker')
+
     def probe(self):
         self.mtda.debug(3, "storage.docker.probe()")
         self._lock.acquire()
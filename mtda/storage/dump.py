@@ -0,0 +1,220 @@
+# ---------------------------------------------------------------------------
+# Dump the shared storage to clients
+# ---------------------------------------------------------------------------
+#
+# This software is a part of MTDA.
+# Copyright (C) 2025 Siemens AG
+#
+# ---------------------------------------------------------------------------
+# SPDX-License-Identifier: MIT
+# ---------------------------------------------------------------------------
+
+# System imports
+import collections
+import concurrent.futures
+import errno
+import hashlib
+import os
+import threading
+import time
+import zmq
+import zstandard as zstd
+
+# Local imports
+import mtda.constants as CONSTS
+from mtda.storage.datastream import Frame
+from mtda.storage.helpers.bmap import BlockMap
+
+
+class ImageDumper:
+    """
+    Read the shared storage and stream its mapped data to a client. Holes
+    of sparse files are not read and blocks of zeroes are not sent. Other
+    data is sent in frames (see Frame) holding zstd frames compressed in
+    parallel on a pool of threads: the client may concatenate them (along
+    with frames of zeroes for data that was not sent) to get a valid zstd
+    image.
+
+    Frames without data mark the end of the transfer when they have a
+    payload: either the block map of the image (see BlockMap.encode()) or an
+    error message. Frames without data nor payload are sent periodically to
+    report that everything before their offset was sent.
+    """
+
+    ZERO_BLOCK = bytes(CONSTS.WRITER.ZERO_BLOCK_SIZE)
+
+    def __init__(self, path, dataport=0, progress=None, done=None,
+                 chunksz=CONSTS.WRITER.DUMP_SIZE,
+                 level=CONSTS.WRITER.DUMP_LEVEL):
+        self._chunksz = chunksz
+        self._dataport = dataport
+        self._done = done
+        self._level = level
+        self._local = threading.local()
+        self._path = path
+        self._progress = progress
+        self._sequence = 0
+        self._socket = None
+        self._stopping = threading.Event()
+        self._thread = None
+        self._workers = os.cpu_count() or 1
+        self.mapped = 0
+
+    def prepare(self):
+        """ Bind the data socket and get its port """
+        context = zmq.Context()
+        timeout = CONSTS.WRITER.DUMP_TIMEOUT * 1000
+
+        self._socket = context.socket(zmq.PUSH)
+        self._socket.setsockopt(zmq.SNDTIMEO, timeout)
+        self._socket.setsockopt(zmq.LINGER, timeout)
+        hwm = int(CONSTS.WRITER.HIGH_WATER_MARK / self._chunksz)
+        self._socket.setsockopt(zmq.SNDHWM, max(hwm, 1))
+
+        self._socket.bind(f"tcp://*:{self._dataport}")
+        endpoint = self._socket.getsockopt_string(zmq.LAST_ENDPOINT)
+        return int(endpoint.split(":")[-1])
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='storage.dump')
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None and \
+           self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    @staticmethod
+    def _extents(fd, size):
+        """ Get (start, end) of extents that may hold data """
+        pos = 0
+        while pos < size:
+            try:
+                start = os.lseek(fd, pos, os.SEEK_DATA)
+                end = os.lseek(fd, start, os.SEEK_HOLE)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # no data past pos
+                    return
+                # holes are not supported
+                yield pos, size
+                return
+            yield start, min(end, size)
+            pos = end
+
+    def _runs(self, data):
+        """ Get (start, end) of runs of blocks that are not zeroes """
+        blksz = len(self.ZERO_BLOCK)
+        start = None
+        for i in range(0, len(data), blksz):
+            if data.startswith(self.ZERO_BLOCK[:len(data) - i], i):
+                if start is not None:
+                    yield start, i
+                    start = None
+            elif start is None:
+                start = i
+        if start is not None:
+            yield start, len(data)
+
+    def _compress(self, data):
+        cctx = getattr(self._local, 'cctx', None)
+        if cctx is None:
+            cctx = self._local.cctx = zstd.ZstdCompressor(level=self._level)
+        return cctx.compress(data)
+
+    def _send(self, offset, size, payload):
+        try:
+            self._socket.send(Frame.encode(self._sequence, offset, size,
+                                           payload))
+        except zmq.Again:
+            raise IOError('client is not receiving the dump')
+        self._sequence += 1
+
+    def _dump(self, fd, size):
+        blksz = CONSTS.WRITER.DUMP_BLOCK_SIZE
+        bmap = BlockMap(blksz, size, 'sha256')
+        # current range as [start, end) and its hasher
+        start = end = 0
+        hasher = None
+        # frames to be sent (in order) as (offset, size, future)
+        inflight = collections.deque()
+        notified = time.monotonic()
+        last = 0
+
+        with concurrent.futures.ThreadPoolExecutor(
+                self._workers, thread_name_prefix='dump') as pool:
+            for first, final in self._extents(fd, size):
+                pos = first - first % blksz
+                while pos < final:
+                    if self._stopping.is_set():
+                        raise IOError('dump aborted')
+                    data = os.pread(fd, min(self._chunksz, final - pos), pos)
+                    if len(data) == 0:
+                        raise IOError(f'{self._path}: unexpected end of data')
+                    for rstart, rend in self._runs(data):
+                        piece = data[rstart:rend]
+                        if hasher is None or pos + rstart != end:
+                            if hasher is not None:
+                                bmap.append(start // blksz, (end - 1) // blksz,
+                                            hasher.hexdigest())
+                            start = pos + rstart
+                            hasher = hashlib.sha256()
+                        hasher.update(piece)
+                        end = pos + rend
+                        self.mapped += len(piece)
+                        inflight.append((pos + rstart, len(piece),
+                                         pool.submit(self._compress, piece)))
+                    pos += len(data)
+
+                    now = time.monotonic()
+                    if now - notified >= CONSTS.WRITER.NOTIFY_SECONDS:
+                        # let the client know we are still making progress
+                        inflight.append((pos, 0, None))
+                        if self._progress is not None:
+                            self._progress(pos, size,
+                                           (pos - last) / (now - notified))
+                        notified = now
+                        last = pos
+                    while len(inflight) > self._workers * 2:
+                        self._sendq(inflight)
+            while inflight:
+                self._sendq(inflight)
+
+        if hasher is not None:
+            bmap.append(start // blksz, (end - 1) // blksz, hasher.hexdigest())
+        if self._progress is not None:
+            elapsed = time.monotonic() - notified
+            self._progress(size, size,
+                           (size - last) / elapsed if elapsed else 0)
+        return bmap
+
+    def _sendq(self, inflight):
+        offset, size, future = inflight.popleft()
+        payload = future.result() if future is not None else b''
+        self._send(offset, size, payload)
+
+    def _run(self):
+        error = None
+        fd = None
+        try:
+            fd = os.open(self._path, os.O_RDONLY)
+            size = os.lseek(fd, 0, os.SEEK_END)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            bmap = self._dump(fd, size)
+            self._send(size, 0, bmap.encode())
+        except Exception as e:
+            error = e
+            try:
+                self._send(0, 0, str(e).encode() or b'dump failed')
+            except Exception:
+                pass
+        finally:
+            if fd is not None:
+                os.close(fd)
+            self._socket.close()
+            self._socket = None
+        if self._done is not None:
+            self._done(error)
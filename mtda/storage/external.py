@@ -0,0 +1,105 @@
+# ---------------------------------------------------------------------------
+# Decompress images with external tools
+# ---------------------------------------------------------------------------
+#
+# This software is a part of MTDA.
+# Copyright (C) 2025 Siemens AG
+#
+# ---------------------------------------------------------------------------
+# SPDX-License-Identifier: MIT
+# ---------------------------------------------------------------------------
+
+# System imports
+import shutil
+import subprocess
+import threading
+
+# Local imports
+import mtda.constants as CONSTS
+
+
+class ExternalDecompressor:
+    """
+    Pipe compressed data through a (multi-threaded) decompression tool and
+    hand its output to the specified callback from a thread of its own.
+    Pipes provide back-pressure: the tool is blocked while its output is
+    not consumed.
+    """
+
+    # tools to be used for each compression (in order of preference)
+    TOOLS = {
+        CONSTS.IMAGE.BZ2: [['lbzip2', '-dc'], ['pbzip2', '-dc']],
+        CONSTS.IMAGE.GZ: [['pigz', '-dc']],
+        CONSTS.IMAGE.XZ: [['xz', '-dc', '-T0']],
+        CONSTS.IMAGE.ZST: [['zstd', '-dc', '-T0']]
+    }
+
+    def __init__(self, cmd, output, blksz=CONSTS.WRITER.WRITE_SIZE):
+        self._blksz = blksz
+        self._cmd = cmd
+        self._error = None
+        self._output = output
+        self._process = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE)
+        self._thread = threading.Thread(target=self._reader, daemon=True,
+                                        name='writer.external')
+        self._thread.start()
+
+    @staticmethod
+    def find(compression):
+        """ Get a command to decompress data, None if no tool was found """
+        for cmd in ExternalDecompressor.TOOLS.get(compression, []):
+            if shutil.which(cmd[0]) is not None:
+                return cmd
+        return None
+
+    def _reader(self):
+        try:
+            stdout = self._process.stdout
+            while (data := stdout.read1(self._blksz)):
+                self._output(data)
+        except Exception as e:
+            self._error = e
+            self._process.kill()
+
+    def _failed(self):
+        stderr = self._process.stderr.read().decode(errors='replace')
+        stderr = stderr.strip() or f'exit code {self._process.returncode}'
+        return RuntimeError(f'{self._cmd[0]} failed: {stderr}')
+
+    def write(self, data):
+        if self._error is not None:
+            raise self._error
+        try:
+            self._process.stdin.write(data)
+        except BrokenPipeError:
+            self._thread.join()
+            self._process.wait()
+            raise self._failed()
+        return len(data)
+
+    def finish(self):
+        """ Wait for the tool to output all data and check its status """
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        if self._process.wait() != 0:
+            raise self._failed()
+
+    def close(self):
+        """ Terminate the tool (if still running) """
+        if self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
+        self._thread.join()
+        for pipe in [self._process.stdin, self._process.stdout,
+                     self._process.stderr]:
+            try:
+                pipe.close()
+            except BrokenPipeError:
+                pass
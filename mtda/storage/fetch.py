@@ -0,0 +1,136 @@
+# ---------------------------------------------------------------------------
+# Fetch images from remote sources
+# ---------------------------------------------------------------------------
+#
+# This software is a part of MTDA.
+# Copyright (C) 2025 Siemens AG
+#
+# ---------------------------------------------------------------------------
+# SPDX-License-Identifier: MIT
+# ---------------------------------------------------------------------------
+
+# System imports
+import collections
+import concurrent.futures
+import threading
+
+# Local imports
+import mtda.constants as CONSTS
+
+
+class RangeFetcher:
+    """
+    Read parts of an image with concurrent (e.g. ranged HTTP) reads and get
+    them in order: parts being read or waiting to be consumed are bounded
+    by the concurrency (reorder buffer).
+    """
+
+    def __init__(self, read, parts, concurrency):
+        self._concurrency = concurrency
+        self._parts = parts
+        self._read = read
+
+    @staticmethod
+    def split(ranges, partsz):
+        """ Split ranges (start, end) into parts (offset, size) """
+        for start, end in ranges:
+            for offset in range(start, end, partsz):
+                yield offset, min(partsz, end - offset)
+
+    def __iter__(self):
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(self._concurrency) as pool:
+            try:
+                for offset, size in self._parts:
+                    pending.append((offset, size,
+                                    pool.submit(self._read, offset, size)))
+                    if len(pending) >= self._concurrency:
+                        yield self._result(*pending.popleft())
+                while pending:
+                    yield self._result(*pending.popleft())
+            finally:
+                for _, _, future in pending:
+                    future.cancel()
+
+    @staticmethod
+    def _result(offset, size, future):
+        data = future.result()
+        if len(data) != size:
+            raise IOError(f'short read at offset {offset}!')
+        return offset, data
+
+
+class HTTPSource:
+    """
+    An image on a HTTP(S) server: read with concurrent range requests if
+    the server supports them, with a single request otherwise. Each thread
+    keeps its connection to the server alive.
+    """
+
+    def __init__(self, url, concurrency=CONSTS.DEFAULTS.HTTP_CONCURRENCY,
+                 partsz=CONSTS.DEFAULTS.HTTP_PART_SIZE):
+        self.concurrency = concurrency
+        self.partsz = partsz
+        self.url = url
+        self._headers = None
+        self._local = threading.local()
+
+    def _http(self):
+        """ Get the HTTP session of this thread """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            import requests
+            session = self._local.session = requests.Session()
+        return session
+
+    def _head(self):
+        if self._headers is None:
+            response = self._http().head(self.url, allow_redirects=True,
+                                         timeout=CONSTS.DEFAULTS.HTTP_TIMEOUT)
+            response.raise_for_status()
+            self._headers = response.headers
+        return self._headers
+
+    @property
+    def ranged(self):
+        """ Whether ranges of the image may be read """
+        headers = self._head()
+        return headers.get('Accept-Ranges', '').lower() == 'bytes' and \
+            'Content-Length' in headers
+
+    @property
+    def size(self):
+        """ Size of the image, 0 if unknown """
+        return int(self._head().get('Content-Length', 0))
+
+    def text(self, url):
+        """ Get a (e.g. bmap) file from the server, None if not found """
+        response = self._http().get(url, timeout=CONSTS.DEFAULTS.HTTP_TIMEOUT)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.text
+
+    def read(self, offset, size):
+        # do not download the whole image if the range is not honored
+        with self._http().get(
+                self.url, stream=True, timeout=CONSTS.DEFAULTS.HTTP_TIMEOUT,
+                headers={'Range': f'bytes={offset}-{offset + size - 1}'}) \
+                as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise IOError(f'{self.url}: range request not honored!')
+            return response.content
+
+    def stream(self, blksz):
+        """ Get data of the image in order (in blocks of up to blksz) """
+        if self.ranged is True:
+            parts = RangeFetcher.split([(0, self.size)], self.partsz)
+            for _, data in RangeFetcher(self.read, parts, self.concurrency):
+                for offset in range(0, len(data), blksz):
+                    yield data[offset:offset + blksz]
+            return
+        with self._http().get(self.url, stream=True,
+                              timeout=CONSTS.DEFAULTS.HTTP_TIMEOUT) as response:
+            response.raise_for_status()
+            yield from response.iter_content(blksz)
@@ -0,0 +1,186 @@
+# ---------------------------------------------------------------------------
+# Compact block maps
+# ---------------------------------------------------------------------------
+#
+# This software is a part of MTDA.
+# Copyright (C) 2025 Siemens AG
+#
+# ---------------------------------------------------------------------------
+# SPDX-License-Identifier: MIT
+# ---------------------------------------------------------------------------
+
+# System imports
+import array
+import bisect
+import hashlib
+import struct
+import sys
+
+
+class BlockMap:
+    """
+    Mapped ranges of an image (as described by a bmap file) held in arrays
+    of first and last blocks (inclusive) along with packed binary digests of
+    each range. Block maps are exchanged as a single blob of bytes (see
+    encode() and decode()).
+    """
+
+    MAGIC = b'BMAP'
+    HEADER = struct.Struct('<4sIQQQ16s')
+
+    def __init__(self, block_size, image_size, checksum_type=None):
+        self.block_size = block_size
+        self.image_size = image_size
+        self.checksum_type = checksum_type
+        self.first = array.array('Q')
+        self.last = array.array('Q')
+        self.digests = bytearray()
+        self.digest_size = 0
+        if checksum_type is not None:
+            try:
+                self.digest_size = hashlib.new(checksum_type).digest_size
+            except ValueError:
+                self.checksum_type = None
+
+    def __len__(self):
+        return len(self.first)
+
+    def append(self, first, last, chksum=None):
+        """ Add a range of blocks with its hex checksum """
+        if len(self.last) > 0 and first <= self.last[-1]:
+            raise ValueError('bmap ranges are not sorted!')
+        self.first.append(first)
+        self.last.append(last)
+        if self.digest_size > 0:
+            digest = bytes.fromhex(chksum or '')
+            if len(digest) != self.digest_size:
+                raise ValueError(f'invalid checksum for range {first}-{last}')
+            self.digests += digest
+
+    @classmethod
+    def parse(cls, xml):
+        """ Get a block map from the root element of a bmap file """
+        result = cls(int(xml.find("BlockSize").text.strip()),
+                     int(xml.find("ImageSize").text.strip()),
+                     xml.find("ChecksumType").text.strip())
+        for child in xml.find("BlockMap").findall("Range"):
+            blocks = child.text.strip().split("-")
+            result.append(int(blocks[0]), int(blocks[-1]),
+                          child.attrib.get("chksum"))
+        return result
+
+    @classmethod
+    def from_dict(cls, bmapDict):
+        """ Get a block map from a dictionary (as sent by older clients) """
+        result = cls(bmapDict["BlockSize"], bmapDict["ImageSize"],
+                     bmapDict.get("ChecksumType"))
+        for r in bmapDict["BlockMap"]:
+            result.append(r["first"], r["last"], r.get("chksum"))
+        return result
+
+    def xml(self):
+        """ Get the contents of a bmap file (version 2.0) for this map """
+        blocks = -(-self.image_size // self.block_size)
+        mapped = sum(last - first + 1
+                     for first, last in zip(self.first, self.last))
+        lines = ['<?xml version="1.0" ?>',
+                 '<bmap version="2.0">',
+                 f'    <ImageSize> {self.image_size} </ImageSize>',
+                 f'    <BlockSize> {self.block_size} </BlockSize>',
+                 f'    <BlocksCount> {blocks} </BlocksCount>',
+                 f'    <MappedBlocksCount> {mapped} </MappedBlocksCount>']
+        if self.checksum_type is not None:
+            lines.append(f'    <ChecksumType> {self.checksum_type} '
+                         '</ChecksumType>')
+            # checksum of the file with this checksum set to zeroes
+            lines.append('    <BmapFileChecksum> {} </BmapFileChecksum>')
+        lines.append('    <BlockMap>')
+        for index in range(len(self)):
+            first = self.first[index]
+            last = self.last[index]
+            blocks = f'{first}-{last}' if last != first else f'{first}'
+            digest = self.digest(index)
+            if digest is not None:
+                lines.append(f'        <Range chksum="{digest.hex()}"> '
+                             f'{blocks} </Range>')
+            else:
+                lines.append(f'        <Range> {blocks} </Range>')
+        lines += ['    </BlockMap>', '</bmap>', '']
+        result = '\n'.join(lines)
+        if self.checksum_type is not None:
+            zeroes = '0' * self.digest_size * 2
+            chksum = hashlib.new(self.checksum_type)
+            chksum.update(result.replace('{}', zeroes, 1).encode())
+            result = result.replace('{}', chksum.hexdigest(), 1)
+        return result
+
+    def encode(self):
+        checksum_type = (self.checksum_type or '').encode()
+        header = self.HEADER.pack(self.MAGIC, self.block_size,
+                                  self.image_size, len(self), self.digest_size,
+                                  checksum_type)
+        first = array.array('Q', self.first)
+        last = array.array('Q', self.last)
+        if sys.byteorder != 'little':
+            first.byteswap()
+            last.byteswap()
+        return header + first.tobytes() + last.tobytes() + bytes(self.digests)
+
+    @classmethod
+    def decode(cls, blob):
+        header = cls.HEADER.unpack_from(blob)
+        magic, block_size, image_size, count, digest_size, checksum_type = header
+        if magic != cls.MAGIC:
+            raise ValueError('invalid block map!')
+        checksum_type = checksum_type.rstrip(b'\0').decode() or None
+        result = cls(block_size, image_size, checksum_type)
+        if digest_size != result.digest_size:
+            raise ValueError('invalid block map digests!')
+        pos = cls.HEADER.size
+        size = count * 8
+        if len(blob) != pos + 2 * size + count * digest_size:
+            raise ValueError('truncated block map!')
+        result.first.frombytes(blob[pos:pos + size])
+        result.last.frombytes(blob[pos + size:pos + 2 * size])
+        if sys.byteorder != 'little':
+            result.first.byteswap()
+            result.last.byteswap()
+        result.digests = bytearray(blob[pos + 2 * size:])
+        return result
+
+    @property
+    def mapped_size(self):
+        """ Number of mapped bytes """
+        result = 0
+        for index in range(len(self)):
+            start, end = self.range(index)
+            result += end - start
+        return result
+
+    def range(self, index):
+        """ Get the start and end offsets (in bytes) of a range """
+        start = self.first[index] * self.block_size
+        end = min((self.last[index] + 1) * self.block_size, self.image_size)
+        return start, end
+
+    def ranges(self):
+        for index in range(len(self)):
+            yield self.range(index)
+
+    def digest(self, index):
+        """ Get the binary digest of a range, None if not available """
+        if self.digest_size == 0:
+            return None
+        start = index * self.digest_size
+        return bytes(self.digests[start:start + self.digest_size])
+
+    def mapped(self, start, end):
+        """ Get mapped pieces (index, start, end) of a range of bytes """
+        index = bisect.bisect_left(self.last, start // self.block_size)
+        while index < len(self):
+            rstart, rend = self.range(index)
+            if rstart >= end:
+                break
+            if max(start, rstart) < min(end, rend):
+                yield index, max(start, rstart), min(end, rend)
+            index += 1
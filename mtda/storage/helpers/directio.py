@@ -0,0 +1,148 @@
+# ---------------------------------------------------------------------------
+# Direct I/O writes to block devices
+# ---------------------------------------------------------------------------
+#
+# This software is a part of MTDA.
+# Copyright (C) 2025 Siemens AG
+#
+# ---------------------------------------------------------------------------
+# SPDX-License-Identifier: MIT
+# ---------------------------------------------------------------------------
+
+# System imports
+import io
+import mmap
+import os
+
+# Local imports
+import mtda.constants as CONSTS
+
+
+class DirectWriter:
+    """
+    File-like object writing to a block device with O_DIRECT, bypassing the
+    page cache. Data is copied into a pool of page-aligned buffers which are
+    written with a single os.pwritev() call once they are all filled (or on
+    seek/flush). Pieces that are not aligned are written through the page
+    cache.
+    """
+
+    def __init__(self, path, bufsize=CONSTS.WRITER.DIRECT_BUFFER_SIZE,
+                 count=CONSTS.WRITER.DIRECT_BUFFERS,
+                 align=CONSTS.WRITER.DIRECT_ALIGNMENT):
+        self._fd = os.open(path, os.O_RDWR | os.O_DIRECT)
+        try:
+            self._buffered = os.open(path, os.O_RDWR)
+        except OSError:
+            os.close(self._fd)
+            raise
+        self._align = align
+        self._bufsize = bufsize
+        # anonymous mappings are page-aligned
+        self._pool = [mmap.mmap(-1, bufsize) for _ in range(count)]
+        self._free = list(self._pool)
+        self._full = []
+        self._buf = self._free.pop()
+        self._fill = 0
+        self._pos = 0
+        self._start = 0
+
+    def _pending(self):
+        return self._fill > 0 or len(self._full) > 0
+
+    @staticmethod
+    def _pwritev(fd, buffers, offset):
+        total = sum(len(b) for b in buffers)
+        written = os.pwritev(fd, buffers, offset)
+        if written < total:
+            # short write: write what is left one buffer at a time
+            for b in buffers:
+                with memoryview(b) as view:
+                    skip = min(written, len(view))
+                    written -= skip
+                    pos = offset + skip
+                    while skip < len(view):
+                        n = os.pwrite(fd, view[skip:], pos)
+                        skip += n
+                        pos += n
+                offset += len(b)
+        return total
+
+    def _write_full(self):
+        self._start += self._pwritev(self._fd, self._full, self._start)
+        self._free.extend(self._full)
+        self._full = []
+
+    def write(self, data):
+        with memoryview(data) as view:
+            view = view.cast('B')
+            size = len(view)
+            if not self._pending():
+                if self._pos % self._align:
+                    # write up to the next aligned offset via the page cache
+                    head = min(size, -self._pos % self._align)
+                    os.pwrite(self._buffered, view[:head], self._pos)
+                    self._pos += head
+                    view = view[head:]
+                self._start = self._pos
+            while len(view) > 0:
+                n = min(len(view), self._bufsize - self._fill)
+                self._buf[self._fill:self._fill + n] = view[:n]
+                self._fill += n
+                self._pos += n
+                view = view[n:]
+                if self._fill == self._bufsize:
+                    self._full.append(self._buf)
+                    if not self._free:
+                        self._write_full()
+                    self._buf = self._free.pop()
+                    self._fill = 0
+        return size
+
+    def flush(self):
+        if not self._pending():
+            return
+        aligned = self._fill - self._fill % self._align
+        with memoryview(self._buf) as view:
+            buffers = self._full
+            if aligned > 0:
+                buffers = buffers + [view[:aligned]]
+            offset = self._start
+            if buffers:
+                offset += self._pwritev(self._fd, buffers, offset)
+            if aligned < self._fill:
+                os.pwrite(self._buffered, view[aligned:self._fill], offset)
+        self._free.extend(self._full)
+        self._full = []
+        self._fill = 0
+        self._start = self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += os.lseek(self._buffered, 0, io.SEEK_END)
+        if offset != self._pos:
+            self.flush()
+            self._pos = offset
+            self._start = offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def fileno(self):
+        """ Descriptor for reads and syncs (not opened with O_DIRECT) """
+        return self._buffered
+
+    def close(self):
+        if self._fd is None:
+            return
+        try:
+            self.flush()
+        finally:
+            os.close(self._fd)
+            os.close(self._buffered)
+            self._fd = None
+            for buf in self._pool:
+                buf.close()
@@ -0,0 +1,126 @@
+# ---------------------------------------------------------------------------
+# Index of block hashes for the shared storage
+# ---------------------------------------------------------------------------
+#
+# This software is a part of MTDA.
+# Copyright (C) 2025 Siemens AG
+#
+# ---------------------------------------------------------------------------
+# SPDX-License-Identifier: MIT
+# ---------------------------------------------------------------------------
+
+# System imports
+import hashlib
+import os
+
+# Local imports
+import mtda.constants as CONSTS
+
+
+class BlockHashIndex:
+    """
+    Hashes of fixed-size blocks of the shared storage. Hashes are updated as
+    data gets written and blocks that were only partially written are
+    re-hashed from the storage when requested.
+    """
+
+    DIGEST_SIZE = 16
+
+    def __init__(self, blksz=CONSTS.WRITER.HASH_BLOCK_SIZE):
+        self.blksz = blksz
+        self._digests = bytearray()
+        self._valid = bytearray()
+        self._pending = None
+
+    @staticmethod
+    def hasher():
+        return hashlib.blake2b(digest_size=BlockHashIndex.DIGEST_SIZE)
+
+    @staticmethod
+    def digest(data):
+        return hashlib.blake2b(
+            data, digest_size=BlockHashIndex.DIGEST_SIZE).digest()
+
+    def _resize(self, blocks):
+        if blocks > len(self._valid):
+            missing = blocks - len(self._valid)
+            self._valid.extend(bytes(missing))
+            self._digests.extend(bytes(missing * self.DIGEST_SIZE))
+
+    def _set(self, block, digest):
+        start = block * self.DIGEST_SIZE
+        self._digests[start:start + self.DIGEST_SIZE] = digest
+        self._valid[block] = 1
+
+    def invalidate(self, offset=0, size=None):
+        """ Invalidate hashes of blocks in the specified range """
+        first = offset // self.blksz
+        if size is None:
+            last = len(self._valid)
+        else:
+            last = min(-(-(offset + size) // self.blksz), len(self._valid))
+        self._valid[first:last] = bytes(max(last - first, 0))
+        if self._pending is not None and first <= self._pending[0] < last:
+            self._pending = None
+
+    def update(self, offset, data):
+        """ Update hashes of blocks covered by data written at offset """
+        end = offset + len(data)
+        self._resize(-(-end // self.blksz))
+        view = memoryview(data)
+        pos = offset
+        while pos < end:
+            block = pos // self.blksz
+            start = block * self.blksz
+            size = min(end, start + self.blksz) - pos
+            piece = view[pos - offset:pos - offset + size]
+            if pos == start and size == self.blksz:
+                self._set(block, self.digest(piece))
+                if self._pending is not None and self._pending[0] == block:
+                    self._pending = None
+            elif pos == start:
+                # block will be fully hashed if sequential writes complete it
+                hasher = self.hasher()
+                hasher.update(piece)
+                self._pending = [block, hasher, size]
+                self._valid[block] = 0
+            elif self._pending is not None and \
+                    self._pending[0] == block and \
+                    self._pending[2] == pos - start:
+                self._pending[1].update(piece)
+                self._pending[2] += size
+                if self._pending[2] == self.blksz:
+                    self._set(block, self._pending[1].digest())
+                    self._pending = None
+            else:
+                self._valid[block] = 0
+                if self._pending is not None and self._pending[0] == block:
+                    self._pending = None
+            pos += size
+
+    def digests(self, fd, size):
+        """
+        Get hashes of blocks covering the first size bytes of the storage,
+        blocks with no valid hash are read from the specified file
+        descriptor
+        """
+        blocks = -(-size // self.blksz)
+        self._resize(blocks)
+        block = 0
+        while block < blocks:
+            if self._valid[block]:
+                block += 1
+                continue
+            # read consecutive invalid blocks at once
+            count = 1
+            while block + count < blocks \
+                    and count < CONSTS.WRITER.HASH_READ_BLOCKS \
+                    and not self._valid[block + count]:
+                count += 1
+            data = os.pread(fd, count * self.blksz, block * self.blksz)
+            view = memoryview(data)
+            for n in range(count):
+                piece = view[n * self.blksz:(n + 1) * self.blksz]
+                self._set(block + n, self.digest(piece))
+            block += count
+        return bytes(self._digests[:blocks * self.DIGEST_SIZE])
@@ -11,17 +11,48 @@
 
 # System imports
 import atexit
+import bisect
+import ctypes
+import fcntl
 import os
 import pathlib
 import psutil
+import queue
+import stat
+import struct
 import subprocess
 import threading
+import time
 import io
 import hashlib
 
 # Local imports
 import mtda.constants as CONSTS
 from mtda.storage.controller import StorageController
+from mtda.storage.helpers.bmap import BlockMap
+from mtda.storage.helpers.directio import DirectWriter
+from mtda.storage.helpers.hashindex import BlockHashIndex
+from mtda.storage.helpers.verify import ReadBackVerifier
+
+
+# flush buffers of a block device (see linux/fs.h)
+BLKFLSBUF = 0x1261
+# zero a range of a block device (see linux/fs.h)
+BLKZEROOUT = 0x127f
+# deallocate a range of a file (see linux/falloc.h)
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+
+def punch_hole(fd, offset, size):
+    """ Deallocate a range of a file, subsequent reads return zeroes """
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                               ctypes.c_int64, ctypes.c_int64]
+    mode = FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE
+    if libc.fallocate(fd, mode, offset, size) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
 
 
 class BmapWriteError(OSError):
@@ -33,17 +64,28 @@ class BmapWriteError(OSError):
 
 class Image(StorageController):
     _is_storage_mounted = False
+    ZERO_BLOCK = bytes(CONSTS.WRITER.ZERO_BLOCK_SIZE)
 
     def __init__(self, mtda):
         self.mtda = mtda
+        # write block devices with O_DIRECT
+        self.direct = False
         self.handle = None
+        self.hashes = BlockHashIndex()
+        self.hashing = False
         self.isloop = False
-        self.bmapDict = None
-        self.crtBlockRange = 0
-        self.writtenBytes = 0
+        # how blocks of zeroes are written to the storage
+        self.zeroes = None
+        self.bmap = None
+        # ranges being written (see _update_range()) and completed ones
+        self.hashers = {}
+        self.completed = None
+        # ranges are hashed on a thread of their own
+        self.verifier = None
+        self.verifying = queue.Queue(CONSTS.WRITER.QUEUE_SIZE)
+        self.verify_error = None
+        self.position = 0
         self.mappedBytes = 0
-        self.overlap = 0
-        self.rangeChkSum = None
         self.lock = threading.Lock()
         atexit.register(self._umount)
 
@@ -56,15 +98,24 @@ class Image(StorageController):
 
         result = True
         if self.handle is not None:
+            start = time.monotonic()
+            # ranges left incomplete were reported when the write completed
+            # (aborted writes leave incomplete ranges behind)
+            self.hashers = {}
+            try:
+                self._sync()
+            except OSError as e:
+                self.mtda.debug(1, f"storage.helpers.image._close(): {e}")
+                result = False
+            self.mtda.debug(2, "storage.helpers.image._close(): synced in "
+                               f"{time.monotonic() - start:.3f}s")
             self.handle.close()
             self.handle = None
-            self.bmapDict = None
+            self.hashing = False
+            self.zeroes = None
+            self.bmap = None
             if hasattr(self, 'rollback'):
                 self.rollback()
-            try:
-                subprocess.check_output(["sync"])
-            except subprocess.CalledProcessError:
-                result = False
 
         self.mtda.debug(3, f"storage.helpers.image._close(): {str(result)}")
         return result
@@ -78,6 +129,76 @@ class Image(StorageController):
         self.mtda.debug(3, f"storage.helpers.image.close(): {str(result)}")
         return result
 
+    def _sync(self, incremental=False):
+        if self.handle is None:
+            return False
+        if incremental is False:
+            self._verified(wait=True)
+            self._incomplete()
+        self.handle.flush()
+        fd = self.handle.fileno()
+        if incremental is True:
+            # start writeback of dirty pages without waiting for it
+            if hasattr(os, 'sync_file_range'):
+                os.sync_file_range(fd, 0, 0, os.SYNC_FILE_RANGE_WRITE)
+            return True
+        os.fdatasync(fd)
+        if stat.S_ISBLK(os.fstat(fd).st_mode):
+            try:
+                fcntl.ioctl(fd, BLKFLSBUF)
+            except OSError as e:
+                # e.g. not permitted
+                self.mtda.debug(2, f"storage.helpers.image._sync(): {e}")
+        return True
+
+    def sync(self, incremental=False):
+        self.mtda.debug(3, "storage.helpers.image.sync()")
+
+        with self.lock:
+            result = self._sync(incremental)
+
+        self.mtda.debug(3, f"storage.helpers.image.sync(): {str(result)}")
+        return result
+
+    def verify(self, checksums=None, size=None, progress=None):
+        """
+        Read data written to the storage back and get ranges that differ:
+        mapped ranges are compared with the block map or blocks of size
+        bytes with the specified checksums (see BlockHashIndex)
+        """
+        self.mtda.debug(3, "storage.helpers.image.verify()")
+
+        with self.lock:
+            if self.handle is None:
+                raise RuntimeError('shared storage not opened')
+            ranges = []
+            if checksums is not None:
+                blksz = self.hashes.blksz
+                dgsz = BlockHashIndex.DIGEST_SIZE
+                for block in range(-(-size // blksz)):
+                    digest = checksums[block * dgsz:(block + 1) * dgsz]
+                    ranges.append((block * blksz,
+                                   min((block + 1) * blksz, size), digest,
+                                   BlockHashIndex.hasher))
+            elif self.bmap is not None and self.bmap.digest_size > 0:
+                bmap = self.bmap
+                for index in range(len(bmap)):
+                    start, end = bmap.range(index)
+                    ranges.append((start, end, bmap.digest(index),
+                                   lambda: hashlib.new(bmap.checksum_type)))
+            else:
+                raise RuntimeError('no checksums to verify the storage')
+
+            # read from the storage rather than from the page cache
+            self._sync()
+            fd = self.handle.fileno()
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            verifier = ReadBackVerifier(fd, ranges, progress)
+            result = verifier.run()
+
+        self.mtda.debug(3, f"storage.helpers.image.verify(): {result}")
+        return result
+
     def _mountpoint(self, path=""):
         result = "/media"
         if os.geteuid() != 0:
@@ -203,6 +324,8 @@ class Image(StorageController):
     def _mount_impl(self, part=None):
         result = True
         if self._status() == CONSTS.STORAGE.ON_HOST:
+            # files may be changed through the mounted partitions
+            self.hashes.invalidate()
             result = self._get_partitions()
             if result:
                 self.mtda.debug(2, "storage.helpers.image.mount(): "
@@ -234,20 +357,71 @@ class Image(StorageController):
             if self._status() == CONSTS.STORAGE.ON_HOST:
                 if self.handle is None:
                     result = self._open()
+                    self.hashing = result is True
         self.mtda.debug(3, f"storage.helpers.image.open(): {str(result)}")
         return result
 
     def _open(self):
-        self.handle = open(self.file, "r+b")
+        self.handle = self._open_path(self.file)
         self.handle.seek(0, 0)
         return True
 
+    def _open_path(self, path):
+        """ Open the storage for writing (with O_DIRECT if enabled) """
+        mode = os.stat(path).st_mode
+        if stat.S_ISBLK(mode):
+            self.zeroes = 'zeroout'
+        elif stat.S_ISREG(mode):
+            self.zeroes = 'punch'
+        if self.direct is True and stat.S_ISBLK(mode):
+            try:
+                return DirectWriter(path)
+            except OSError as e:
+                self.mtda.debug(1, "storage.helpers.image._open_path(): "
+                                   f"direct I/O not available: {e}")
+        return open(path, "r+b")
+
     def path(self):
         self.mtda.debug(3, "storage.helpers.image.path()")
         result = self.file
         self.mtda.debug(3, f"storage.helpers.image.open(): {result}")
         return result
 
+    def _has_cow(self):
+        """ Whether changes made by others go to a CoW device"""
+        return False
+
+    def invalidate(self, cow=False):
+        """
+        Invalidate the index of block hashes as the shared storage may be
+        changed by others. Changes going to a CoW device do not invalidate
+        the index as they are rolled back before we write to the storage.
+        """
+        self.mtda.debug(3, "storage.helpers.image.invalidate()")
+
+        with self.lock:
+            result = cow is False or self._has_cow() is False
+            if result is True:
+                self.hashes.invalidate()
+
+        self.mtda.debug(3, "storage.helpers.image."
+                           f"invalidate(): {str(result)}")
+        return result
+
+    def checksums(self, size):
+        """ Get hashes of blocks covering the first size bytes """
+        self.mtda.debug(3, "storage.helpers.image.checksums()")
+
+        with self.lock:
+            if self.hashing is False:
+                raise RuntimeError("shared storage not opened")
+            self.handle.flush()
+            result = self.hashes.digests(self.handle.fileno(), size)
+
+        self.mtda.debug(3, "storage.helpers.image.checksums(): "
+                           f"{len(result)} bytes")
+        return result
+
     def status(self):
         self.mtda.debug(3, "storage.helpers.image.status()")
         with self.lock:
@@ -256,30 +430,26 @@ class Image(StorageController):
         self.mtda.debug(3, f"storage.helpers.image.status(): {str(result)}")
         return result
 
-    def _get_hasher_by_name(self):
-        algo = self.bmapDict["ChecksumType"]
-        if algo == 'sha256':
-            return hashlib.sha256()
-        elif algo == 'md5':
-            return hashlib.md5()
-        else:
-            self.mtda.debug(1, "storage.helpers.image._get_hasher_by_name(): "
-                               "unknown hash algorithm %s" % algo)
-            return None
-
-    def setBmap(self, bmapDict):
-        self.bmapDict = bmapDict
-        self.crtBlockRange = 0
-        self.writtenBytes = 0
+    def setBmap(self, bmap):
+        """
+        Set the block map of the image to be written: either a blob of bytes
+        (see BlockMap.encode()) or a dictionary (as sent by older clients)
+        """
+        if isinstance(bmap, dict):
+            bmap = BlockMap.from_dict(bmap)
+        elif bmap is not None:
+            bmap = BlockMap.decode(bmap)
+        # wait for ranges of the previous image to be hashed
+        self.verifying.join()
+        self.verify_error = None
+        self.bmap = bmap
+        self.hashers = {}
+        self.completed = None
+        self.position = 0
         self.mappedBytes = 0
-        self.overlap = 0
-        if bmapDict is not None:
-            blocksize = bmapDict["BlockSize"]
-            # bytes missing in the last block until it is full
-            last_block_missing = -bmapDict["ImageSize"] % blocksize
-            self.rangeChkSum = self._get_hasher_by_name()
-            # the last block is not full, if the imagesize is not a multiple of the blocksize
-            self.mappedBytes = bmapDict["MappedBlocksCount"] * blocksize - last_block_missing
+        if bmap is not None:
+            self.completed = bytearray(len(bmap))
+            self.mappedBytes = bmap.mapped_size
 
     def supports_hotplug(self):
         return False
@@ -317,76 +487,250 @@ class Image(StorageController):
         with self.lock:
             result = None
             if self.handle is not None:
-                # Check if there is a valid bmapDict, write all data otherwise
-                if self.bmapDict is not None:
+                # Check if there is a valid bmap, write all data otherwise
+                if self.bmap is not None:
                     result = self._write_with_bmap(data)
                 else:
                     # No bmap
-                    result = self.handle.write(data)
+                    result = self._write(data)
                     self.mtda.notify_write(size=len(data))
 
         self.mtda.debug(3, f"storage.helpers.image.write(): {str(result)}")
         return result
 
-    def _write_with_bmap(self, data):
-        cur_range = self.bmapDict["BlockMap"][self.crtBlockRange]
-        blksize = self.bmapDict["BlockSize"]
-        imageBytes = self.bmapDict["ImageSize"]
-        # offset within the data buffer
-        offset = 0
-        # remaining bytes in data buffer
-        remaining = len(data) - offset
-        while remaining:
-            writtenBlocks = self.writtenBytes // blksize
-            if writtenBlocks > cur_range["last"]:
-                self.crtBlockRange += 1
-                cur_range = self.bmapDict["BlockMap"][self.crtBlockRange]
-
-            if writtenBlocks >= cur_range["first"]:
-                # bmap ranges are inclusive. Exclusive ranges like [from, to)
-                # are easier to handle, hence add one block
-                cur_last_block = cur_range["last"] + 1
-                end = min(remaining, (cur_last_block - writtenBlocks) * blksize - self.overlap)
-                nbytes = self._write_with_chksum(data[offset:offset + end])
-                # either we completed our range, or we are at the end of the image
-                if self.writtenBytes + nbytes in [cur_last_block * blksize, imageBytes]:
-                    self._validate_and_reset_range()
-                self.mtda.notify_write(size=nbytes, mapped=self.mappedBytes)
+    def pwrite(self, data, offset):
+        self.mtda.debug(3, "storage.helpers.image.pwrite()")
+
+        with self.lock:
+            result = None
+            if self.handle is not None:
+                if self.bmap is not None:
+                    result = self._write_with_bmap(data, offset)
+                else:
+                    self.handle.seek(offset, io.SEEK_SET)
+                    result = self._write(data)
+                    self.mtda.notify_write(size=len(data))
+
+        self.mtda.debug(3, f"storage.helpers.image.pwrite(): {str(result)}")
+        return result
+
+    def _write_with_bmap(self, data, offset=None):
+        """ Write mapped pieces of data and skip others """
+        if offset is None:
+            offset = self.handle.tell()
+        elif offset > self.position:
+            # skipped bytes are processed too
+            self.mtda.notify_write(seek=offset - self.position,
+                                   mapped=self.mappedBytes)
+        end = offset + len(data)
+        view = memoryview(data)
+        pos = offset
+        for index, start, stop in self.bmap.mapped(offset, end):
+            if start > pos:
+                self.mtda.notify_write(seek=start - pos,
+                                       mapped=self.mappedBytes)
+            if start == offset and stop == end:
+                piece = data
             else:
-                # the range already got incremented, hence we need to iterate
-                # until the begin of the current range
-                nbytes = min(remaining,
-                             (cur_range["first"] - writtenBlocks)
-                             * blksize - self.overlap)
-                self.handle.seek(nbytes, io.SEEK_CUR)
-                self.mtda.notify_write(seek=nbytes, mapped=self.mappedBytes)
-            self.writtenBytes += nbytes
-            self.overlap = self.writtenBytes % blksize
-            offset += nbytes
-            remaining -= nbytes
-
-        return offset
-
-    def _validate_and_reset_range(self):
-        if not self.rangeChkSum:
+                piece = view[start - offset:stop - offset]
+            self.handle.seek(start, io.SEEK_SET)
+            self._write(piece)
+            self._update_range(index, start, piece)
+            self.mtda.notify_write(size=stop - start, mapped=self.mappedBytes)
+            pos = stop
+        if end > pos:
+            self.mtda.notify_write(seek=end - pos, mapped=self.mappedBytes)
+        self.handle.seek(end, io.SEEK_SET)
+        self.position = max(self.position, end)
+        return len(data)
+
+    def _update_range(self, index, offset, data):
+        """
+        Queue data written to a range to be hashed. Ranges written in order
+        are hashed as data gets written, others are read back from the
+        storage once all their bytes were written.
+        """
+        if self.bmap.digest(index) is None:
             return
-        cur_range = self.bmapDict["BlockMap"][self.crtBlockRange]
-        first = cur_range['first']
-        last = cur_range['last']
-        obs_chksum = self.rangeChkSum.hexdigest()
-        exp_chksum = cur_range['chksum']
-        self.mtda.debug(2, "storage.helpers.image._validate_and_reset_range(): "
-                           f"checksum of range {first}:{last} is {obs_chksum}")
-        if exp_chksum == obs_chksum:
-            self.rangeChkSum = self._get_hasher_by_name()
+        self._verified()
+        if self.verifier is None:
+            self.verifier = threading.Thread(target=self._verifier,
+                                             daemon=True, name='verifier')
+            self.verifier.start()
+        start, end = self.bmap.range(index)
+        # hasher, end of data written in order and extents written
+        # out of order
+        state = self.hashers.get(index)
+        if state is None:
+            state = [hashlib.new(self.bmap.checksum_type), start, None]
+            if self.completed[index]:
+                # range written again
+                state[2] = [(start, end)]
+            self.hashers[index] = state
+        stop = offset + len(data)
+        if state[2] is None and offset == state[1]:
+            state[1] = stop
+            complete = stop >= end
+            self.verifying.put((self.bmap, index, state[0], data, complete))
+        else:
+            if state[2] is None:
+                state[2] = [(start, state[1])] if state[1] > start else []
+            extents = state[2]
+            self._cover(extents, offset, stop)
+            complete = extents == [(start, end)]
+            if complete is True:
+                # data shall be read back from the storage
+                self.handle.flush()
+                self.verifying.put((self.bmap, index, None, None, True))
+        if complete is True:
+            del self.hashers[index]
+            self.completed[index] = 1
+
+    @staticmethod
+    def _cover(extents, start, end):
+        """ Add an extent to a sorted list of disjoint extents """
+        i = bisect.bisect_left(extents, (start, start))
+        if i > 0 and extents[i - 1][1] >= start:
+            i -= 1
+        j = i
+        while j < len(extents) and extents[j][0] <= end:
+            start = min(start, extents[j][0])
+            end = max(end, extents[j][1])
+            j += 1
+        extents[i:j] = [(start, end)]
+
+    def _incomplete(self):
+        """ Raise an error for the first range that was partly written """
+        if not self.hashers:
             return
+        index = min(self.hashers)
+        self.hashers = {}
         raise BmapWriteError(
-            "checksum mismatch for blocks range %d-%d: "
-            "calculated %s, should be %s"
-            % (first, last, obs_chksum, exp_chksum))
-
-    def _write_with_chksum(self, data):
-        if self.rangeChkSum:
-            self.rangeChkSum.update(data)
-        result = self.handle.write(data)
+            "blocks range %d-%d was only partly written"
+            % (self.bmap.first[index], self.bmap.last[index]))
+
+    def _verified(self, wait=False):
+        """ Raise the first checksum mismatch (if any) """
+        if wait is True:
+            self.verifying.join()
+        error = self.verify_error
+        if error is not None:
+            self.verify_error = None
+            raise error
+
+    def _verifier(self):
+        while True:
+            bmap, index, hasher, data, final = self.verifying.get()
+            try:
+                self._verify_range(bmap, index, hasher, data, final)
+            except BmapWriteError as e:
+                self.mtda.debug(1, f"storage.helpers.image._verifier(): {e}")
+                if self.verify_error is None:
+                    self.verify_error = e
+            except OSError as e:
+                self.mtda.debug(1, f"storage.helpers.image._verifier(): {e}")
+                if self.verify_error is None:
+                    self.verify_error = BmapWriteError(
+                        f"blocks range {bmap.first[index]}-"
+                        f"{bmap.last[index]} could not be read back: {e}")
+            finally:
+                self.verifying.task_done()
+
+    def _verify_range(self, bmap, index, hasher, data, final):
+        """
+        Hash data written to a range (read the range back from the storage
+        without data) and validate completed ranges
+        """
+        if hasher is None:
+            hasher = hashlib.new(bmap.checksum_type)
+            start, end = bmap.range(index)
+            fd = self.handle.fileno()
+            while start < end:
+                size = min(end - start, CONSTS.WRITER.VERIFY_READ_SIZE)
+                data = os.pread(fd, size, start)
+                if not data:
+                    break
+                hasher.update(data)
+                start += len(data)
+        else:
+            hasher.update(data)
+        if final is False:
+            return
+        expected = bmap.digest(index)
+        digest = hasher.digest()
+        if digest != expected:
+            first = bmap.first[index]
+            last = bmap.last[index]
+            raise BmapWriteError(
+                "checksum mismatch for blocks range %d-%d: "
+                "calculated %s, should be %s"
+                % (first, last, digest.hex(), expected.hex()))
+
+    def _write(self, data):
+        if self.zeroes is not None and \
+           len(data) >= CONSTS.WRITER.ZERO_BLOCK_SIZE:
+            write = self._write_skipping_zeroes
+        else:
+            write = self.handle.write
+        if self.hashing is True:
+            offset = self.handle.tell()
+            result = write(data)
+            self.hashes.update(offset, data)
+        else:
+            result = write(data)
         return result
+
+    def _write_skipping_zeroes(self, data):
+        """ Write data but zero aligned blocks of zeroes in place """
+        if not isinstance(data, (bytes, bytearray)):
+            data = bytes(data)
+        blksz = CONSTS.WRITER.ZERO_BLOCK_SIZE
+        offset = self.handle.tell()
+        size = len(data)
+        start = -offset % blksz
+        end = start + (size - start) // blksz * blksz
+        view = memoryview(data)
+        # data up to pos was written
+        pos = 0
+        zero = None
+        for i in range(start, end, blksz):
+            if data.startswith(self.ZERO_BLOCK, i):
+                if zero is None:
+                    zero = i
+            elif zero is not None:
+                pos = self._write_zeroes(view, pos, zero, i, offset)
+                zero = None
+        if zero is not None:
+            pos = self._write_zeroes(view, pos, zero, end, offset)
+        if pos < size:
+            self.handle.write(view[pos:])
+        return size
+
+    def _write_zeroes(self, view, pos, start, end, offset):
+        """ Write data up to a run of zeroes and zero that run """
+        if self.zeroes is None:
+            # zeroes get written along with other data
+            return pos
+        if pos < start:
+            self.handle.write(view[pos:start])
+        try:
+            self._zero(offset + start, end - start)
+        except OSError as e:
+            self.mtda.debug(2, "storage.helpers.image._write_zeroes(): "
+                               f"writing zeroes: {e}")
+            self.zeroes = None
+            return start
+        self.handle.seek(end - start, io.SEEK_CUR)
+        return end
+
+    def _zero(self, offset, size):
+        fd = self.handle.fileno()
+        if self.zeroes == 'zeroout':
+            fcntl.ioctl(fd, BLKZEROOUT, struct.pack('QQ', offset, size))
+            return
+        # keep sparse files sparse, grow them if needed
+        length = os.fstat(fd).st_size
+        if offset < length:
+            punch_hole(fd, offset, min(size, length - offset))
+        if offset + size > length:
+            os.ftruncate(fd, offset + size)
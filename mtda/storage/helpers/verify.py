@@ -0,0 +1,124 @@
+# ---------------------------------------------------------------------------
+# Verify data written to the shared storage
+# ---------------------------------------------------------------------------
+#
+# This software is a part of MTDA.
+# Copyright (C) 2025 Siemens AG
+#
+# ---------------------------------------------------------------------------
+# SPDX-License-Identifier: MIT
+# ---------------------------------------------------------------------------
+
+# System imports
+import collections
+import concurrent.futures
+import os
+import time
+
+# Local imports
+import mtda.constants as CONSTS
+
+
+class ReadBackVerifier:
+    """
+    Read ranges back from the storage and compare their digests with the
+    expected ones. Contiguous ranges are read together with large sequential
+    reads while ranges are hashed in parallel on a pool of threads.
+    """
+
+    def __init__(self, fd, ranges, progress=None,
+                 readsz=CONSTS.WRITER.VERIFY_READ_SIZE):
+        """
+        ranges is a list of (start, end, digest, hasher) tuples where hasher
+        creates a hash object for the range
+        """
+        self._fd = fd
+        self._ranges = ranges
+        self._progress = progress
+        self._readsz = readsz
+        self._hashers = {}
+        self._mismatches = []
+        self._workers = os.cpu_count() or 1
+
+    @property
+    def size(self):
+        return sum(end - start for start, end, _, _ in self._ranges)
+
+    def _reads(self):
+        """ Get reads as (offset, size, pieces) with pieces of ranges """
+        offset = None
+        size = 0
+        pieces = []
+        for index, (start, end, _, _) in enumerate(self._ranges):
+            pos = start
+            while pos < end:
+                if offset is not None and \
+                   (offset + size != pos or size == self._readsz):
+                    yield offset, size, pieces
+                    offset = None
+                if offset is None:
+                    offset = pos
+                    size = 0
+                    pieces = []
+                n = min(end - pos, self._readsz - size)
+                pieces.append((index, pos - offset, n, pos + n == end))
+                size += n
+                pos += n
+        if offset is not None:
+            yield offset, size, pieces
+
+    def _hash(self, index, data, last, previous):
+        # pieces of a range are hashed in order
+        if previous is not None:
+            previous.result()
+        hasher = self._hashers[index]
+        hasher.update(data)
+        if last is True:
+            del self._hashers[index]
+            start, end, digest, _ = self._ranges[index]
+            if hasher.digest() != digest:
+                self._mismatches.append((start, end))
+
+    def run(self):
+        """ Get ranges that differ from their expected digests """
+        total = self.size
+        verified = 0
+        notified = time.monotonic()
+        last = 0
+        chains = {}
+        inflight = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(
+                self._workers, thread_name_prefix='verifier') as pool:
+            for offset, size, pieces in self._reads():
+                data = os.pread(self._fd, size, offset)
+                view = memoryview(data)
+                for index, pos, n, final in pieces:
+                    if index not in self._hashers:
+                        self._hashers[index] = self._ranges[index][3]()
+                    piece = view[pos:pos + n]
+                    if len(piece) < n:
+                        # short read: missing bytes are read as zeroes
+                        piece = bytes(piece) + bytes(n - len(piece))
+                    future = pool.submit(self._hash, index, piece, final,
+                                         chains.pop(index, None))
+                    if final is False:
+                        chains[index] = future
+                    inflight.append(future)
+                while len(inflight) > self._workers * 4:
+                    inflight.popleft().result()
+                verified += size
+                now = time.monotonic()
+                if self._progress is not None and \
+                   now - notified >= CONSTS.WRITER.NOTIFY_SECONDS:
+                    self._progress(verified, total,
+                                   (verified - last) / (now - notified))
+                    notified = now
+                    last = verified
+            for future in inflight:
+                future.result()
+        if self._progress is not None:
+            elapsed = time.monotonic() - notified
+            self._progress(verified, total,
+                           (verified - last) / elapsed if elapsed else 0)
+        self._mismatches.sort()
+        return self._mismatches
@@ -0,0 +1,441 @@
+# ---------------------------------------------------------------------------
+# Share the storage over the network with the NBD protocol
+# ---------------------------------------------------------------------------
+#
+# This software is a part of MTDA.
+# Copyright (C) 2025 Siemens AG
+#
+# ---------------------------------------------------------------------------
+# SPDX-License-Identifier: MIT
+# ---------------------------------------------------------------------------
+
+# System imports
+import asyncio
+import concurrent.futures
+import errno
+import fcntl
+import ipaddress
+import os
+import stat
+import struct
+import threading
+import time
+
+# Local imports
+import mtda.constants as CONSTS
+from mtda.storage.helpers.image import BLKZEROOUT, punch_hole
+
+# discard a range of a block device (see linux/fs.h)
+BLKDISCARD = 0x1277
+
+# handshake (see doc/proto.md of the NBD project)
+NBDMAGIC = 0x4e42444d41474943
+IHAVEOPT = 0x49484156454f5054
+REPLYMAGIC = 0x3e889045565a9
+FLAG_FIXED_NEWSTYLE = 1 << 0
+FLAG_NO_ZEROES = 1 << 1
+OPT_EXPORT_NAME = 1
+OPT_ABORT = 2
+OPT_LIST = 3
+OPT_INFO = 6
+OPT_GO = 7
+OPT_STRUCTURED_REPLY = 8
+REP_ACK = 1
+REP_SERVER = 2
+REP_INFO = 3
+REP_ERR_UNSUP = (1 << 31) + 1
+REP_ERR_INVALID = (1 << 31) + 3
+REP_ERR_UNKNOWN = (1 << 31) + 6
+INFO_EXPORT = 0
+MAX_OPTION_SIZE = 4096
+
+# transmission
+TRANSMISSION_FLAGS = ((1 << 0) |  # HAS_FLAGS
+                      (1 << 2) |  # SEND_FLUSH
+                      (1 << 3) |  # SEND_FUA
+                      (1 << 5) |  # SEND_TRIM
+                      (1 << 6) |  # SEND_WRITE_ZEROES
+                      (1 << 8))   # CAN_MULTI_CONN
+REQUEST = struct.Struct('>IHHQQI')
+REQUEST_MAGIC = 0x25609513
+SIMPLE_REPLY = struct.Struct('>IIQ')
+SIMPLE_MAGIC = 0x67446698
+CHUNK = struct.Struct('>IHHQI')
+CHUNK_MAGIC = 0x668e33ef
+CMD_READ = 0
+CMD_WRITE = 1
+CMD_DISC = 2
+CMD_FLUSH = 3
+CMD_TRIM = 4
+CMD_WRITE_ZEROES = 6
+CMD_FLAG_FUA = 1 << 0
+CMD_FLAG_NO_HOLE = 1 << 1
+REPLY_FLAG_DONE = 1 << 0
+REPLY_TYPE_NONE = 0
+REPLY_TYPE_OFFSET_DATA = 1
+REPLY_TYPE_ERROR = (1 << 15) + 1
+
+# errors that may be sent to clients (others are reported as EIO)
+ERRORS = {errno.EPERM, errno.EIO, errno.ENOMEM, errno.EINVAL, errno.ENOSPC,
+          errno.EOVERFLOW, errno.ENOTSUP, errno.ESHUTDOWN}
+
+
+def allow_list(path=CONSTS.NBD.ALLOW_FILE):
+    """
+    Get hosts or networks allowed to connect from a file (one per line as
+    for nbd-server), None if the file does not exist (all hosts allowed)
+    """
+    if os.path.exists(path) is False:
+        return None
+    with open(path) as f:
+        return [line.strip() for line in f
+                if line.strip() and not line.startswith('#')]
+
+
+class NBDServer:
+    """
+    Export a file or block device with the NBD protocol (fixed newstyle
+    handshake). The server runs an asyncio loop in a thread of its own:
+    several clients may be connected and requests of each client may
+    complete out of order (their I/O is done on a pool of threads).
+    Structured replies are used when negotiated by the client. TRIM and
+    WRITE_ZEROES requests are passed down to the storage (discarded or
+    zeroed ranges of block devices, holes punched in files). Counters of
+    requests served are available from stats().
+    """
+
+    def __init__(self, mtda, path, name=CONSTS.NBD.EXPORT,
+                 port=CONSTS.NBD.PORT, allow=None):
+        self.mtda = mtda
+        self._allow = None
+        if allow is not None:
+            self._allow = [ipaddress.ip_network(a, strict=False)
+                           for a in allow]
+        self._blkdev = False
+        self._clients = 0
+        self._fd = None
+        self._loop = None
+        self._name = name
+        self._path = path
+        self._pool = None
+        self._port = port
+        self._server = None
+        self._size = 0
+        self._started = None
+        self._stats = dict.fromkeys(['connections', 'reads', 'read_bytes',
+                                     'writes', 'written_bytes', 'flushes',
+                                     'trims', 'zeroes', 'errors'], 0)
+        self._thread = None
+
+    def start(self):
+        """ Open the exported storage and accept clients """
+        self.mtda.debug(3, "storage.nbd.start()")
+
+        self._fd = os.open(self._path, os.O_RDWR)
+        try:
+            self._size = os.lseek(self._fd, 0, os.SEEK_END)
+            self._blkdev = stat.S_ISBLK(os.fstat(self._fd).st_mode)
+            self._pool = concurrent.futures.ThreadPoolExecutor(
+                CONSTS.NBD.QUEUE_DEPTH, thread_name_prefix='nbd')
+            self._loop = asyncio.new_event_loop()
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._serve, None, self._port))
+        except Exception:
+            self._cleanup()
+            raise
+        self._started = time.monotonic()
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        daemon=True, name='storage.nbd')
+        self._thread.start()
+
+        self.mtda.debug(3, "storage.nbd.start(): exporting "
+                           f"{self._path} ({self._size} bytes)")
+
+    def stop(self):
+        """ Disconnect clients and close the exported storage """
+        self.mtda.debug(3, "storage.nbd.stop()")
+
+        loop = self._loop
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join()
+        self._thread = None
+        self._cleanup()
+
+    def stats(self):
+        """ Get counters of requests served since the server was started """
+        result = dict(self._stats)
+        result['clients'] = self._clients
+        result['uptime'] = 0.0
+        if self._started is not None:
+            result['uptime'] = time.monotonic() - self._started
+        return result
+
+    def _cleanup(self):
+        if self._pool is not None:
+            # wait for pending I/O before the storage gets closed
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        if self._loop is not None:
+            self._loop.close()
+            self._loop = None
+        if self._fd is not None:
+            try:
+                os.fsync(self._fd)
+            finally:
+                os.close(self._fd)
+                self._fd = None
+
+    async def _shutdown(self):
+        self._server.close()
+        tasks = [t for t in asyncio.all_tasks()
+                 if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self._server.wait_closed()
+
+    def _allowed(self, host):
+        if self._allow is None:
+            return True
+        address = ipaddress.ip_address(host.split('%')[0])
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        return any(address in network for network in self._allow)
+
+    def _exported(self, name):
+        # an empty name is for the default export
+        return name in ('', self._name)
+
+    async def _serve(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        try:
+            if self._allowed(peer[0]) is False:
+                self.mtda.debug(1, f"storage.nbd: {peer[0]} not allowed")
+                return
+            structured = await self._negotiate(reader, writer)
+            if structured is not None:
+                self.mtda.debug(2, f"storage.nbd: {peer[0]} connected")
+                self._stats['connections'] += 1
+                self._clients += 1
+                try:
+                    await self._transmit(reader, writer, structured)
+                finally:
+                    self._clients -= 1
+                self.mtda.debug(2, f"storage.nbd: {peer[0]} disconnected")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # client went away
+            pass
+        except asyncio.CancelledError:
+            # server stopping
+            pass
+        except Exception as e:
+            self.mtda.debug(1, f"storage.nbd: {peer[0]}: {e}")
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _option_reply(writer, option, reply, data=b''):
+        writer.write(struct.pack('>QIII', REPLYMAGIC, option, reply,
+                                 len(data)) + data)
+
+    async def _negotiate(self, reader, writer):
+        """
+        Get whether structured replies were negotiated by the client, None
+        if it did not select our export
+        """
+        writer.write(struct.pack('>QQH', NBDMAGIC, IHAVEOPT,
+                                 FLAG_FIXED_NEWSTYLE | FLAG_NO_ZEROES))
+        await writer.drain()
+        flags, = struct.unpack('>I', await reader.readexactly(4))
+        structured = False
+
+        while True:
+            magic, option, length = struct.unpack(
+                '>QII', await reader.readexactly(16))
+            if magic != IHAVEOPT or length > MAX_OPTION_SIZE:
+                return None
+            data = await reader.readexactly(length)
+
+            if option == OPT_EXPORT_NAME:
+                if self._exported(data.decode(errors='replace')) is False:
+                    return None
+                writer.write(struct.pack('>QH', self._size,
+                                         TRANSMISSION_FLAGS))
+                if not flags & FLAG_NO_ZEROES:
+                    writer.write(bytes(124))
+                await writer.drain()
+                return structured
+            elif option == OPT_ABORT:
+                self._option_reply(writer, option, REP_ACK)
+                await writer.drain()
+                return None
+            elif option == OPT_LIST:
+                name = self._name.encode()
+                self._option_reply(writer, option, REP_SERVER,
+                                   struct.pack('>I', len(name)) + name)
+                self._option_reply(writer, option, REP_ACK)
+            elif option in (OPT_INFO, OPT_GO):
+                size = struct.unpack_from('>I', data)[0] if length >= 4 else 0
+                if length < 6 + size or \
+                   length != 6 + size + 2 * struct.unpack_from(
+                       '>H', data, 4 + size)[0]:
+                    self._option_reply(writer, option, REP_ERR_INVALID)
+                elif self._exported(data[4:4 + size].decode(
+                        errors='replace')) is False:
+                    self._option_reply(writer, option, REP_ERR_UNKNOWN)
+                else:
+                    self._option_reply(writer, option, REP_INFO,
+                                       struct.pack('>HQH', INFO_EXPORT,
+                                                   self._size,
+                                                   TRANSMISSION_FLAGS))
+                    self._option_reply(writer, option, REP_ACK)
+                    if option == OPT_GO:
+                        await writer.drain()
+                        return structured
+            elif option == OPT_STRUCTURED_REPLY:
+                if length > 0:
+                    self._option_reply(writer, option, REP_ERR_INVALID)
+                else:
+                    structured = True
+                    self._option_reply(writer, option, REP_ACK)
+            else:
+                self._option_reply(writer, option, REP_ERR_UNSUP)
+            await writer.drain()
+
+    async def _transmit(self, reader, writer, structured):
+        depth = asyncio.Semaphore(CONSTS.NBD.QUEUE_DEPTH)
+        pending = set()
+        try:
+            while True:
+                magic, flags, cmd, cookie, offset, length = REQUEST.unpack(
+                    await reader.readexactly(REQUEST.size))
+                if magic != REQUEST_MAGIC or cmd == CMD_DISC:
+                    break
+                data = None
+                if cmd == CMD_WRITE:
+                    if length > CONSTS.NBD.MAX_REQUEST:
+                        # we would lose track of requests
+                        raise IOError(f'write of {length} bytes refused')
+                    data = await reader.readexactly(length)
+                await depth.acquire()
+                task = asyncio.ensure_future(self._request(
+                    writer, structured, flags, cmd, cookie, offset, length,
+                    data))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                task.add_done_callback(lambda _: depth.release())
+        finally:
+            # complete requests that were received
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _request(self, writer, structured, flags, cmd, cookie, offset,
+                       length, data):
+        loop = asyncio.get_running_loop()
+        error = 0
+        result = None
+        try:
+            result = await loop.run_in_executor(
+                self._pool, self._execute, flags, cmd, offset, length, data)
+        except OSError as e:
+            self.mtda.debug(2, f"storage.nbd: request {cmd} at {offset} "
+                               f"({length} bytes) failed: {e}")
+            error = e.errno if e.errno in ERRORS else errno.EIO
+
+        if error != 0:
+            self._stats['errors'] += 1
+        elif cmd == CMD_READ:
+            self._stats['reads'] += 1
+            self._stats['read_bytes'] += length
+        elif cmd == CMD_WRITE:
+            self._stats['writes'] += 1
+            self._stats['written_bytes'] += length
+        elif cmd == CMD_FLUSH:
+            self._stats['flushes'] += 1
+        elif cmd == CMD_TRIM:
+            self._stats['trims'] += 1
+        elif cmd == CMD_WRITE_ZEROES:
+            self._stats['zeroes'] += 1
+
+        # header and data are written together (no await in-between)
+        if structured is False:
+            writer.write(SIMPLE_REPLY.pack(SIMPLE_MAGIC, error, cookie))
+            if error == 0 and result:
+                writer.write(result)
+        elif error != 0:
+            writer.write(CHUNK.pack(CHUNK_MAGIC, REPLY_FLAG_DONE,
+                                    REPLY_TYPE_ERROR, cookie, 6) +
+                         struct.pack('>IH', error, 0))
+        elif result:
+            writer.write(CHUNK.pack(CHUNK_MAGIC, REPLY_FLAG_DONE,
+                                    REPLY_TYPE_OFFSET_DATA, cookie,
+                                    8 + len(result)) +
+                         struct.pack('>Q', offset))
+            writer.write(result)
+        else:
+            writer.write(CHUNK.pack(CHUNK_MAGIC, REPLY_FLAG_DONE,
+                                    REPLY_TYPE_NONE, cookie, 0))
+        await writer.drain()
+
+    def _execute(self, flags, cmd, offset, length, data):
+        """ Execute a request (from the pool), returns data to be sent """
+        fd = self._fd
+        if offset + length > self._size:
+            if cmd in (CMD_WRITE, CMD_WRITE_ZEROES):
+                raise OSError(errno.ENOSPC, 'write past the end')
+            raise OSError(errno.EINVAL, 'request past the end')
+
+        if cmd == CMD_READ:
+            if length > CONSTS.NBD.MAX_REQUEST:
+                raise OSError(errno.EINVAL, 'request too large')
+            result = os.pread(fd, length, offset)
+            if len(result) != length:
+                raise OSError(errno.EIO, 'short read')
+            return result
+        elif cmd == CMD_WRITE:
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(fd, view, offset)
+                view = view[written:]
+                offset += written
+        elif cmd == CMD_FLUSH:
+            os.fdatasync(fd)
+        elif cmd == CMD_TRIM:
+            try:
+                self._discard(offset, length)
+            except OSError as e:
+                # trimming is only advisory
+                if e.errno not in (errno.ENOTSUP, errno.EOPNOTSUPP):
+                    raise
+        elif cmd == CMD_WRITE_ZEROES:
+            self._zero(offset, length, flags & CMD_FLAG_NO_HOLE)
+        else:
+            raise OSError(errno.EINVAL, f'unknown command {cmd}')
+
+        if flags & CMD_FLAG_FUA and cmd in (CMD_WRITE, CMD_WRITE_ZEROES):
+            os.fdatasync(fd)
+        return None
+
+    def _discard(self, offset, size):
+        if size == 0:
+            return
+        if self._blkdev is True:
+            fcntl.ioctl(self._fd, BLKDISCARD, struct.pack('QQ', offset, size))
+        else:
+            punch_hole(self._fd, offset, size)
+
+    def _zero(self, offset, size, allocate):
+        if size == 0:
+            return
+        if self._blkdev is True:
+            fcntl.ioctl(self._fd, BLKZEROOUT, struct.pack('QQ', offset, size))
+        elif allocate:
+            zeroes = bytes(min(size, CONSTS.WRITER.ZERO_BLOCK_SIZE))
+            end = offset + size
+            while offset < end:
+                offset += os.pwrite(self._fd, zeroes[:end - offset], offset)
+        else:
+            punch_hole(self._fd, offset, size)
@@ -10,7 +10,9 @@
 # ---------------------------------------------------------------------------
 
 # System imports
+import json
 import os
+import re
 import subprocess
 
 # Local imports
@@ -102,7 +104,7 @@ class QemuController(Image):
         self.lock.release()
         return result
 
-    def commit(self):
+    def commit(self, progress=None):
         if self.cow:
             cmd = ['qemu-img', 'commit', self.cow]
             subprocess.check_call(cmd)
@@ -110,12 +112,110 @@ class QemuController(Image):
     def rollback(self):
         if self.cow:
             cmd = ['qemu-img', 'create', '-F', 'raw', '-f', 'qcow2',
-                   '-b', self.file, self.cow, f'{self.size}M']
+                   '-b', self.file, self.cow, f'{int(self.size / 1024**2)}M']
             subprocess.check_call(cmd)
 
+    def _check_snapshot(self, name=None):
+        if self.cow is None:
+            raise FileNotFoundError('no CoW device was configured!')
+        if name is not None and re.fullmatch(r'[\w.-]+', name) is None:
+            raise ValueError(f"invalid snapshot name '{name}'")
+
+    def _monitor(self, *args):
+        """ Run a command from the qemu monitor (no output if successful) """
+        output = self.qemu.command(list(args)).strip()
+        if output:
+            raise RuntimeError(output)
+
+    def _snapshots(self):
+        # the image may be in use by qemu
+        cmd = ['qemu-img', 'info', '--output=json', '-U', self.cow]
+        info = json.loads(subprocess.check_output(cmd, text=True))
+        return [s['name'] for s in info.get('snapshots', [])]
+
+    def snapshots(self):
+        """ Get names of internal snapshots of the CoW image """
+        self.mtda.debug(3, "storage.qemu.snapshots()")
+
+        self._check_snapshot()
+        with self.lock:
+            result = []
+            if os.path.exists(self.cow):
+                result = self._snapshots()
+
+        self.mtda.debug(3, f"storage.qemu.snapshots(): {result}")
+        return result
+
+    def snapshot(self, name):
+        """
+        Take an internal snapshot of the CoW image: through the monitor of
+        qemu when the storage is attached to the target
+        """
+        self.mtda.debug(3, f"storage.qemu.snapshot({name})")
+
+        self._check_snapshot(name)
+        with self.lock:
+            if self.id is not None:
+                self._monitor('snapshot_blkdev_internal', self.name, name)
+            else:
+                if not os.path.exists(self.cow):
+                    self.rollback()
+                cmd = ['qemu-img', 'snapshot', '-c', name, self.cow]
+                subprocess.check_call(cmd)
+            result = True
+
+        self.mtda.debug(3, f"storage.qemu.snapshot(): {result}")
+        return result
+
+    def delete_snapshot(self, name):
+        self.mtda.debug(3, f"storage.qemu.delete_snapshot({name})")
+
+        self._check_snapshot(name)
+        with self.lock:
+            if self.id is not None:
+                self._monitor('snapshot_delete_blkdev_internal', self.name,
+                              name)
+            else:
+                cmd = ['qemu-img', 'snapshot', '-d', name, self.cow]
+                subprocess.check_call(cmd)
+            result = True
+
+        self.mtda.debug(3, f"storage.qemu.delete_snapshot(): {result}")
+        return result
+
+    def revert(self, name):
+        """
+        Revert the CoW image to an internal snapshot. qemu cannot revert a
+        single drive: the storage is unplugged from the target while it is
+        being reverted
+        """
+        self.mtda.debug(3, f"storage.qemu.revert({name})")
+
+        self._check_snapshot(name)
+        with self.lock:
+            if os.path.exists(self.cow) is False or \
+               name not in self._snapshots():
+                raise ValueError(f"no snapshot named '{name}'")
+            attached = self.id is not None
+            if attached and self._rm() is False:
+                raise RuntimeError('usb storage could not be removed!')
+            try:
+                cmd = ['qemu-img', 'snapshot', '-a', name, self.cow]
+                subprocess.check_call(cmd)
+            finally:
+                if attached:
+                    self._add()
+            result = True
+
+        self.mtda.debug(3, f"storage.qemu.revert(): {result}")
+        return result
+
     def supports_hotplug(self):
         return True
 
+    def _has_cow(self):
+        return self.cow is not None
+
     """ Attach the shared storage device to the host"""
     def to_host(self):
         self.mtda.debug(3, "storage.qemu.to_host()")
@@ -23,6 +23,8 @@ class SamsungSdMuxStorageController(Image):
         super().__init__(mtda)
         self.file = "/dev/sda"
         self.serial = None
+        # only the agent is expected to switch the sdmux
+        self._mode = None
 
     """ Configure this storage controller from the provided configuration"""
     def configure(self, conf):
@@ -49,6 +51,7 @@ class SamsungSdMuxStorageController(Image):
     def probe(self):
         self.mtda.debug(3, "storage.samsung.probe()")
 
+        self._mode = None
         result = True
         try:
             subprocess.check_output([
@@ -71,6 +74,7 @@ class SamsungSdMuxStorageController(Image):
             ])
         except subprocess.CalledProcessError:
             result = False
+        self._mode = CONSTS.STORAGE.ON_HOST if result else None
 
         self.mtda.debug(3, f"storage.samsung.to_host(): {str(result)}")
         return result
@@ -90,6 +94,7 @@ class SamsungSdMuxStorageController(Image):
                 ])
             except subprocess.CalledProcessError:
                 result = False
+            self._mode = CONSTS.STORAGE.ON_TARGET if result else None
 
         self.mtda.debug(3, f"storage.samsung.to_target(): {str(result)}")
         self.lock.release()
@@ -99,21 +104,26 @@ class SamsungSdMuxStorageController(Image):
     def _status(self):
         self.mtda.debug(3, "storage.samsung.status()")
 
-        try:
-            status = subprocess.check_output([
-                "sd-mux-ctrl", "-e", self.serial, "-u"
-            ]).decode("utf-8").splitlines()
-            result = CONSTS.STORAGE.UNKNOWN
-            for s in status:
-                if s == "SD connected to: TS":
-                    result = CONSTS.STORAGE.ON_HOST
-                    break
-                elif s == "SD connected to: DUT":
-                    result = CONSTS.STORAGE.ON_TARGET
-                    break
-        except subprocess.CalledProcessError:
-            self.mtda.debug(1, "storage.samsung.status(): sd-mux-ctrl failed!")
-            result = CONSTS.STORAGE.UNKNOWN
+        result = self._mode
+        if result is None:
+            try:
+                status = subprocess.check_output([
+                    "sd-mux-ctrl", "-e", self.serial, "-u"
+                ]).decode("utf-8").splitlines()
+                result = CONSTS.STORAGE.UNKNOWN
+                for s in status:
+                    if s == "SD connected to: TS":
+                        result = CONSTS.STORAGE.ON_HOST
+                        break
+                    elif s == "SD connected to: DUT":
+                        result = CONSTS.STORAGE.ON_TARGET
+                        break
+            except subprocess.CalledProcessError:
+                self.mtda.debug(1, "storage.samsung.status(): "
+                                   "sd-mux-ctrl failed!")
+                result = CONSTS.STORAGE.UNKNOWN
+            if result != CONSTS.STORAGE.UNKNOWN:
+                self._mode = result
 
         self.mtda.debug(3, f"storage.samsung.status(): {str(result)}")
         return result
@@ -0,0 +1,454 @@
+# ---------------------------------------------------------------------------
+# Split compressed images into independently decodable blocks
+# ---------------------------------------------------------------------------
+#
+# This software is a part of MTDA.
+# Copyright (C) 2025 Siemens AG
+#
+# ---------------------------------------------------------------------------
+# SPDX-License-Identifier: MIT
+# ---------------------------------------------------------------------------
+
+# System imports
+import abc
+import bz2
+import lzma
+import zlib
+
+
+class NotSplittable(Exception):
+    """
+    Raised when blocks of a compressed stream cannot be found, data
+    received so far is provided to be decompressed sequentially
+    """
+
+    def __init__(self, data):
+        super().__init__('blocks cannot be found')
+        self.data = data
+
+
+class BlockSplitter(object):
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def feed(self, data):
+        """ Get blocks (jobs) completed with the provided data"""
+
+    @abc.abstractmethod
+    def finish(self):
+        """ Check that the compressed stream was complete"""
+
+    @abc.abstractmethod
+    def decode(self, job):
+        """ Decompress a block"""
+
+    @abc.abstractmethod
+    def size(self, job):
+        """ Estimate the size of a decompressed block"""
+
+
+class XzSplitter(BlockSplitter):
+    """
+    Split xz streams into blocks: blocks written by multi-threaded encoders
+    (xz -T) have their sizes in their headers. Each block is decoded along
+    with the stream header as the index is not needed to decode blocks.
+    Blocks without sizes are decoded sequentially as they are received,
+    their end is only found once decoded.
+    """
+
+    MAGIC = b'\xfd7zXZ\x00'
+    # data decoded at once from blocks without sizes
+    READ_SIZE = 1024**2
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._blocks = 0
+        self._check = 0
+        self._header = None
+        self._pos = 0
+        self._records = []
+        self._sequential = None
+        self._state = self._stream_header
+
+    @staticmethod
+    def _vli(buf, pos):
+        """ Decode a variable-length integer, IndexError if incomplete """
+        result = 0
+        for i in range(9):
+            byte = buf[pos + i]
+            result |= (byte & 0x7f) << (7 * i)
+            if byte & 0x80 == 0:
+                return result, pos + i + 1
+        raise ValueError('invalid integer in xz stream!')
+
+    def feed(self, data):
+        """ Get blocks completed with the provided data as they are found """
+        self._buf += data
+        more = True
+        while more is True:
+            jobs = []
+            more = self._state(jobs)
+            yield from jobs
+        # drop data that was processed
+        del self._buf[:self._pos]
+        self._pos = 0
+
+    def finish(self):
+        if self._state != self._stream_padding or len(self._buf) > 0:
+            raise ValueError('truncated xz stream!')
+
+    def decode(self, job):
+        header, block, size = job
+        if header is None:
+            # decoded sequentially
+            return block
+        data = lzma.LZMADecompressor(lzma.FORMAT_XZ).decompress(header + block)
+        if size is not None and len(data) != size:
+            raise ValueError(f'xz block has {len(data)} bytes instead of '
+                             f'{size}!')
+        return data
+
+    def size(self, job):
+        header, block, size = job
+        if size is None:
+            return len(block)
+        return size
+
+    def _available(self):
+        return len(self._buf) - self._pos
+
+    def _stream_header(self, jobs):
+        if self._available() < 12:
+            return False
+        header = bytes(self._buf[self._pos:self._pos + 12])
+        if header[:6] != self.MAGIC:
+            raise ValueError('not a xz stream!')
+        if zlib.crc32(header[6:8]) != int.from_bytes(header[8:], 'little'):
+            raise ValueError('corrupted xz stream header!')
+        check = header[7] & 0x0f
+        self._check = 0 if check == 0 else 4 << ((check - 1) // 3)
+        self._header = header
+        self._records = []
+        self._pos += 12
+        self._state = self._block
+        return True
+
+    def _block(self, jobs):
+        if self._available() < 1:
+            return False
+        if self._buf[self._pos] == 0:
+            self._state = self._index
+            return True
+        hsize = (self._buf[self._pos] + 1) * 4
+        if self._available() < hsize:
+            return False
+        flags = self._buf[self._pos + 1]
+        if flags & 0x40 == 0:
+            # single-threaded encoders do not store sizes
+            if self._blocks == 0:
+                raise NotSplittable(self._header +
+                                    bytes(self._buf[self._pos:]))
+            self._start_sequential(hsize)
+            return True
+        csize, pos = self._vli(self._buf, self._pos + 2)
+        usize = None
+        if flags & 0x80:
+            usize, pos = self._vli(self._buf, pos)
+        total = hsize + csize + (-csize % 4) + self._check
+        if self._available() < total:
+            return False
+        block = bytes(self._buf[self._pos:self._pos + total])
+        jobs.append((self._header, block, usize))
+        self._records.append((hsize + csize + self._check, usize))
+        self._blocks += 1
+        self._pos += total
+        return True
+
+    def _filters(self, header):
+        """ Get the filter chain of a block from its header """
+        result = []
+        pos = 2
+        flags = header[1]
+        if flags & 0x40:
+            _, pos = self._vli(header, pos)
+        if flags & 0x80:
+            _, pos = self._vli(header, pos)
+        for _ in range((flags & 0x03) + 1):
+            id, pos = self._vli(header, pos)
+            size, pos = self._vli(header, pos)
+            props = header[pos:pos + size]
+            pos += size
+            if id == lzma.FILTER_LZMA2 and size == 1:
+                bits = props[0] & 0x3f
+                if bits == 40:
+                    dict_size = 0xffffffff
+                else:
+                    dict_size = (2 | (bits & 1)) << (bits // 2 + 11)
+                result.append({'id': id, 'dict_size': dict_size})
+            elif id == lzma.FILTER_DELTA and size == 1:
+                result.append({'id': id, 'dist': props[0] + 1})
+            elif id in [lzma.FILTER_X86, lzma.FILTER_POWERPC,
+                        lzma.FILTER_IA64, lzma.FILTER_ARM,
+                        lzma.FILTER_ARMTHUMB, lzma.FILTER_SPARC]:
+                spec = {'id': id}
+                if size > 0:
+                    spec['start_offset'] = int.from_bytes(props, 'little')
+                result.append(spec)
+            else:
+                raise ValueError(f'unsupported xz filter {id:#x}!')
+        return result
+
+    def _start_sequential(self, hsize):
+        """ Decode a block without sizes as it gets received """
+        header = bytes(self._buf[self._pos:self._pos + hsize])
+        decoder = lzma.LZMADecompressor(lzma.FORMAT_RAW,
+                                        filters=self._filters(header))
+        # the stream decoder checks the block as data gets decoded
+        checker = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+        self._sequential = [decoder, checker, hsize, 0, 0, b'']
+        self._verify(self._header + header)
+        self._pos += hsize
+        self._state = self._decode
+
+    def _verify(self, data):
+        """ Feed data of a block decoded sequentially to its checker """
+        checker = self._sequential[1]
+        try:
+            checker.decompress(data, self.READ_SIZE)
+            while checker.needs_input is False:
+                checker.decompress(b'', self.READ_SIZE)
+        except lzma.LZMAError as e:
+            raise ValueError(f'corrupted xz block: {e}!')
+
+    def _decode(self, jobs):
+        state = self._sequential
+        decoder = state[0]
+        data = b''
+        if decoder.needs_input is True:
+            if self._available() == 0:
+                return False
+            # the previous input was consumed
+            self._verify(state[5])
+            data = bytes(self._buf[self._pos:])
+            self._pos = len(self._buf)
+            state[3] += len(data)
+            state[5] = data
+        try:
+            decoded = decoder.decompress(data, self.READ_SIZE)
+        except lzma.LZMAError as e:
+            raise ValueError(f'corrupted xz block: {e}!')
+        if decoded:
+            state[4] += len(decoded)
+            jobs.append((None, decoded, None))
+        if decoder.eof is True:
+            # give back data following the block
+            unused = decoder.unused_data
+            if unused:
+                self._verify(state[5][:-len(unused)])
+            else:
+                self._verify(state[5])
+            self._buf[self._pos:self._pos] = unused
+            state[3] -= len(unused)
+            self._state = self._decoded
+        return True
+
+    def _decoded(self, jobs):
+        """ Check the end of a block decoded sequentially """
+        _, _, hsize, csize, usize, _ = self._sequential
+        size = -csize % 4 + self._check
+        if self._available() < size:
+            return False
+        self._verify(bytes(self._buf[self._pos:self._pos + size]))
+        self._records.append((hsize + csize + self._check, usize))
+        self._blocks += 1
+        self._pos += size
+        self._sequential = None
+        self._state = self._block
+        return True
+
+    def _index(self, jobs):
+        start = self._pos
+        try:
+            count, pos = self._vli(self._buf, start + 1)
+            records = []
+            for _ in range(count):
+                unpadded, pos = self._vli(self._buf, pos)
+                uncompressed, pos = self._vli(self._buf, pos)
+                records.append((unpadded, uncompressed))
+        except IndexError:
+            return False
+        pos += -(pos - start) % 4
+        if len(self._buf) < pos + 4:
+            return False
+        crc = int.from_bytes(self._buf[pos:pos + 4], 'little')
+        if zlib.crc32(self._buf[start:pos]) != crc:
+            raise ValueError('corrupted xz index!')
+        if len(records) != len(self._records):
+            raise ValueError('xz index does not match blocks!')
+        for (unpadded, uncompressed), (size, usize) in zip(records,
+                                                           self._records):
+            if unpadded != size or usize not in [None, uncompressed]:
+                raise ValueError('xz index does not match blocks!')
+        self._pos = pos + 4
+        self._state = self._stream_footer
+        return True
+
+    def _stream_footer(self, jobs):
+        if self._available() < 12:
+            return False
+        if self._buf[self._pos + 10:self._pos + 12] != b'YZ':
+            raise ValueError('corrupted xz stream footer!')
+        self._pos += 12
+        self._state = self._stream_padding
+        return True
+
+    def _stream_padding(self, jobs):
+        # streams may be concatenated and padded with null bytes
+        if self._available() >= 4 and \
+           self._buf[self._pos:self._pos + 4] == bytes(4):
+            self._pos += 4
+            return True
+        if self._available() < len(self.MAGIC):
+            return False
+        self._state = self._stream_header
+        return True
+
+
+class Bz2Splitter(BlockSplitter):
+    """
+    Split bz2 streams into blocks: blocks start with a 48-bit magic number
+    which is not aligned on bytes. Each block is decoded as a stream of its
+    own. The magic number may be found in compressed data: blocks failing to
+    decode should then be merged with the next block.
+    """
+
+    BLOCK_MAGIC = 0x314159265359
+    EOS_MAGIC = 0x177245385090
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._block = None
+        self._eos = False
+        self._level = None
+        self._scan = 0
+        self._needles = [(magic, self._needles_for(magic))
+                         for magic in [self.BLOCK_MAGIC, self.EOS_MAGIC]]
+
+    @staticmethod
+    def _needles_for(magic):
+        """ Bytes found in data for each bit offset of the magic number """
+        result = []
+        for shift in range(8):
+            window = (magic << (8 - shift)).to_bytes(7, 'big')
+            if shift == 0:
+                result.append((window[0:6], 0))
+            else:
+                result.append((window[1:6], 1))
+        return result
+
+    def _bits(self, pos, count):
+        start = pos // 8
+        end = (pos + count + 7) // 8
+        value = int.from_bytes(self._buf[start:end], 'big')
+        return (value >> (end * 8 - pos - count)) & ((1 << count) - 1)
+
+    def _find(self, first):
+        """ Find the first magic number from the specified bit """
+        result = None
+        for magic, needles in self._needles:
+            for shift, (needle, lead) in enumerate(needles):
+                index = self._scan
+                while True:
+                    index = self._buf.find(needle, index)
+                    if index < 0:
+                        break
+                    pos = (index - lead) * 8 + shift
+                    if result is not None and pos >= result[0]:
+                        break
+                    if pos >= first and pos + 48 <= len(self._buf) * 8 \
+                       and self._bits(pos, 48) == magic:
+                        result = (pos, magic)
+                        break
+                    index += 1
+        return result
+
+    def feed(self, data):
+        self._buf += data
+        jobs = []
+        while self._step(jobs) is True:
+            pass
+        return jobs
+
+    def _step(self, jobs):
+        if self._level is None:
+            # stream header followed by a block or the end of the stream
+            if len(self._buf) < 10:
+                return False
+            if self._buf[:3] != b'BZh' or self._buf[3] not in b'123456789':
+                raise ValueError('not a bz2 stream!')
+            magic = self._bits(32, 48)
+            if magic not in [self.BLOCK_MAGIC, self.EOS_MAGIC]:
+                raise ValueError('corrupted bz2 stream!')
+            self._level = bytes(self._buf[:4])
+            self._block = 32
+            self._eos = magic == self.EOS_MAGIC
+            self._scan = 4
+            return True
+
+        if self._eos is True:
+            # stream footer (magic and combined CRC) padded to a byte
+            end = (self._block + 48 + 32 + 7) // 8
+            if len(self._buf) < end:
+                return False
+            del self._buf[:end]
+            self._level = None
+            return len(self._buf) > 0
+
+        found = self._find(self._block + 48)
+        if found is None:
+            # search again in bytes that might hold part of a magic number
+            self._scan = max(self._block // 8, len(self._buf) - 7)
+            return False
+
+        pos, magic = found
+        start = self._block // 8
+        end = (pos + 7) // 8
+        jobs.append((self._level, bytes(self._buf[start:end]),
+                     self._block % 8, pos - self._block))
+        # drop data of emitted blocks
+        drop = pos // 8
+        del self._buf[:drop]
+        self._block = pos - drop * 8
+        self._scan = 0
+        self._eos = magic == self.EOS_MAGIC
+        return True
+
+    def finish(self):
+        if self._level is not None or len(self._buf) > 0:
+            raise ValueError('truncated bz2 stream!')
+
+    def size(self, job):
+        # blocks hold up to 100k bytes per level before their runs of
+        # bytes are encoded
+        return int(job[0][3:]) * 100000
+
+    def decode(self, job):
+        level, data, shift, count = job
+        value = int.from_bytes(data, 'big')
+        value >>= len(data) * 8 - shift - count
+        value &= (1 << count) - 1
+        # end the stream after this block: the combined CRC of a stream
+        # with a single block is the CRC of that block
+        crc = (value >> (count - 80)) & 0xffffffff
+        value = (value << 80) | (self.EOS_MAGIC << 32) | crc
+        count += 80
+        pad = -count % 8
+        value <<= pad
+        stream = level + value.to_bytes((count + pad) // 8, 'big')
+        return bz2.decompress(stream)
+
+    def merge(self, job, next_job):
+        level, data, shift, count = job
+        _, next_data, _, next_count = next_job
+        data = data[:(shift + count) // 8] + next_data
+        return (level, data, shift, count + next_count)
@@ -11,6 +11,7 @@
 
 # System imports
 import atexit
+import fcntl
 import os
 import stat
 import subprocess
@@ -19,13 +20,15 @@ import time
 
 # Local imports
 import mtda.constants as CONSTS
-from mtda.storage.helpers.image import Image
+from mtda.storage.helpers.image import BLKFLSBUF, Image
+from mtda.support.dm import DeviceMapper
 from mtda.support.usb import Composite
 from mtda.utils import SystemdDeviceUnit
 
 
 # Local constants
 DM_BASE = "mtda-base"
+DM_CHUNK_SECTORS = 8
 DM_COW = "mtda-cow"
 
 
@@ -40,6 +43,7 @@ class UsbFunctionController(Image):
         self.loop_device = None
         self.file = None
         self.mode = CONSTS.STORAGE.ON_HOST
+        self._dm = DeviceMapper()
         Composite.mtda = mtda
 
     def cleanup(self):
@@ -131,7 +135,7 @@ class UsbFunctionController(Image):
 
         cmd = ['/sbin/dmsetup', 'create', DM_COW, '--table',
                f"0 {self.base_size} snapshot "
-               f"{self.base_device} {self.cow_device} P 8"]
+               f"{self.base_device} {self.cow_device} P {DM_CHUNK_SECTORS}"]
         subprocess.check_call(cmd)
         self.file = f"/dev/mapper/{DM_COW}"
 
@@ -147,76 +151,114 @@ class UsbFunctionController(Image):
         dropin = os.path.join(dir, 'auto-dep-storage-cow.conf')
         SystemdDeviceUnit.create_device_dependency(dropin, self.cow_device)
 
-    def rollback(self):
-        if self.cow_device is None:
-            raise FileNotFoundError('no CoW device was configured!')
+    def _has_cow(self):
+        return self.cow_device is not None
 
-        subprocess.run(['/sbin/kpartx', '-dv', f"/dev/mapper/{DM_COW}"])
-        cmd = ['/sbin/dmsetup', 'remove', DM_COW]
-        subprocess.check_call(cmd)
+    def _snapshot(self, target):
+        return [(0, int(self.base_size), target,
+                 f"{self.base_device} {self.cow_device} P {DM_CHUNK_SECTORS}")]
 
-        cmd = ['/bin/dd', 'if=/dev/zero', f'of={self.cow_device}',
-               'bs=1M', 'count=4', 'conv=fsync']
-        subprocess.check_call(cmd)
+    def _remove_partitions(self, name):
+        """ Remove partition mappings (from kpartx) of a device if any """
+        path = f"/dev/mapper/{name}"
+        if os.path.exists(path) is False:
+            return
+        rdev = os.stat(path).st_rdev
+        holders = f"/sys/dev/block/{os.major(rdev)}:{os.minor(rdev)}/holders"
+        if os.path.isdir(holders) and len(os.listdir(holders)) == 0:
+            return
+        subprocess.run(['/sbin/kpartx', '-dv', path])
 
-        cmd = ['/sbin/dmsetup', 'create', DM_COW, '--table',
-               f"0 {self.base_size} snapshot "
-               f"{self.base_device} {self.cow_device} P 8"]
-        subprocess.check_call(cmd)
+    def _invalidate_cow(self):
+        """ Zero the header of the snapshot for it to start afresh """
+        fd = os.open(self.cow_device, os.O_WRONLY | os.O_SYNC)
+        try:
+            os.pwrite(fd, bytes(DM_CHUNK_SECTORS * 512), 0)
+        finally:
+            os.close(fd)
+
+    def rollback(self):
+        """
+        Discard changes made to the shared storage. The snapshot is swapped
+        out of the CoW device (a snapshot loaded on the same CoW device would
+        take its exceptions over), its header is zeroed and a new snapshot
+        swapped in: no process is forked and no device removed.
+        """
+        self.mtda.debug(3, "storage.usbf.rollback()")
+
+        if self.cow_device is None:
+            raise FileNotFoundError('no CoW device was configured!')
 
-    def commit(self):
+        self._remove_partitions(DM_COW)
+        self._dm.load(DM_COW, [(0, int(self.base_size), 'error', '')])
+        self._dm.resume(DM_COW)
+        self._invalidate_cow()
+        self._dm.load(DM_COW, self._snapshot('snapshot'))
+        self._dm.resume(DM_COW)
+
+        # drop cached data of the discarded snapshot
+        fd = os.open(f"/dev/mapper/{DM_COW}", os.O_RDONLY)
+        try:
+            fcntl.ioctl(fd, BLKFLSBUF)
+        finally:
+            os.close(fd)
+
+        self.mtda.debug(3, "storage.usbf.rollback(): done")
+
+    def commit(self, progress=None):
+        """
+        Merge changes from the CoW device into the base device. The merge
+        is polled every COMMIT_INTERVAL seconds and its progress (merged and
+        total bytes) passed to the progress callback
+        """
         if self.cow_device is None:
             raise FileNotFoundError('no CoW device was configured!')
 
         # Trigger merge
-        cmd = ['/sbin/dmsetup', 'suspend', DM_BASE]
-        subprocess.check_call(cmd)
+        self._dm.suspend(DM_BASE)
 
-        subprocess.run(['/sbin/kpartx', '-dv', f"/dev/mapper/{DM_COW}"])
+        self._remove_partitions(DM_COW)
         cmd = ['/sbin/dmsetup', 'remove', DM_COW]
         subprocess.check_call(cmd)
 
-        cmd = ['/sbin/dmsetup', 'reload', DM_BASE, '--table',
-               f"0 {self.base_size} snapshot-merge "
-               f"{self.base_device} {self.cow_device} P 8"]
-        subprocess.check_call(cmd)
-
-        cmd = ['/sbin/dmsetup', 'resume', DM_BASE]
-        subprocess.check_call(cmd)
+        self._dm.load(DM_BASE, self._snapshot('snapshot-merge'))
+        self._dm.resume(DM_BASE)
 
         # Wait for merge to complete
+        total = None
         while True:
-            cmd = ['/sbin/dmsetup', 'status', DM_BASE]
-            status = subprocess.check_output(cmd, text=True).strip()
-
-            if 'snapshort-merge' not in status:
+            status = self._dm.status(DM_BASE)
+            if len(status) == 0 or status[0][2] != 'snapshot-merge':
                 break
+            status = status[0][3]
+            if status in ('Invalid', 'Merge failed'):
+                raise IOError(f'merge of {self.cow_device} failed!')
 
-            status = status.split()
-            allocated = status[3].split('/')[0]
-            metadata = status[4]
+            usage, metadata = status.split()[:2]
+            allocated = int(usage.split('/')[0])
+            metadata = int(metadata)
 
             self.mtda.debug(4, "storage.usbf.commit(): "
                                f"allocated={allocated}, metadata={metadata}")
+
+            # allocated sectors drop down to metadata sectors while merging
+            if total is None:
+                total = allocated - metadata
+            if progress is not None:
+                merged = total - (allocated - metadata)
+                progress(merged * 512, total * 512)
             if allocated == metadata:
                 break
 
-            time.sleep(1000)
+            time.sleep(CONSTS.STORAGE.COMMIT_INTERVAL)
 
         # Resume CoW device
-        cmd = ['/sbin/dmsetup', 'suspend', DM_BASE]
-        subprocess.check_call(cmd)
-
-        cmd = ['/sbin/dmsetup', 'reload', DM_BASE, '--table',
-               f"0 {self.base_size} snapshot-origin {self.base_device}"]
-        subprocess.check_call(cmd)
-
-        cmd = ['/sbin/dmsetup', 'resume', DM_BASE]
-        subprocess.check_call(cmd)
+        self._dm.reload(DM_BASE, [(0, int(self.base_size), 'snapshot-origin',
+                                   self.base_device)])
 
         cmd = ['/sbin/dmsetup', 'create', DM_COW, '--table',
                f"0 {self.base_size} snapshot "
-               f"{self.base_device} {self.cow_device} P 8"]
+               f"{self.base_device} {self.cow_device} P {DM_CHUNK_SECTORS}"]
         subprocess.check_call(cmd)
 
     """ Get file used by the USB Function driver"""
@@ -288,7 +330,7 @@ class UsbFunctionController(Image):
 
         self.mtda.debug(3, "storage.usbf._open(): "
                            f"opening {path}")
-        self.handle = open(path, "r+b")
+        self.handle = self._open_path(path)
         self.handle.seek(0, 0)
 
         self.mtda.debug(3, f"storage.usbf._open(): {result}")
@@ -18,11 +18,19 @@ from mtda.storage.helpers.image import Image
 
 
 class UsbSdMuxStorageController(Image):
+    """
+    SD card multiplexed between the host and the target with an USB-SD-Mux.
+    The sdmux is controlled with the usbsdmux library (SCSI commands sent
+    from our process) when installed, with the usbsdmux tool otherwise. Its
+    status is cached: only the agent is expected to switch it.
+    """
 
     def __init__(self, mtda):
         super().__init__(mtda)
         self.file = "/dev/sda"
         self.control_device = "/dev/sg0"
+        self._mode = None
+        self._mux = None
 
     """ Configure this storage controller from the provided configuration"""
     def configure(self, conf):
@@ -36,17 +44,43 @@ class UsbSdMuxStorageController(Image):
         self.mtda.debug(3, f"storage.usbsdmux.configure(): {str(result)}")
         return result
 
+    def _control(self):
+        """ Get the sdmux from the usbsdmux library (None if missing) """
+        if self._mux is None:
+            try:
+                from usbsdmux import usbsdmux
+            except ImportError:
+                return None
+            # newer versions also support the USB-SD-Mux FAST
+            driver = getattr(usbsdmux, 'autoselect_driver', usbsdmux.UsbSdMux)
+            self._mux = driver(self.control_device)
+        return self._mux
+
+    def _usbsdmux(self, mode):
+        """ Get or set (host, dut) the mode of the sdmux, None on errors """
+        try:
+            mux = self._control()
+            if mux is None:
+                return subprocess.check_output([
+                    "usbsdmux", self.control_device, mode
+                ]).decode("utf-8")
+            elif mode == "get":
+                return mux.get_mode()
+            elif mode == "host":
+                mux.mode_host()
+            else:
+                mux.mode_DUT()
+            return ""
+        except (OSError, subprocess.CalledProcessError) as e:
+            self.mtda.debug(1, f"storage.usbsdmux: {mode} failed: {e}")
+            return None
+
     """ Check presence of the sdmux"""
     def probe(self):
         self.mtda.debug(3, "storage.usbsdmux.probe()")
 
-        result = True
-        try:
-            subprocess.check_output([
-                "usbsdmux", self.control_device, "get"
-            ])
-        except subprocess.CalledProcessError:
-            result = False
+        self._mode = None
+        result = self._status() != CONSTS.STORAGE.UNKNOWN
 
         self.mtda.debug(3, f"storage.usbsdmux.probe(): {str(result)}")
         return result
@@ -55,13 +89,8 @@ class UsbSdMuxStorageController(Image):
     def to_host(self):
         self.mtda.debug(3, "storage.usbsdmux.to_host()")
 
-        result = True
-        try:
-            subprocess.check_output([
-                "usbsdmux", self.control_device, "host"
-            ])
-        except subprocess.CalledProcessError:
-            result = False
+        result = self._usbsdmux("host") is not None
+        self._mode = CONSTS.STORAGE.ON_HOST if result else None
 
         self.mtda.debug(3, f"storage.usbsdmux.to_host(): {str(result)}")
         return result
@@ -75,12 +104,8 @@ class UsbSdMuxStorageController(Image):
         if result is True:
             result = self._umount()
         if result is True:
-            try:
-                subprocess.check_output([
-                    "usbsdmux", self.control_device, "dut"
-                ])
-            except subprocess.CalledProcessError:
-                result = False
+            result = self._usbsdmux("dut") is not None
+            self._mode = CONSTS.STORAGE.ON_TARGET if result else None
 
         self.mtda.debug(3, f"storage.usbsdmux.to_target(): {str(result)}")
         self.lock.release()
@@ -90,21 +115,19 @@ class UsbSdMuxStorageController(Image):
     def _status(self):
         self.mtda.debug(3, "storage.usbsdmux.status()")
 
-        try:
-            status = subprocess.check_output([
-                "usbsdmux", self.control_device, "get"
-            ]).decode("utf-8").splitlines()
+        result = self._mode
+        if result is None:
             result = CONSTS.STORAGE.UNKNOWN
-            for s in status:
+            status = self._usbsdmux("get")
+            for s in (status or "").splitlines():
                 if s == "host":
                     result = CONSTS.STORAGE.ON_HOST
                     break
                 elif s == "dut":
                     result = CONSTS.STORAGE.ON_TARGET
                     break
-        except subprocess.CalledProcessError:
-            self.mtda.debug(1, "storage.usbsdmux.status(): usbsdmux failed!")
-            result = CONSTS.STORAGE.UNKNOWN
+            if result != CONSTS.STORAGE.UNKNOWN:
+                self._mode = result
 
         self.mtda.debug(3, f"storage.usbsdmux.status(): {str(result)}")
         return result
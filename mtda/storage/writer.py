@@ -9,7 +9,12 @@
 # SPDX-License-Identifier: MIT
 # ---------------------------------------------------------------------------
 
+import base64
 import bz2
+import collections
+import concurrent.futures
+import os
+import queue
 import threading
 import mtda.constants as CONSTS
 import time
@@ -18,6 +23,42 @@ import zstandard as zstd
 import lzma
 
 from mtda.exceptions import RetryException
+from mtda.storage.datastream import Frame
+from mtda.storage.external import ExternalDecompressor
+from mtda.storage.splitter import BlockSplitter, Bz2Splitter, NotSplittable, \
+                                  XzSplitter
+
+
+class WriterStage:
+    """ Statistics of a stage of the write pipeline """
+
+    def __init__(self, name, inbox=None):
+        self.name = name
+        self.busy = 0.0
+        self.inbox = inbox
+
+    @property
+    def depth(self):
+        """
+        Number of items waiting to be processed by this stage (the receive
+        stage reads directly from the data stream and has no inbox)
+        """
+        if self.inbox is None:
+            return 0
+        return self.inbox.qsize()
+
+    def __str__(self):
+        return f'{self.name}={self.depth}/{self.busy:.3f}'
+
+
+class BlockSink:
+    """ File-like object feeding decompressed data to the block writer """
+
+    def __init__(self, writer):
+        self._writer = writer
+
+    def write(self, data):
+        return self._writer.output(data)
 
 
 class AsyncImageWriter:
@@ -26,18 +67,46 @@ class AsyncImageWriter:
         self.mtda = mtda
         self.storage = storage
         self.compression = compression
+        # decompress with external (multi-threaded) tools when available
+        self.external = False
+        # start writeback of written data every so many bytes (0: never)
+        self.sync_interval = 0
         self._blksz = CONSTS.WRITER.WRITE_SIZE
+        self._blocks = None
+        self._checkpoint = 0
+        self._chunks = None
+        # bytes consumed from the data stream (see credits())
+        self._consumed = 0
+        self._crediting = False
+        # estimated size of blocks being decoded (see _split())
+        self._decoding = 0
+        self._granted = 0
         self._exiting = False
         self._failed = False
+        self._fail_reason = ""
+        self._frames = collections.deque()
+        self._local = threading.local()
+        self._lost = False
+        self._paused = threading.Event()
+        self._pausing = threading.Event()
+        self._pool = None
+        self._workers = os.cpu_count() or 1
+        self._recorder = None
+        self._resume_at = 0
         self._session = None
         self._size = 0
+        self._sparse = False
         self._socket = None
+        self._stages = []
         self._stream = None
+        self._synced = None
         self._thread = None
+        self._unsynced = 0
         self._receiving = False
         self._writing = False
         self._written = 0
         self._seeked = 0
+        self._sequence = 0
         # number of mapped bytes, if available
         self._mapped = 0
         self._zdec = None
@@ -73,6 +142,32 @@ class AsyncImageWriter:
         result = compression
         self.mtda.debug(3, f"storage.writer.compression.set(): {str(result)}")
 
+    @property
+    def sparse(self):
+        return self._sparse
+
+    @sparse.setter
+    def sparse(self, enabled):
+        """
+        Whether the data stream is made of frames holding mapped ranges of
+        the image (see Frame) rather than the image itself
+        """
+        self.mtda.debug(3, "storage.writer.sparse.set()")
+
+        self._sparse = enabled is True
+
+        self.mtda.debug(3, f"storage.writer.sparse.set(): {self._sparse}")
+
+    def record(self, recorder):
+        """ Record received data (e.g. into the image cache) """
+        self.mtda.debug(3, "storage.writer.record()")
+
+        if self._recorder is not None:
+            self._recorder.discard()
+        self._recorder = recorder
+
+        self.mtda.debug(3, "storage.writer.record(): exit")
+
     def enqueue(self, data, callback=None):
         self.mtda.debug(3, "mtda.storage.writer.enqueue()")
 
@@ -83,6 +178,35 @@ class AsyncImageWriter:
         self.mtda.debug(3, f"storage.writer.enqueue(): {result}")
         return result
 
+    def credits(self):
+        """
+        Get the number of bytes the client may have sent so far. Received
+        data is consumed as the decompressor takes it from its queue: CREDIT
+        events then tell the client how much more it may send (see _grant())
+        so that the data stream is kept busy with bounded buffering.
+        """
+        self.mtda.debug(3, "storage.writer.credits()")
+
+        if self._failed is True:
+            raise RuntimeError(f'write failed: {self._fail_reason}')
+        self._crediting = True
+        result = self._consumed + CONSTS.WRITER.CREDIT_WINDOW
+        self._granted = self._consumed
+
+        self.mtda.debug(3, f"storage.writer.credits(): {result}")
+        return result
+
+    def _grant(self, size):
+        """ Grant credits for data consumed from the data stream """
+        self._consumed += size
+        if self._crediting is False:
+            return
+        # grant credits in batches of a quarter of the window
+        if self._consumed - self._granted >= CONSTS.WRITER.CREDIT_WINDOW // 4:
+            self._granted = self._consumed
+            limit = self._consumed + CONSTS.WRITER.CREDIT_WINDOW
+            self.mtda._storage_event(f'{CONSTS.STORAGE.CREDIT} {limit}')
+
     @property
     def failed(self):
         return self._failed
@@ -100,12 +224,84 @@ class AsyncImageWriter:
         self.mtda.debug(3, f"storage.writer.flush(): {result}")
         return result
 
+    def received(self, sent):
+        """
+        Wait for the specified number of bytes sent by the client to be
+        received. Returns the number of bytes received and whether frames
+        were lost: the transfer shall then be resumed (see resume()). Stops
+        waiting if the data stream stalls.
+        """
+        self.mtda.debug(3, "storage.writer.received()")
+
+        last = None
+        deadline = 0
+        while self._received < sent and self._lost is False and \
+                self._exiting is False:
+            now = time.monotonic()
+            if self._received != last:
+                last = self._received
+                deadline = now + CONSTS.WRITER.RECV_TIMEOUT
+            elif now > deadline:
+                break
+            time.sleep(CONSTS.WRITER.QUEUE_TIMEOUT / 10)
+        result = (self._received, self._lost)
+
+        self.mtda.debug(3, f"storage.writer.received(): {result}")
+        return result
+
+    def resume(self, sent=0):
+        """
+        Resume a transfer of frames on a new data stream (e.g. after the
+        network connection was lost). Data is received until the specified
+        number of bytes sent by the client or until the data stream stalls.
+        Frames already received are then written: the client shall send
+        frames from the returned offset (the end of the last frame written)
+        starting with sequence number 0. Returns the new port, the offset
+        and the number of bytes received.
+        """
+        self.mtda.debug(3, "storage.writer.resume()")
+
+        if self._sparse is False or self._receiving is False:
+            raise RuntimeError('transfer cannot be resumed')
+
+        # wait for the receiver to stop reading from the data stream
+        self._resume_at = sent
+        self._pausing.set()
+        try:
+            while self._paused.wait(CONSTS.WRITER.QUEUE_TIMEOUT) is False:
+                if self._exiting is True:
+                    raise RuntimeError('transfer cannot be resumed')
+
+            # write frames that were received
+            for inbox in [self._chunks, self._blocks]:
+                while inbox.unfinished_tasks > 0:
+                    if self._exiting is True:
+                        raise RuntimeError('transfer cannot be resumed')
+                    time.sleep(CONSTS.WRITER.QUEUE_TIMEOUT / 10)
+
+            self._stream.close()
+            port = self._stream.prepare()
+            self._sequence = 0
+            self._lost = False
+            result = (port, self._checkpoint, self._received)
+        finally:
+            self._pausing.clear()
+            # wait for the receiver to read from the new data stream
+            while self._paused.is_set() and self._exiting is False:
+                time.sleep(CONSTS.WRITER.QUEUE_TIMEOUT / 10)
+
+        self.mtda.debug(3, f"storage.writer.resume(): {result}")
+        return result
+
     def start(self, session, size, stream):
         self.mtda.debug(3, "mtda.storage.writer.start()")
 
         self._session = session
         self._size = size
         self._stream = stream
+        self._consumed = 0
+        self._crediting = False
+        self._granted = 0
         self._written = 0
         self._seeked = 0
         self._mapped = 0
@@ -132,6 +328,8 @@ class AsyncImageWriter:
 
         self._thread = None
         self._zdec = None
+        self._sparse = False
+        self.record(None)
 
         self.mtda.debug(3, f"storage.writer.stop(): {result}")
         return result
@@ -159,6 +357,12 @@ class AsyncImageWriter:
             details = f'{self._written} {self._mapped} {speed} {self.written}'
         else:
             details = f'{self._received} {self._size} {speed} {self.written}'
+        # Append queue depth and busy time (in seconds) of each stage
+        for stage in self._stages:
+            details += f' {stage}'
+        # and time taken to make written data durable
+        if self._synced is not None:
+            details += f' sync={self._synced:.3f}'
 
         self.mtda.debug(2, "storage.writer.notify_write(): "
                            f"progress event: {details}")
@@ -166,41 +370,116 @@ class AsyncImageWriter:
         self._last_notification = now
         self._last_written = self._written
 
-    def worker(self):
-        self.mtda.debug(3, "storage.writer.worker()")
+    def _abort(self, reason):
+        if self._failed is False or not self._fail_reason:
+            self._fail_reason = reason
+        self._failed = True
+        self._exiting = True
+
+    def _retries(self):
+        # wait for the client to resume transfers of frames
+        if self._sparse is True:
+            return max(CONSTS.WRITER.RECV_RETRIES,
+                       CONSTS.WRITER.RESUME_TIMEOUT // CONSTS.WRITER.RECV_TIMEOUT)
+        return CONSTS.WRITER.RECV_RETRIES
+
+    def _pause(self):
+        """ Pause the receiver while the transfer is being resumed """
+        self._paused.set()
+        while self._pausing.is_set() and self._exiting is False:
+            time.sleep(CONSTS.WRITER.QUEUE_TIMEOUT / 10)
+        self._paused.clear()
+
+    def _get(self, inbox):
+        """ Get the next item from a stage inbox, None if aborted """
+        while self._exiting is False:
+            try:
+                return inbox.get(timeout=CONSTS.WRITER.QUEUE_TIMEOUT)
+            except queue.Empty:
+                pass
+        return None
+
+    def _put(self, outbox, item):
+        """ Queue an item for the next stage, return False if aborted """
+        start = time.monotonic()
+        while self._exiting is False:
+            try:
+                outbox.put(item, timeout=CONSTS.WRITER.QUEUE_TIMEOUT)
+                break
+            except queue.Full:
+                pass
+        # time spent waiting on the next stage is not busy time: it is
+        # accounted for the calling thread (see _busy())
+        self._local.waited = self._waited() + time.monotonic() - start
+        return self._exiting is False
+
+    def _waited(self):
+        return getattr(self._local, 'waited', 0.0)
+
+    def _busy(self, stage, start, waited):
+        """ Charge time elapsed since start to a stage (less waits) """
+        stage.busy += time.monotonic() - start - (self._waited() - waited)
+
+    def output(self, data):
+        """ Queue decompressed data for the block writer """
+        size = len(data)
+        if size == 0:
+            return 0
+        if size <= self._blksz and isinstance(data, bytes):
+            self._put(self._blocks, data)
+            return size
+        # split large blocks to bound memory used by queued data
+        view = memoryview(data)
+        for offset in range(0, size, self._blksz):
+            block = bytes(view[offset:offset + self._blksz])
+            if self._put(self._blocks, block) is False:
+                break
+        return size
+
+    def receiver(self):
+        self.mtda.debug(3, "storage.writer.receiver()")
 
         mtda = self.mtda
-        tries = CONSTS.WRITER.RECV_RETRIES
-        fail_reason = ""
-        self._exiting = False
-        self._failed = True
-        self._last_notification = time.monotonic()
-        self._last_written = 0
-        self._received = 0
-        self._receiving = True
-        self._written = 0
-        self._writing = True
+        stage = self._stages[0]
+        tries = self._retries()
+        complete = False
         while self._exiting is False:
+            if self._pausing.is_set() and self._received >= self._resume_at:
+                self._pause()
+                tries = self._retries()
+                continue
             try:
                 chunk = self._stream.pop()
                 if len(chunk) == 0:
-                    mtda.debug(2, "storage.writer.worker(): empty chunk "
+                    mtda.debug(2, "storage.writer.receiver(): empty chunk "
                                   "transfer complete")
-                    self._failed = False
+                    complete = True
                     break
+                start = time.monotonic()
+                waited = self._waited()
                 self._received += len(chunk)
+                # frames are recorded once accepted (see write_frame())
+                if self._recorder is not None and self._sparse is False:
+                    self._recorder.write(chunk)
 
-                tries = CONSTS.WRITER.RECV_RETRIES
-                self._write(chunk)
+                tries = self._retries()
+                self._put(self._chunks, chunk)
+                self._busy(stage, start, waited)
 
             except RetryException:
+                if self._pausing.is_set():
+                    # no more data to be received before resuming
+                    self._pause()
+                    tries = self._retries()
+                    continue
                 tries = tries - 1
                 if self._receiving is False:
                     if self._size > 0 and self._received == self._size:
-                        mtda.debug(2, "storage.writer.worker(): "
+                        mtda.debug(2, "storage.writer.receiver(): "
                                       "transfer complete")
+                        complete = True
                         break
-                    mtda.debug(1, "storage.writer.worker(): "
+                    mtda.debug(1, "storage.writer.receiver(): "
                                   "incomplete transfer")
                     tries = 0
 
@@ -212,21 +491,175 @@ class AsyncImageWriter:
                 if self._size > 0:
                     total = f" / {self._size}"
 
-                mtda.debug(1, f"storage.writer.worker(): timeout!{retries} "
+                mtda.debug(1, f"storage.writer.receiver(): timeout!{retries} "
                               f"(recv'd {self._received}{total})")
 
                 if tries == 0:
-                    self._failed = True
-                    fail_reason = "too many retries"
+                    self._abort("too many retries")
                     break
 
             except Exception as e:
                 import traceback
-                self._failed = True
-                fail_reason = str(e)
-                mtda.debug(1, f"storage.writer.worker(): {e}")
+                mtda.debug(1, f"storage.writer.receiver(): {e}")
                 mtda.debug(1, traceback.format_exc())
+                self._abort(str(e))
+                break
+
+        self._receiving = False
+        if complete is True:
+            # tell the decompressor that there is no more data
+            self._put(self._chunks, None)
+
+        mtda.debug(3, "storage.writer.receiver(): exit")
+
+    def decompressor(self):
+        self.mtda.debug(3, "storage.writer.decompressor()")
+
+        mtda = self.mtda
+        stage = self._stages[1]
+        # the compression of the image (and whether it is made of frames)
+        # is only set once the writer was started: pick the external
+        # decompressor when data is received
+        external = self.external
+        while self._exiting is False:
+            chunk = self._get(self._chunks)
+            if chunk is None:
+                try:
+                    if isinstance(self._zdec, (BlockSplitter,
+                                               ExternalDecompressor)):
+                        self._zdec.finish()
+                    self._output_frames()
+                except Exception as e:
+                    mtda.debug(1, f"storage.writer.decompressor(): {e}")
+                    self._abort(str(e))
+                if self._lost is True:
+                    self._abort("frames were lost")
+                break
+            start = time.monotonic()
+            waited = self._waited()
+            self._grant(len(chunk))
+            try:
+                if external is True and self._sparse is False:
+                    self._zdec = self._external()
+                external = False
+                if self._sparse is True:
+                    self.write_frame(chunk)
+                    # keep workers busy unless we are running out of frames
+                    if self._chunks.qsize() == 0:
+                        self._output_frames()
+                    else:
+                        self._output_frames(self._workers * 2)
+                elif isinstance(self._zdec, ExternalDecompressor):
+                    self._zdec.write(chunk)
+                else:
+                    self._write(chunk)
+                    self._output_frames(self._workers)
+            except Exception as e:
+                import traceback
+                mtda.debug(1, f"storage.writer.decompressor(): {e}")
+                mtda.debug(1, traceback.format_exc())
+                self._abort(str(e))
+            self._busy(stage, start, waited)
+            self._chunks.task_done()
+
+        self._frames.clear()
+        self._decoding = 0
+        if isinstance(self._zdec, ExternalDecompressor):
+            self._zdec.close()
+        if self._exiting is False:
+            # tell the block writer that there is no more data
+            self._put(self._blocks, None)
+
+        mtda.debug(3, "storage.writer.decompressor(): exit")
+
+    def _external(self):
+        """ Start an external decompressor, None if not available """
+        if self._compression == CONSTS.IMAGE.RAW:
+            return None
+        cmd = ExternalDecompressor.find(self._compression)
+        if cmd is None:
+            self.mtda.debug(2, "storage.writer._external(): no tool found, "
+                               "using in-process decompression")
+            return None
+        try:
+            result = ExternalDecompressor(cmd, self.output, self._blksz)
+            self.mtda.debug(2, f"storage.writer._external(): using {cmd[0]}")
+        except OSError as e:
+            self.mtda.debug(1, f"storage.writer._external(): {e}")
+            result = None
+        return result
+
+    def worker(self):
+        self.mtda.debug(3, "storage.writer.worker()")
+
+        mtda = self.mtda
+        self._checkpoint = 0
+        self._exiting = False
+        self._failed = False
+        self._fail_reason = ""
+        self._lost = False
+        self._sequence = 0
+        self._synced = None
+        self._unsynced = 0
+        self._last_notification = time.monotonic()
+        self._last_written = 0
+        self._received = 0
+        self._receiving = True
+        self._written = 0
+        self._writing = True
+
+        # Receive, decompress and write data in separate stages connected
+        # with bounded queues so network, CPU and I/O activities overlap
+        self._chunks = queue.Queue(CONSTS.WRITER.QUEUE_SIZE)
+        self._blocks = queue.Queue(CONSTS.WRITER.QUEUE_SIZE)
+        stage = WriterStage('write', self._blocks)
+        self._stages = [
+            WriterStage('recv'),
+            WriterStage('decompress', self._chunks),
+            stage
+        ]
+        threads = [
+            threading.Thread(target=self.receiver,
+                             daemon=True, name='writer.recv'),
+            threading.Thread(target=self.decompressor,
+                             daemon=True, name='writer.decompress')
+        ]
+        # frames are decompressed on a pool of threads
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            self._workers, thread_name_prefix='writer.frame')
+        for t in threads:
+            t.start()
+
+        while self._exiting is False:
+            data = self._get(self._blocks)
+            if data is None:
                 break
+            start = time.monotonic()
+            try:
+                if isinstance(data, tuple):
+                    offset, data = data
+                    self.storage.pwrite(data, offset)
+                    self._checkpoint = offset + len(data)
+                else:
+                    self.storage.write(data)
+                self._writeback(len(data))
+            except Exception as e:
+                import traceback
+                mtda.debug(1, f"storage.writer.worker(): {e}")
+                mtda.debug(1, traceback.format_exc())
+                self._abort(str(e))
+            stage.busy += time.monotonic() - start
+            self._blocks.task_done()
+
+        # Data may not be fully written if we were asked to stop
+        if self._exiting is True and self._failed is False:
+            self._abort("stopped")
+
+        self._exiting = True
+        for t in threads:
+            t.join()
+        self._pool.shutdown()
+        self._pool = None
 
         self._receiving = False
         self._writing = False
@@ -235,26 +668,159 @@ class AsyncImageWriter:
             self._stream.close()
             self._stream = None
 
+        if self._failed is False:
+            self._sync()
+
         # Issue a write event to notify subscribers about final counters
         # This needs to happen before the INITIALIZED / CORRUPTED event,
         # as this is used to inform the subscribers about termination of
         # the write operation.
         self.notify_write(force=True)
+        self._commit()
         if self._failed is False:
             mtda._storage_event(CONSTS.STORAGE.INITIALIZED)
         else:
             mtda.debug(1, "storage.writer.worker(): "
                           "write or decompression error!")
-            mtda._storage_event(CONSTS.STORAGE.CORRUPTED, fail_reason)
+            mtda._storage_event(CONSTS.STORAGE.CORRUPTED, self._fail_reason)
 
         mtda.debug(3, "storage.writer.worker(): exit")
 
+    def _writeback(self, size):
+        """ Periodically start writeback of written data """
+        if self.sync_interval > 0:
+            self._unsynced += size
+            if self._unsynced >= self.sync_interval:
+                self.storage.sync(incremental=True)
+                self._unsynced = 0
+
+    def _sync(self):
+        """ Make written data durable """
+        start = time.monotonic()
+        try:
+            self.storage.sync()
+        except Exception as e:
+            self.mtda.debug(1, f"storage.writer._sync(): {e}")
+            self._abort(str(e))
+        self._synced = time.monotonic() - start
+
+    def _commit(self):
+        recorder = self._recorder
+        self._recorder = None
+        if recorder is None:
+            return
+        try:
+            if self._failed is False:
+                bmap = getattr(self.storage, 'bmap', None)
+                if bmap is not None:
+                    bmap = base64.b64encode(bmap.encode()).decode()
+                recorder.commit(compression=self._compression.value,
+                                sparse=self._sparse, bmap=bmap)
+            else:
+                recorder.discard()
+        except (OSError, ValueError) as e:
+            # a failure to cache the image is not a write failure
+            self.mtda.debug(1, f"storage.writer._commit(): {e}")
+
+    def write_frame(self, message):
+        self.mtda.debug(3, "storage.writer.write_frame()")
+
+        sequence, offset, size, payload = Frame.decode(message)
+        if sequence != self._sequence:
+            # frames were lost (e.g. the connection was reset): drop frames
+            # until the client resumes the transfer
+            if self._lost is False:
+                self.mtda.debug(1, "storage.writer.write_frame(): "
+                                   f"expected frame {self._sequence}, "
+                                   f"got {sequence}!")
+            self._lost = True
+            return 0
+        self._sequence += 1
+        if self._compression not in [CONSTS.IMAGE.ZST, CONSTS.IMAGE.RAW]:
+            raise ValueError("unsupported compression for sparse images!")
+        if self._recorder is not None:
+            self._recorder.write_frame(offset, size, payload)
+        future = self._pool.submit(self._decompress_frame,
+                                   offset, size, payload)
+        self._frames.append((None, future, 0))
+
+        self.mtda.debug(3, f"storage.writer.write_frame(): {size}")
+        return size
+
+    def _decompress_frame(self, offset, size, payload):
+        if self._compression == CONSTS.IMAGE.ZST:
+            # frames are compressed independently from each other
+            # but decompressors cannot be shared between threads
+            zdec = getattr(self._local, 'zdec', None)
+            if zdec is None:
+                zdec = self._local.zdec = zstd.ZstdDecompressor()
+            data = zdec.decompress(payload, max_output_size=size)
+        else:
+            data = bytes(payload)
+        if len(data) != size:
+            raise ValueError(f"frame at offset {offset} has {len(data)} "
+                             f"bytes instead of {size}!")
+        return offset, data
+
+    def _output_frames(self, count=0):
+        """ Queue decompressed frames or blocks for the block writer """
+        while len(self._frames) > count:
+            job, future, size = self._frames.popleft()
+            self._decoding -= size
+            try:
+                item = future.result()
+            except Exception as e:
+                item = self._merge_blocks(job, e)
+            if isinstance(item, tuple):
+                recorder = self._recorder
+                if recorder is not None:
+                    # frames are cached if they hold the expected image
+                    recorder.update(*item)
+                self._put(self._blocks, item)
+            else:
+                self.output(item)
+            if self._exiting is True:
+                break
+
+    def _merge_blocks(self, job, error):
+        """
+        Decode a block that could not be decoded along with the next block:
+        its end may have been wrongly found (e.g. bz2 block magic found in
+        compressed data)
+        """
+        merge = getattr(self._zdec, 'merge', None)
+        tries = 2
+        while job is not None and merge is not None and self._frames \
+                and tries > 0:
+            next_job, _, size = self._frames.popleft()
+            self._decoding -= size
+            job = merge(job, next_job)
+            tries -= 1
+            try:
+                return self._zdec.decode(job)
+            except Exception:
+                pass
+        raise error
+
+    def _split(self, data):
+        """ Decode blocks found in data on the pool of threads """
+        for job in self._zdec.feed(data):
+            # bound memory used by decoded blocks (that may be large)
+            size = self._zdec.size(job)
+            while self._frames and self._exiting is False and \
+                    self._decoding + size > CONSTS.WRITER.DECODE_MEMORY:
+                self._output_frames(len(self._frames) - 1)
+            future = self._pool.submit(self._zdec.decode, job)
+            self._frames.append((job, future, size))
+            self._decoding += size
+        return len(data)
+
     def write_raw(self, data):
         self.mtda.debug(3, "storage.writer.write_raw()")
 
         result = None
         try:
-            result = self.storage.write(data)
+            result = self.output(data)
         except OSError as e:
             self.mtda.debug(1, f"storage.writer.write_raw(): {e}")
             raise
@@ -276,7 +842,7 @@ class AsyncImageWriter:
                 uncompressed = self._zdec.decompress(data, self._blksz)
                 data = self._zdec.unconsumed_tail
                 cont = len(data) > 0
-                result = self.storage.write(uncompressed)
+                result = self.output(uncompressed)
         except (OSError, zlib.error) as e:
             self.mtda.debug(1, f"storage.writer.write_gz(): {e}")
             raise
@@ -289,14 +855,23 @@ class AsyncImageWriter:
 
         # Create a bz2 decompressor when called for the first time
         if self._zdec is None:
-            self._zdec = bz2.BZ2Decompressor()
+            if self._workers > 1:
+                self._zdec = Bz2Splitter()
+            else:
+                self._zdec = bz2.BZ2Decompressor()
+
+        # Decode blocks in parallel
+        if isinstance(self._zdec, Bz2Splitter):
+            result = self._split(data)
+            self.mtda.debug(3, f"storage.writer.write_bz2(): {str(result)}")
+            return result
 
         try:
             cont = True
             result = None
             while cont is True:
                 uncompressed = self._zdec.decompress(data, self._blksz)
-                result = self.storage.write(uncompressed)
+                result = self.output(uncompressed)
                 cont = self._zdec.needs_input is False
                 data = b''
         except EOFError:
@@ -315,7 +890,7 @@ class AsyncImageWriter:
         # Create a decompressor when called for the first time
         if self._zdec is None:
             dctx = zstd.ZstdDecompressor()
-            self._zdec = dctx.stream_writer(self.storage)
+            self._zdec = dctx.stream_writer(BlockSink(self))
         try:
             result = self._zdec.write(data)
         except OSError as e:
@@ -330,14 +905,29 @@ class AsyncImageWriter:
 
         # Create a xz decompressor when called for the first time
         if self._zdec is None:
-            self._zdec = lzma.LZMADecompressor()
+            if self._workers > 1:
+                self._zdec = XzSplitter()
+            else:
+                self._zdec = lzma.LZMADecompressor()
+
+        # Decode blocks in parallel if their sizes are known
+        if isinstance(self._zdec, XzSplitter):
+            try:
+                result = self._split(data)
+                self.mtda.debug(3, f"storage.writer.write_xz(): {str(result)}")
+                return result
+            except NotSplittable as e:
+                self.mtda.debug(2, "storage.writer.write_xz(): "
+                                   "decoding blocks sequentially")
+                self._zdec = lzma.LZMADecompressor()
+                data = e.data
 
         try:
             cont = True
             result = None
             while cont is True:
                 uncompressed = self._zdec.decompress(data, self._blksz)
-                result = self.storage.write(uncompressed)
+                result = self.output(uncompressed)
                 cont = self._zdec.needs_input is False
                 data = b''
         except EOFError:
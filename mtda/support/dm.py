@@ -0,0 +1,119 @@
+# ---------------------------------------------------------------------------
+# Support for device-mapper
+# ---------------------------------------------------------------------------
+#
+# This software is a part of MTDA.
+# Copyright (C) 2025 Siemens AG
+#
+# ---------------------------------------------------------------------------
+# SPDX-License-Identifier: MIT
+# ---------------------------------------------------------------------------
+
+# System imports
+import fcntl
+import os
+import struct
+
+# struct dm_ioctl and struct dm_target_spec (see linux/dm-ioctl.h)
+DM_IOCTL = struct.Struct('=3IIIIiIIIQ128s129s7s')
+DM_TARGET_SPEC = struct.Struct('=QQiI16s')
+DM_VERSION = (4, 0, 0)
+DM_CONTROL = '/dev/mapper/control'
+DM_BUFFER_SIZE = 16384
+
+# commands
+DM_DEV_SUSPEND = 6
+DM_TABLE_LOAD = 9
+DM_TABLE_STATUS = 12
+
+# flags
+DM_SUSPEND_FLAG = 1 << 1
+DM_STATUS_TABLE_FLAG = 1 << 4
+DM_BUFFER_FULL_FLAG = 1 << 8
+
+
+def _iowr(nr):
+    return (3 << 30) | (DM_IOCTL.size << 16) | (0xfd << 8) | nr
+
+
+class DeviceMapper:
+    """
+    Drive device-mapper with ioctls on its control device rather than with
+    dmsetup: tables of existing devices may be loaded, swapped and queried
+    without forking. Devices are still created and removed with dmsetup so
+    that their nodes get managed by udev. Tables are lists of (start,
+    length, target type, parameters) with start and length in sectors.
+    """
+
+    def __init__(self, control=DM_CONTROL):
+        self._control = control
+
+    def _ioctl(self, cmd, name, flags=0, data=b'', target_count=0):
+        size = max(DM_IOCTL.size + len(data), DM_BUFFER_SIZE)
+        while True:
+            header = DM_IOCTL.pack(*DM_VERSION, size, DM_IOCTL.size,
+                                   target_count, 0, flags, 0, 0, 0,
+                                   name.encode(), b'', b'')
+            buf = bytearray(size)
+            buf[:DM_IOCTL.size] = header
+            buf[DM_IOCTL.size:DM_IOCTL.size + len(data)] = data
+            fd = os.open(self._control, os.O_RDWR)
+            try:
+                fcntl.ioctl(fd, _iowr(cmd), buf, True)
+            finally:
+                os.close(fd)
+            result = DM_IOCTL.unpack_from(buf)
+            if result[7] & DM_BUFFER_FULL_FLAG:
+                size *= 2
+                continue
+            return result, buf
+
+    def load(self, name, table):
+        """ Load a table into the inactive slot of a device """
+        data = bytearray()
+        for index, (start, length, target, params) in enumerate(table):
+            params = params.encode() + b'\0'
+            params += bytes(-(DM_TARGET_SPEC.size + len(params)) % 8)
+            spec = DM_TARGET_SPEC.size + len(params)
+            last = index == len(table) - 1
+            data += DM_TARGET_SPEC.pack(start, length, 0, 0 if last else spec,
+                                        target.encode())
+            data += params
+        self._ioctl(DM_TABLE_LOAD, name, data=bytes(data),
+                    target_count=len(table))
+
+    def suspend(self, name):
+        self._ioctl(DM_DEV_SUSPEND, name, DM_SUSPEND_FLAG)
+
+    def resume(self, name):
+        """ Resume a device, swapping its tables if one was loaded """
+        self._ioctl(DM_DEV_SUSPEND, name)
+
+    def reload(self, name, table):
+        """ Replace the table of a device """
+        self.suspend(name)
+        self.load(name, table)
+        self.resume(name)
+
+    def status(self, name):
+        """ Get the status of each target of a device """
+        return self._table(name, 0)
+
+    def table(self, name):
+        """ Get the active table of a device """
+        return self._table(name, DM_STATUS_TABLE_FLAG)
+
+    def _table(self, name, flags):
+        result = []
+        header, buf = self._ioctl(DM_TABLE_STATUS, name, flags)
+        count = header[5]
+        pos = header[4]
+        for _ in range(count):
+            start, length, _, next, target = DM_TARGET_SPEC.unpack_from(
+                buf, pos)
+            params = buf[pos + DM_TARGET_SPEC.size:].split(b'\0', 1)[0]
+            result.append((start, length, target.rstrip(b'\0').decode(),
+                           params.decode()))
+            # next is relative to the data of the ioctl for status
+            pos = header[4] + next
+        return result
@@ -0,0 +1,142 @@
+# ---------------------------------------------------------------------------
+# Test device-mapper ioctls
+# ---------------------------------------------------------------------------
+#
+# This software is a part of MTDA.
+# Copyright (C) 2025 Siemens AG
+#
+# ---------------------------------------------------------------------------
+# SPDX-License-Identifier: MIT
+# ---------------------------------------------------------------------------
+
+import pytest
+import types
+
+import mtda.support.dm as dm
+
+from mtda.support.dm import DeviceMapper
+
+# ioctl numbers (see linux/dm-ioctl.h)
+DM_DEV_SUSPEND = 0xc138fd06
+DM_TABLE_LOAD = 0xc138fd09
+DM_TABLE_STATUS = 0xc138fd0c
+
+TABLE = [(0, 100, 'snapshot-merge', '/dev/base /dev/cow P 8'),
+         (100, 8, 'linear', '8:1 0'),
+         (108, 1, 'error', ''),
+         (109, 20, 'zero', '')]
+
+
+class Control:
+    """ Mocked control device of device-mapper """
+
+    def __init__(self, table=TABLE, status_size=0):
+        self.calls = []
+        self.table = table
+        # size of the buffer needed by DM_TABLE_STATUS
+        self.status_size = status_size
+
+    def ioctl(self, fd, request, buf, mutate):
+        assert mutate is True
+        header = list(dm.DM_IOCTL.unpack_from(buf))
+        version, size, start, count, flags = (header[:3], header[3],
+                                              header[4], header[5], header[7])
+        name = header[11].rstrip(b'\0').decode()
+        assert version == [4, 0, 0]
+        assert size == len(buf) and start == dm.DM_IOCTL.size
+        self.calls.append((request, name, flags, size))
+
+        if request == DM_TABLE_LOAD:
+            # next is relative to the current target
+            pos = start
+            table = []
+            for index in range(count):
+                first, length, _, next, target = \
+                    dm.DM_TARGET_SPEC.unpack_from(buf, pos)
+                params = buf[pos + dm.DM_TARGET_SPEC.size:]
+                params = params.split(b'\0', 1)[0].decode()
+                if index < count - 1:
+                    assert next % 8 == 0
+                    assert next >= dm.DM_TARGET_SPEC.size + len(params) + 1
+                table.append((first, length, target.rstrip(b'\0').decode(),
+                              params))
+                pos += next
+            self.table = table
+        elif request == DM_TABLE_STATUS:
+            if size < self.status_size:
+                header[7] |= dm.DM_BUFFER_FULL_FLAG
+                buf[:dm.DM_IOCTL.size] = dm.DM_IOCTL.pack(*header)
+                return
+            # next is relative to the data of the ioctl
+            data = bytearray()
+            for first, length, target, params in self.table:
+                if not flags & dm.DM_STATUS_TABLE_FLAG:
+                    params = 'status ' + params
+                params = params.encode() + b'\0'
+                params += bytes(-(dm.DM_TARGET_SPEC.size + len(params)) % 8)
+                next = len(data) + dm.DM_TARGET_SPEC.size + len(params)
+                data += dm.DM_TARGET_SPEC.pack(first, length, 0, next,
+                                               target.encode())
+                data += params
+            buf[start:start + len(data)] = data
+            header[5] = len(self.table)
+            buf[:dm.DM_IOCTL.size] = dm.DM_IOCTL.pack(*header)
+        else:
+            assert request == DM_DEV_SUSPEND
+
+
+@pytest.fixture()
+def control(monkeypatch):
+    result = Control()
+    monkeypatch.setattr(dm, 'fcntl', types.SimpleNamespace(
+        ioctl=result.ioctl))
+    return result
+
+
+@pytest.fixture()
+def mapper(tmp_path):
+    path = tmp_path / 'control'
+    path.touch()
+    return DeviceMapper(str(path))
+
+
+def test_dm_layout():
+    assert dm.DM_IOCTL.size == 312
+    assert dm.DM_TARGET_SPEC.size == 40
+    assert dm._iowr(dm.DM_DEV_SUSPEND) == DM_DEV_SUSPEND
+    assert dm._iowr(dm.DM_TABLE_LOAD) == DM_TABLE_LOAD
+    assert dm._iowr(dm.DM_TABLE_STATUS) == DM_TABLE_STATUS
+
+
+def test_dm_load(control, mapper):
+    table = [(0, 10, 'snapshot', '/dev/base /dev/cow P 8'),
+             (10, 5, 'error', ''),
+             (15, 1, 'linear', '/dev/base 15')]
+    mapper.load('storage', table)
+    assert control.table == table
+    assert control.calls == [(DM_TABLE_LOAD, 'storage', 0,
+                              dm.DM_BUFFER_SIZE)]
+
+
+def test_dm_reload(control, mapper):
+    mapper.reload('storage', [(0, 1, 'zero', '')])
+    assert [call[:3] for call in control.calls] == [
+        (DM_DEV_SUSPEND, 'storage', dm.DM_SUSPEND_FLAG),
+        (DM_TABLE_LOAD, 'storage', 0),
+        (DM_DEV_SUSPEND, 'storage', 0)]
+    assert control.table == [(0, 1, 'zero', '')]
+
+
+def test_dm_table(control, mapper):
+    assert mapper.table('storage') == TABLE
+    assert mapper.status('storage') == [
+        (first, length, target, 'status ' + params)
+        for first, length, target, params in TABLE]
+
+
+def test_dm_buffer_full(control, mapper):
+    control.status_size = 4 * dm.DM_BUFFER_SIZE
+    assert mapper.table('storage') == TABLE
+    # the ioctl is retried with larger buffers
+    assert [call[3] for call in control.calls] == [
+        dm.DM_BUFFER_SIZE, 2 * dm.DM_BUFFER_SIZE, 4 * dm.DM_BUFFER_SIZE]
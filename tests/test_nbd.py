@@ -0,0 +1,250 @@
+# ---------------------------------------------------------------------------
+# Test sharing of the storage with the NBD protocol
+# ---------------------------------------------------------------------------
+#
+# This software is a part of MTDA.
+# Copyright (C) 2025 Siemens AG
+#
+# ---------------------------------------------------------------------------
+# SPDX-License-Identifier: MIT
+# ---------------------------------------------------------------------------
+
+import os
+import pytest
+import socket
+import struct
+
+import mtda.constants as CONSTS
+import mtda.storage.nbd as NBD
+
+from mtda.storage.helpers.image import Image
+from mtda.storage.nbd import NBDServer
+from mtda.storage.nbd import allow_list
+
+SIZE = 8*1024**2
+
+
+class Agent:
+    def debug(self, level, msg):
+        pass
+
+
+class FileImage(Image):
+    def __init__(self, mtda, path):
+        super().__init__(mtda)
+        self.file = path
+
+    def _status(self):
+        return CONSTS.STORAGE.ON_HOST
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture()
+def image(tmp_path):
+    path = tmp_path / 'storage.img'
+    path.write_bytes(os.urandom(SIZE))
+    return FileImage(Agent(), str(path))
+
+
+@pytest.fixture()
+def server(image):
+    port = free_port()
+    server = NBDServer(image.mtda, image.path(), port=port)
+    server.start()
+    server.port = port
+    yield server
+    server.stop()
+
+
+def receive(s, size):
+    result = b''
+    while len(result) < size:
+        data = s.recv(size - len(result))
+        assert data, 'connection closed'
+        result += data
+    return result
+
+
+def option(s, option, data=b''):
+    s.sendall(struct.pack('>QII', NBD.IHAVEOPT, option, len(data)) + data)
+
+
+def option_reply(s, option):
+    magic, opt, reply, size = struct.unpack('>QIII', receive(s, 20))
+    assert magic == NBD.REPLYMAGIC and opt == option
+    return reply, receive(s, size)
+
+
+def connect(port, name=b'mtda-storage', go=True, structured=True):
+    """ Connect and negotiate, returns the socket and the export size """
+    s = socket.create_connection(('127.0.0.1', port))
+    magic, opt, flags = struct.unpack('>QQH', receive(s, 18))
+    assert magic == NBD.NBDMAGIC and opt == NBD.IHAVEOPT
+    assert flags & NBD.FLAG_FIXED_NEWSTYLE
+    s.sendall(struct.pack('>I', NBD.FLAG_FIXED_NEWSTYLE |
+                          NBD.FLAG_NO_ZEROES))
+    if structured is True:
+        option(s, NBD.OPT_STRUCTURED_REPLY)
+        assert option_reply(s, NBD.OPT_STRUCTURED_REPLY)[0] == NBD.REP_ACK
+    if go is False:
+        option(s, NBD.OPT_EXPORT_NAME, name)
+        size, flags = struct.unpack('>QH', receive(s, 10))
+        return s, size
+    option(s, NBD.OPT_GO, struct.pack('>I', len(name)) + name +
+           struct.pack('>H', 0))
+    reply, data = option_reply(s, NBD.OPT_GO)
+    if reply != NBD.REP_INFO:
+        return s, reply
+    info, size, flags = struct.unpack('>HQH', data)
+    assert info == NBD.INFO_EXPORT
+    assert flags & NBD.TRANSMISSION_FLAGS == NBD.TRANSMISSION_FLAGS
+    assert option_reply(s, NBD.OPT_GO)[0] == NBD.REP_ACK
+    return s, size
+
+
+def request(s, cmd, offset, length, data=b'', flags=0, cookie=1):
+    s.sendall(NBD.REQUEST.pack(NBD.REQUEST_MAGIC, flags, cmd, cookie, offset,
+                               length) + data)
+
+
+def reply(s, structured=True, length=0):
+    """ Get the error, cookie and data of a reply """
+    if structured is False:
+        magic, error, cookie = NBD.SIMPLE_REPLY.unpack(
+            receive(s, NBD.SIMPLE_REPLY.size))
+        assert magic == NBD.SIMPLE_MAGIC
+        data = receive(s, length) if error == 0 else b''
+        return error, cookie, data
+    magic, flags, type, cookie, size = NBD.CHUNK.unpack(
+        receive(s, NBD.CHUNK.size))
+    assert magic == NBD.CHUNK_MAGIC and flags & NBD.REPLY_FLAG_DONE
+    payload = receive(s, size)
+    if type == NBD.REPLY_TYPE_ERROR:
+        return struct.unpack_from('>I', payload)[0], cookie, b''
+    elif type == NBD.REPLY_TYPE_OFFSET_DATA:
+        return 0, cookie, payload[8:]
+    return 0, cookie, b''
+
+
+def test_nbd_requests(image, server):
+    s, size = connect(server.port)
+    assert size == SIZE
+
+    data = os.urandom(1024**2)
+    request(s, NBD.CMD_WRITE, 4096, len(data), data, NBD.CMD_FLAG_FUA)
+    assert reply(s)[0] == 0
+    request(s, NBD.CMD_READ, 4096, len(data))
+    assert reply(s) == (0, 1, data)
+    request(s, NBD.CMD_READ, SIZE - 10, 20)
+    assert reply(s)[0] != 0
+
+    request(s, NBD.CMD_TRIM, 4*1024**2, 65536)
+    assert reply(s)[0] == 0
+    request(s, NBD.CMD_WRITE_ZEROES, 0, 65536)
+    assert reply(s)[0] == 0
+    request(s, NBD.CMD_FLUSH, 0, 0)
+    assert reply(s)[0] == 0
+    request(s, NBD.CMD_READ, 0, 65536)
+    assert reply(s) == (0, 1, bytes(65536))
+
+    request(s, NBD.CMD_DISC, 0, 0)
+    assert s.recv(1) == b''
+    s.close()
+
+    stats = server.stats()
+    assert stats['writes'] == 1 and stats['written_bytes'] == len(data)
+    assert stats['trims'] == 1 and stats['zeroes'] == 1
+    assert stats['flushes'] == 1 and stats['errors'] == 1
+
+    with open(image.path(), 'rb') as f:
+        written = f.read()
+    assert written[:65536] == bytes(65536)
+    assert written[65536:4096 + len(data)] == data[65536 - 4096:]
+
+
+def test_nbd_simple_replies(image, server):
+    # old clients select the export by name and get simple replies
+    s, size = connect(server.port, go=False, structured=False)
+    assert size == SIZE
+    # requests may complete out of order
+    for i in range(32):
+        request(s, NBD.CMD_READ, i * 65536, 65536, cookie=i)
+    replies = {}
+    for _ in range(32):
+        error, cookie, data = reply(s, False, 65536)
+        assert error == 0
+        replies[cookie] = data
+    with open(image.path(), 'rb') as f:
+        for i in range(32):
+            assert replies[i] == f.read(65536)
+    s.close()
+
+
+def test_nbd_options(server):
+    s = socket.create_connection(('127.0.0.1', server.port))
+    receive(s, 18)
+    s.sendall(struct.pack('>I', NBD.FLAG_FIXED_NEWSTYLE |
+                          NBD.FLAG_NO_ZEROES))
+    option(s, NBD.OPT_LIST)
+    reply, data = option_reply(s, NBD.OPT_LIST)
+    assert reply == NBD.REP_SERVER and data[4:] == b'mtda-storage'
+    assert option_reply(s, NBD.OPT_LIST)[0] == NBD.REP_ACK
+
+    name = b'mtda-storage'
+    option(s, NBD.OPT_INFO, struct.pack('>I', len(name)) + name +
+           struct.pack('>H', 0))
+    reply, data = option_reply(s, NBD.OPT_INFO)
+    assert reply == NBD.REP_INFO
+    assert struct.unpack('>HQH', data)[1] == SIZE
+    assert option_reply(s, NBD.OPT_INFO)[0] == NBD.REP_ACK
+
+    option(s, 1000)
+    assert option_reply(s, 1000)[0] == NBD.REP_ERR_UNSUP
+    option(s, NBD.OPT_ABORT)
+    assert option_reply(s, NBD.OPT_ABORT)[0] == NBD.REP_ACK
+    s.close()
+
+    s, reply = connect(server.port, name=b'unknown')
+    assert reply == NBD.REP_ERR_UNKNOWN
+    s.close()
+
+
+def test_nbd_allow(image, tmp_path):
+    path = tmp_path / 'allow'
+    assert allow_list(str(path)) is None
+    path.write_text('# networks allowed to connect\n'
+                    '10.0.0.0/8\n'
+                    '\n'
+                    '192.168.1.1\n')
+    allow = allow_list(str(path))
+    assert allow == ['10.0.0.0/8', '192.168.1.1']
+
+    port = free_port()
+    server = NBDServer(image.mtda, image.path(), port=port, allow=allow)
+    assert server._allowed('10.1.2.3') is True
+    assert server._allowed('::ffff:192.168.1.1') is True
+    assert server._allowed('192.168.1.2') is False
+    assert server._allowed('fe80::1%eth0') is False
+    server.start()
+    try:
+        # connections from other hosts are closed
+        s = socket.create_connection(('127.0.0.1', port))
+        assert s.recv(1) == b''
+        s.close()
+    finally:
+        server.stop()
+
+    server = NBDServer(image.mtda, image.path(), port=port,
+                       allow=allow + ['127.0.0.0/8'])
+    server.start()
+    try:
+        s, size = connect(port)
+        assert size == SIZE
+        s.close()
+    finally:
+        server.stop()
@@ -0,0 +1,152 @@
+# ---------------------------------------------------------------------------
+# Test splitting of compressed images into blocks
+# ---------------------------------------------------------------------------
+#
+# This software is a part of MTDA.
+# Copyright (C) 2025 Siemens AG
+#
+# ---------------------------------------------------------------------------
+# SPDX-License-Identifier: MIT
+# ---------------------------------------------------------------------------
+
+import bz2
+import lzma
+import pytest
+import random
+import shutil
+import subprocess
+
+from mtda.storage.splitter import Bz2Splitter
+from mtda.storage.splitter import NotSplittable
+from mtda.storage.splitter import XzSplitter
+
+
+def image(size=3*1024**2):
+    # runs of bytes and random data for blocks of various sizes
+    rnd = random.Random(size)
+    result = bytearray()
+    while len(result) < size:
+        result += bytes([rnd.randrange(256)]) * rnd.randrange(1, 100)
+        result += rnd.randbytes(rnd.randrange(1, 500))
+    return bytes(result[:size])
+
+
+def xz(data, *args):
+    if shutil.which('xz') is None:
+        pytest.skip('xz not installed')
+    return subprocess.run(['xz', '-c'] + list(args), input=data,
+                          stdout=subprocess.PIPE, check=True).stdout
+
+
+def split(splitter, data, chunk):
+    """ Feed data in chunks and decode blocks that were found """
+    jobs = []
+    for offset in range(0, len(data), chunk):
+        jobs += list(splitter.feed(data[offset:offset + chunk]))
+    splitter.finish()
+    return b''.join(splitter.decode(job) for job in jobs), len(jobs)
+
+
+def test_xz_multi_threaded():
+    data = image()
+    output, blocks = split(XzSplitter(), xz(data, '-T4', '--block-size=1MiB'),
+                           77777)
+    assert output == data
+    assert blocks == 3
+
+
+def test_xz_single_threaded():
+    data = image()
+    stream = xz(data, '-T1')
+    splitter = XzSplitter()
+    # header and first block in separate chunks
+    assert list(splitter.feed(stream[:12])) == []
+    with pytest.raises(NotSplittable) as e:
+        list(splitter.feed(stream[12:4097]))
+    # data handed back includes the stream header
+    assert lzma.decompress(e.value.data + stream[4097:]) == data
+
+
+@pytest.mark.parametrize('args', [[], ['--x86', '--lzma2'],
+                                  ['--delta=dist=4', '--lzma2'],
+                                  ['-C', 'crc32'], ['-C', 'sha256'],
+                                  ['-C', 'none']])
+def test_xz_concatenated(args):
+    data = image()
+    stream = xz(data, '-T4', '--block-size=1MiB') + bytes(8)
+    # blocks of the second stream are decoded sequentially
+    stream += xz(data[:100000], '-T1', *args)
+    output, _ = split(XzSplitter(), stream, 65535)
+    assert output == data + data[:100000]
+
+
+def test_xz_corrupted():
+    data = image()
+    stream = bytearray(xz(data, '-T4', '--block-size=1MiB'))
+    stream[len(stream) // 2] ^= 1
+    with pytest.raises((ValueError, lzma.LZMAError)):
+        split(XzSplitter(), bytes(stream), 77777)
+
+    # data of a block decoded sequentially
+    head = xz(data, '-T4', '--block-size=1MiB')
+    stream = bytearray(xz(data[:100000], '-T1'))
+    stream[len(stream) // 2] ^= 1
+    with pytest.raises(ValueError):
+        split(XzSplitter(), head + bytes(stream), 77777)
+
+    # check of a block decoded sequentially (followed by the index and
+    # the stream footer, which holds the size of the index)
+    stream = bytearray(xz(data[:100000], '-T1', '-C', 'crc32'))
+    index = (int.from_bytes(stream[-8:-4], 'little') + 1) * 4
+    stream[-12 - index - 1] ^= 1
+    with pytest.raises(ValueError):
+        split(XzSplitter(), head + bytes(stream), 77777)
+
+
+def test_xz_truncated():
+    stream = xz(image(), '-T4', '--block-size=1MiB')
+    with pytest.raises(ValueError, match='truncated'):
+        split(XzSplitter(), stream[:-3], 77777)
+
+
+@pytest.mark.parametrize('level', [1, 9])
+def test_bz2(level):
+    data = image()
+    output, blocks = split(Bz2Splitter(), bz2.compress(data, level), 4097)
+    assert output == data
+    assert blocks > 1
+
+
+def test_bz2_concatenated():
+    data = image()
+    stream = bz2.compress(data, 1) + bz2.compress(b'') + bz2.compress(data, 9)
+    output, _ = split(Bz2Splitter(), stream, 7777)
+    assert output == data + data
+
+
+def test_bz2_false_magic():
+    data = image()
+    splitter = Bz2Splitter()
+    jobs = list(splitter.feed(bz2.compress(data, 1)))
+    level, block, shift, count = jobs[1]
+    # split a block as if its magic number was found in compressed data
+    pos = shift + count // 2
+    first = (level, block[:(pos + 7) // 8], shift, pos - shift)
+    second = (level, block[pos // 8:], pos % 8, count - (pos - shift))
+    with pytest.raises((ValueError, OSError)):
+        splitter.decode(first)
+    assert splitter.decode(splitter.merge(first, second)) == \
+        splitter.decode(jobs[1])
+
+
+def test_bz2_corrupted():
+    stream = bytearray(bz2.compress(image(), 1))
+    stream[len(stream) // 2] ^= 1
+    with pytest.raises((ValueError, OSError)):
+        split(Bz2Splitter(), bytes(stream), 4097)
+
+
+def test_bz2_truncated():
+    stream = bz2.compress(image(), 1)
+    with pytest.raises(ValueError, match='truncated'):
+        split(Bz2Splitter(), stream[:-3], 4097)
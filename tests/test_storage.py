@@ -67,3 +67,15 @@ def test_write_zst(powered_off):
     assert Target.on() is True
     Console.send("cat /etc/os-release\r")
     assert Console.wait_for("Ubuntu") is not None
+
+
+def test_write_xz_then_zst(powered_off):
+    # the compression of the image is only known once the writer started
+    assert Storage.to_host() is True
+    Storage.write("almalinux.tar.xz")
+    Storage.write("ubuntu.tar.zst")
+    assert Storage.to_target() is True
+
+    assert Target.on() is True
+    Console.send("cat /etc/os-release\r")
+    assert Console.wait_for("Ubuntu") is not None